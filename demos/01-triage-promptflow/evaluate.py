@@ -0,0 +1,308 @@
+"""Evaluate the triage prompt against labelled tickets
+
+Streams a JSONL file (`data/eval.jsonl` format, or the
+`{"inputs": {...}, "outputs": {...}}` format of `sample-data/tickets.jsonl`),
+classifies tickets with a bounded pool of workers under shared
+requests-per-minute / tokens-per-minute budgets, and reports accuracy,
+confusion matrices, throughput and latency percentiles. With
+`--batch-size N` each request classifies N tickets (`classify_batch`);
+with `--local` a TF-IDF classifier answers confident tickets without a call
+(`local_classifier.py`); with `--cache` repeated and near-duplicate tickets
+are answered from a `TriageCache`.
+
+    python evaluate.py --data data/eval.jsonl --concurrency 8 --tpm 60000
+"""
+import argparse
+import heapq
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from triage import (
+    CATEGORIES,
+    PRIORITIES,
+    RateLimits,
+    classify_batch,
+    create_client,
+    default_deployment,
+    merge_stats,
+    read_labelled_tickets,
+)
+from local_classifier import (
+    DEFAULT_THRESHOLD,
+    DEFAULT_TRAINING_FILES,
+    DISABLED_THRESHOLD,
+    LocalClassifier,
+    calibrate_threshold,
+    triage_tickets,
+)
+from triage_cache import TriageCache
+
+# Helpers shared with the RAG function live next to its function_app.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "02-rag-search", "rag-function"))
+from tracing import percentile  # noqa: E402
+
+load_dotenv()
+
+DEMO_DIR = os.path.dirname(os.path.abspath(__file__))
+MISMATCHES_SHOWN = 10
+
+parser = argparse.ArgumentParser(description="Score the triage prompt against labelled tickets")
+parser.add_argument("--data", default=os.path.join(DEMO_DIR, "data", "eval.jsonl"), help="Labelled tickets (JSONL)")
+parser.add_argument("--deployment", default=default_deployment(), help="Azure OpenAI chat deployment")
+parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight at once")
+parser.add_argument(
+    "--batch-size", type=int, default=int(os.getenv("TRIAGE_BATCH_SIZE", "1")),
+    help="Tickets classified per request (1 = one ticket per call)"
+)
+parser.add_argument(
+    "--rpm", type=float, default=float(os.getenv("TRIAGE_EVAL_RPM", "0")),
+    help="Requests-per-minute budget (0 = unlimited)"
+)
+parser.add_argument(
+    "--tpm", type=float, default=float(os.getenv("TRIAGE_EVAL_TPM", "0")),
+    help="Tokens-per-minute budget (0 = unlimited)"
+)
+parser.add_argument("--local", action="store_true", help="Answer confident tickets with the local classifier first")
+parser.add_argument(
+    "--local-threshold", type=float, default=DEFAULT_THRESHOLD,
+    help="Minimum local confidence (0-1) to skip the LLM (TRIAGE_LOCAL_THRESHOLD; unset: no ticket is answered locally)"
+)
+parser.add_argument(
+    "--local-target-accuracy", type=float,
+    help="Derive the threshold by cross-validating the training files against this local accuracy"
+)
+parser.add_argument(
+    "--local-train", nargs="+", default=DEFAULT_TRAINING_FILES,
+    help="Labelled JSONL files the local classifier is trained on"
+)
+parser.add_argument(
+    "--cache", action="store_true",
+    help="Answer repeated and near-duplicate tickets from the triage cache (TRIAGE_CACHE_* settings)"
+)
+parser.add_argument("--max-retries", type=int, default=5, help="Retries per ticket on 429, timeouts and 5xx")
+parser.add_argument("--timeout", type=float, default=30.0, help="Seconds per request")
+parser.add_argument("--limit", type=int, default=0, help="Only evaluate the first N tickets")
+parser.add_argument("--output", help="Write one JSON result per ticket to this file")
+parser.add_argument(
+    "--min-accuracy", type=float, default=0.0,
+    help="Exit with status 1 if accuracy on both fields is below this (0-1), for CI"
+)
+
+
+def print_confusion(title: str, labels: List[str], matrix: Dict[str, Dict[str, int]]):
+    """Rows are the expected label, columns the predicted one ("invalid" = unparseable answer)"""
+    columns = labels + ["invalid"]
+    rows = labels + sorted(set(matrix) - set(labels))
+    print(f"\n{title} (rows: expected, columns: predicted)")
+    print("| expected \\ predicted | " + " | ".join(columns) + " |")
+    print("|---|" + "---:|" * len(columns))
+    for expected in rows:
+        counts = matrix.get(expected, {})
+        print(f"| {expected} | " + " | ".join(str(counts.get(c, 0)) for c in columns) + " |")
+
+
+def chunked(items: Iterator[Dict], size: int) -> Iterator[List[Dict]]:
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class Tally:
+    """Accuracy, confusion matrices and latencies accumulated as results stream in (tickets aren't kept)"""
+
+    def __init__(self):
+        self.total = self.category_correct = self.priority_correct = self.both_correct = 0
+        self.errors = self.invalid = 0
+        self.category_matrix: Dict[str, Dict[str, int]] = {}
+        self.priority_matrix: Dict[str, Dict[str, int]] = {}
+        self.latencies: List[float] = []
+        self.sources: Dict[str, List[int]] = {}  # source -> [tickets, correct]
+        self.mismatch_count = 0
+        self._first_mismatches: List[Tuple[int, Dict]] = []  # max-heap on line of the earliest mismatches
+
+    def add(self, r: Dict):
+        predicted: Optional[Dict] = r["predicted"]
+        got_category = predicted["category"] if predicted else "invalid"
+        got_priority = predicted["priority"] if predicted else "invalid"
+        expected_category, expected_priority = r["expected"]["category"], r["expected"]["priority"]
+        row = self.category_matrix.setdefault(expected_category, {})
+        row[got_category] = row.get(got_category, 0) + 1
+        row = self.priority_matrix.setdefault(expected_priority, {})
+        row[got_priority] = row.get(got_priority, 0) + 1
+        category_ok, priority_ok = got_category == expected_category, got_priority == expected_priority
+        self.total += 1
+        self.category_correct += category_ok
+        self.priority_correct += priority_ok
+        self.both_correct += category_ok and priority_ok
+        self.errors += "error" in r
+        self.invalid += predicted is None and "error" not in r
+        self.latencies.append(r["latencyMs"])
+        counts = self.sources.setdefault(r["source"], [0, 0])
+        counts[0] += 1
+        counts[1] += predicted == r["expected"]
+        if not (category_ok and priority_ok):
+            self.mismatch_count += 1
+            heapq.heappush(self._first_mismatches, (-r["line"], r))
+            if len(self._first_mismatches) > MISMATCHES_SHOWN:
+                heapq.heappop(self._first_mismatches)
+
+    def mismatches(self) -> List[Dict]:
+        """The first MISMATCHES_SHOWN mismatches in file order"""
+        return [r for _, r in sorted(self._first_mismatches, key=lambda item: -item[0])]
+
+
+def evaluate(
+    batch: List[Dict], client, limits: RateLimits, classifier: Optional[LocalClassifier],
+    cache: Optional[TriageCache], args: argparse.Namespace, local_threshold: float
+) -> Tuple[List[Dict], Dict]:
+    """Classify one batch of tickets; returns (per-ticket results, call stats for the batch)"""
+    started = time.perf_counter()
+    results = [{"line": t["line"], "ticket_text": t["ticket_text"],
+                "expected": {"category": t["category"], "priority": t["priority"]}} for t in batch]
+    texts = [t["ticket_text"] for t in batch]
+    stats: Dict = {}
+    sources = ["llm"] * len(batch)
+    try:
+        if classifier:
+            predicted, sources, stats = triage_tickets(
+                client, texts, classifier, local_threshold, args.deployment, limits,
+                max_retries=args.max_retries, timeout=args.timeout, cache=cache
+            )
+        else:
+            predicted, stats = classify_batch(
+                client, args.deployment, texts, limits,
+                max_retries=args.max_retries, timeout=args.timeout, cache=cache
+            )
+        for result, classification in zip(results, predicted):
+            result["predicted"] = classification
+    except Exception as e:
+        for result in results:
+            result.update(predicted=None, error=f"{type(e).__name__}: {e}")
+    latency = round((time.perf_counter() - started) * 1000, 1)
+    local_latency = round(stats.get("localSeconds", 0.0) * 1000 / max(stats.get("localHits", 0), 1), 3)
+    for result, source in zip(results, sources):
+        result["source"] = source
+        result["latencyMs"] = local_latency if source == "local" else latency
+    return results, stats
+
+
+def main(args: argparse.Namespace) -> int:
+    client = create_client()
+    limits = RateLimits(args.rpm, args.tpm)
+    tickets = read_labelled_tickets(args.data)
+    if args.limit:
+        tickets = islice(tickets, args.limit)
+    batch_size = max(1, args.batch_size)
+    classifier = None
+    local_threshold = args.local_threshold
+    if args.local:
+        classifier = LocalClassifier.from_files(args.local_train)
+        if args.local_target_accuracy is not None:
+            training = [t for path in args.local_train if os.path.exists(path) for t in read_labelled_tickets(path)]
+            local_threshold = calibrate_threshold(training, args.local_target_accuracy)
+        threshold = "off" if local_threshold == DISABLED_THRESHOLD else f"{local_threshold:g}"
+        print(f"Local classifier trained on {classifier.examples} tickets (threshold {threshold})")
+        if any(os.path.abspath(path) == os.path.abspath(args.data) for path in args.local_train):
+            print("  Warning: --data is part of the training set, so local accuracy is optimistic")
+    cache = (TriageCache.from_env() or TriageCache()) if args.cache else None
+
+    output = open(args.output, "w", encoding="utf-8") if args.output else None
+    tally = Tally()
+    call_stats: Dict = {}
+    started = time.perf_counter()
+    print(f"Evaluating {args.data} with {args.deployment} "
+          f"(concurrency {args.concurrency}, batch size {batch_size}, "
+          f"rpm {args.rpm or 'unlimited'}, tpm {args.tpm or 'unlimited'})")
+
+    def collect(done):
+        for future in done:
+            batch_results, stats = future.result()
+            merge_stats(call_stats, stats)
+            for result in batch_results:
+                tally.add(result)
+                if output:
+                    output.write(json.dumps(result) + "\n")
+                if tally.total % 100 == 0:
+                    print(f"  {tally.total} tickets, {tally.total / (time.perf_counter() - started):.1f}/s")
+
+    # Only `concurrency` batches are read ahead and results are folded into the tally as they land, so memory
+    # grows only by one latency per ticket
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            in_flight = set()
+            for batch in chunked(iter(tickets), batch_size):
+                if len(in_flight) >= args.concurrency:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done)
+                in_flight.add(pool.submit(evaluate, batch, client, limits, classifier, cache, args, local_threshold))
+            collect(in_flight)
+    finally:
+        if output:
+            output.close()
+
+    elapsed = time.perf_counter() - started
+    total = tally.total
+    if not total:
+        print("No tickets found")
+        return 1
+
+    tokens = call_stats.get("tokens", 0)
+    requests = call_stats.get("requests", 0)
+    accuracy = tally.both_correct / total
+
+    print(f"\nTickets: {total}")
+    print(f"Category accuracy: {tally.category_correct / total:.1%} ({tally.category_correct}/{total})")
+    print(f"Priority accuracy: {tally.priority_correct / total:.1%} ({tally.priority_correct}/{total})")
+    print(f"Both correct:      {accuracy:.1%} ({tally.both_correct}/{total})")
+    print_confusion("Category", CATEGORIES, tally.category_matrix)
+    print_confusion("Priority", PRIORITIES, tally.priority_matrix)
+
+    print(f"\nThroughput: {total / elapsed:.1f} tickets/s, {tokens / elapsed * 60:,.0f} tokens/min "
+          f"({elapsed:.1f}s total, {tokens:,} tokens, {tokens / total:,.0f} tokens/ticket)")
+    if requests:
+        print(f"Requests: {requests} ({(total - call_stats.get('localHits', 0)) / requests:.1f} tickets/request"
+              + (f", {call_stats.get('fallbacks', 0)} single-ticket fallbacks" if batch_size > 1 else "") + ")")
+    else:
+        print("Requests: 0")
+    print("Latency (ms): " + ", ".join(f"p{p} {percentile(tally.latencies, p):,.0f}" for p in (50, 90, 95, 99)))
+    print(f"Retries: {call_stats.get('retries', 0)} (429s: {call_stats.get('throttled', 0)}), "
+          f"worker time waiting for budget or backoff: {call_stats.get('waited', 0.0):.1f}s")
+    if classifier:
+        local, local_correct = tally.sources.get("local", [0, 0])
+        llm, llm_correct = tally.sources.get("llm", [0, 0])
+        print(f"Local hit rate: {local / total:.1%} ({local}/{total}), "
+              f"{call_stats.get('localSeconds', 0.0) * 1e6 / total:,.0f} µs/ticket; "
+              f"accuracy local {local_correct / max(local, 1):.1%}, LLM {llm_correct / max(llm, 1):.1%}")
+    if cache:
+        cache_stats = cache.stats()
+        print(f"Triage cache: {call_stats.get('cacheHits', 0)} hits "
+              f"({cache_stats['exactHits']} exact, {cache_stats['nearHits']} near-duplicate), "
+              f"{cache_stats['entries']} entries")
+    print(f"Invalid answers: {tally.invalid}, failed requests: {tally.errors}")
+
+    if tally.mismatch_count:
+        mismatches = tally.mismatches()
+        print(f"\nFirst {len(mismatches)} of {tally.mismatch_count} mismatches:")
+        for r in mismatches:
+            got = r["predicted"] or {"category": "invalid", "priority": "invalid"}
+            print(f"  line {r['line']}: expected {r['expected']['category']}/{r['expected']['priority']}, "
+                  f"got {got['category']}/{got['priority']} - {r['ticket_text'][:80]}"
+                  + (f" [{r['error']}]" if "error" in r else ""))
+
+    if accuracy < args.min_accuracy:
+        print(f"\nAccuracy {accuracy:.1%} is below --min-accuracy {args.min_accuracy:.1%}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(parser.parse_args()))
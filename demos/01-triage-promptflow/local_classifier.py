@@ -0,0 +1,252 @@
+"""Local fast-path triage: a TF-IDF nearest-centroid classifier in front of the LLM
+
+Trained from labelled tickets (`data/eval.jsonl` plus historical labels such
+as `sample-data/tickets.jsonl`). Category and priority are predicted by
+separate centroid models; a ticket is answered locally only when both are
+confident, every other ticket goes to the chat model.
+
+Confidence is the margin between the best and second-best centroid
+similarity (`1 - second / best`): 0 when two labels tie, 1 when only one
+label shares any terms with the ticket. It ranks tickets but is not a
+probability of being right, so the fast path is off until a threshold is
+set: pick it from the cross-validated hit rate / accuracy table, or let
+`calibrate_threshold` derive it for a target accuracy:
+
+    python local_classifier.py --train data/eval.jsonl ../../sample-data/tickets.jsonl --target-accuracy 0.9
+"""
+import argparse
+import math
+import os
+import re
+import time
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from triage import (
+    RateLimits,
+    classify_batch,
+    default_deployment,
+    merge_stats,
+    read_labelled_tickets,
+)
+from triage_cache import TriageCache
+
+DEMO_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_TRAINING_FILES = [
+    os.path.join(DEMO_DIR, "data", "eval.jsonl"),
+    os.path.join(DEMO_DIR, "..", "..", "sample-data", "tickets.jsonl"),
+]
+# Confidence never exceeds 1, so the default sends every ticket to the LLM until a calibrated threshold is set
+DISABLED_THRESHOLD = math.inf
+DEFAULT_THRESHOLD = float(os.getenv("TRIAGE_LOCAL_THRESHOLD") or DISABLED_THRESHOLD)
+CALIBRATION_THRESHOLDS = [round(0.05 * i, 2) for i in range(20)]
+
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "but", "by", "can", "do", "for", "from", "have", "i", "if",
+    "in", "is", "it", "me", "my", "of", "on", "or", "our", "please", "so", "that", "the", "this", "to",
+    "was", "we", "with", "you", "your"
+}
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Lower-cased words and adjacent word pairs ("account locked" carries more than either word)"""
+    words = [w for w in TOKEN_PATTERN.findall(text.lower()) if w not in STOPWORDS and len(w) > 1]
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+def _normalize(vector: Dict[str, float]) -> Dict[str, float]:
+    norm = math.sqrt(sum(v * v for v in vector.values()))
+    return {term: v / norm for term, v in vector.items()} if norm else {}
+
+
+class CentroidModel:
+    """Nearest centroid over L2-normalized TF-IDF vectors for one label (category or priority)"""
+
+    def __init__(self, idf: Dict[str, float], centroids: Dict[str, Dict[str, float]]):
+        self.idf = idf
+        self.centroids = centroids
+
+    @classmethod
+    def train(cls, texts: List[str], labels: List[str], idf: Dict[str, float]) -> "CentroidModel":
+        sums: Dict[str, Counter] = {}
+        for text, label in zip(texts, labels):
+            sums.setdefault(label, Counter()).update(vectorize(text, idf))
+        return cls(idf, {label: _normalize(dict(total)) for label, total in sums.items()})
+
+    def predict(self, vector: Dict[str, float]) -> Tuple[Optional[str], float]:
+        """Return (label, confidence); (None, 0.0) when the ticket shares no terms with any label"""
+        scores = sorted(
+            ((sum(weight * centroid.get(term, 0.0) for term, weight in vector.items()), label)
+             for label, centroid in self.centroids.items()),
+            reverse=True
+        )
+        if not scores or scores[0][0] <= 0:
+            return None, 0.0
+        best, label = scores[0]
+        second = scores[1][0] if len(scores) > 1 else 0.0
+        return label, 1.0 - max(second, 0.0) / best
+
+
+def vectorize(text: str, idf: Dict[str, float]) -> Dict[str, float]:
+    """TF-IDF vector of a ticket, restricted to terms seen in training"""
+    counts = Counter(t for t in tokenize(text) if t in idf)
+    return _normalize({term: (1 + math.log(count)) * idf[term] for term, count in counts.items()})
+
+
+class LocalClassifier:
+    """Category and priority centroid models sharing one vocabulary"""
+
+    def __init__(self, category: CentroidModel, priority: CentroidModel, examples: int):
+        self.category = category
+        self.priority = priority
+        self.examples = examples
+
+    @classmethod
+    def train(cls, tickets: Iterable[Dict]) -> "LocalClassifier":
+        """Train from `read_labelled_tickets` rows; rows missing a label are skipped"""
+        rows = [t for t in tickets if t.get("category") and t.get("priority")]
+        if not rows:
+            raise ValueError("No labelled tickets to train the local classifier on")
+        texts = [t["ticket_text"] for t in rows]
+        document_frequency = Counter(term for text in texts for term in set(tokenize(text)))
+        idf = {term: math.log((1 + len(texts)) / (1 + df)) + 1 for term, df in document_frequency.items()}
+        return cls(
+            CentroidModel.train(texts, [t["category"] for t in rows], idf),
+            CentroidModel.train(texts, [t["priority"] for t in rows], idf),
+            len(rows)
+        )
+
+    @classmethod
+    def from_files(cls, paths: Optional[List[str]] = None) -> "LocalClassifier":
+        tickets = []
+        for path in paths or DEFAULT_TRAINING_FILES:
+            if os.path.exists(path):
+                tickets.extend(read_labelled_tickets(path))
+        return cls.train(tickets)
+
+    def predict(self, ticket_text: str) -> Tuple[Optional[Dict[str, str]], float]:
+        """Return ({"category", "priority"} or None, confidence of the less certain of the two)"""
+        vector = vectorize(ticket_text, self.category.idf)
+        category, category_confidence = self.category.predict(vector)
+        priority, priority_confidence = self.priority.predict(vector)
+        if category is None or priority is None:
+            return None, 0.0
+        return {"category": category, "priority": priority}, min(category_confidence, priority_confidence)
+
+
+def triage_tickets(
+    client,
+    ticket_texts: List[str],
+    classifier: LocalClassifier,
+    threshold: float = DEFAULT_THRESHOLD,
+    deployment: Optional[str] = None,
+    limits: Optional[RateLimits] = None,
+    max_retries: int = 5,
+    timeout: float = 30.0,
+    cache: Optional[TriageCache] = None
+) -> Tuple[List[Optional[Dict[str, str]]], List[str], Dict]:
+    """Answer confident tickets locally and send the rest (less cache hits) to the LLM in one batch
+
+    Returns (classifications, source per ticket - "local" or "llm", stats);
+    stats are the LLM call stats plus `localHits` and `localSeconds`.
+    """
+    classifications: List[Optional[Dict[str, str]]] = [None] * len(ticket_texts)
+    sources = ["llm"] * len(ticket_texts)
+    started = time.perf_counter()
+    for i, text in enumerate(ticket_texts):
+        classification, confidence = classifier.predict(text)
+        if classification is not None and confidence >= threshold:
+            classifications[i], sources[i] = classification, "local"
+    stats: Dict = {"localHits": sources.count("local"), "localSeconds": time.perf_counter() - started}
+
+    uncertain = [i for i, source in enumerate(sources) if source == "llm"]
+    if uncertain:
+        answers, llm_stats = classify_batch(
+            client, deployment or default_deployment(), [ticket_texts[i] for i in uncertain], limits,
+            max_retries=max_retries, timeout=timeout, cache=cache
+        )
+        for i, classification in zip(uncertain, answers):
+            classifications[i] = classification
+        merge_stats(stats, llm_stats)
+    return classifications, sources, stats
+
+
+def cross_validate(tickets: List[Dict], folds: int, thresholds: List[float]) -> List[Tuple[float, int, int]]:
+    """(threshold, local hits, correct hits) with each ticket predicted by a model that never saw it"""
+    rows = [t for t in tickets if t.get("category") and t.get("priority")]
+    folds = max(2, min(folds, len(rows)))
+    predictions = []
+    for fold in range(folds):
+        held_out = rows[fold::folds]
+        model = LocalClassifier.train(t for i, t in enumerate(rows) if i % folds != fold)
+        for ticket in held_out:
+            classification, confidence = model.predict(ticket["ticket_text"])
+            correct = classification == {"category": ticket["category"], "priority": ticket["priority"]}
+            predictions.append((confidence if classification else -1.0, correct))
+    return [
+        (threshold,
+         sum(1 for confidence, _ in predictions if confidence >= threshold),
+         sum(1 for confidence, correct in predictions if confidence >= threshold and correct))
+        for threshold in thresholds
+    ]
+
+
+def accuracy_lower_bound(correct: int, hits: int, z: float = 1.96) -> float:
+    """Lower end of the Wilson score interval (95% by default) of correct / hits"""
+    if not hits:
+        return 0.0
+    p = correct / hits
+    centre = p + z * z / (2 * hits)
+    spread = z * math.sqrt(p * (1 - p) / hits + z * z / (4 * hits * hits))
+    return (centre - spread) / (1 + z * z / hits)
+
+
+def calibrate_threshold(
+    tickets: List[Dict],
+    target_accuracy: float,
+    folds: int = 10,
+    thresholds: Optional[List[float]] = None
+) -> float:
+    """Lowest threshold whose cross-validated local accuracy is at least `target_accuracy`
+
+    The accuracy must hold at the lower end of its 95% confidence interval, so a threshold that answers
+    two tickets correctly by luck doesn't qualify. Returns DISABLED_THRESHOLD when none does.
+    """
+    for threshold, hits, correct in cross_validate(tickets, folds, thresholds or CALIBRATION_THRESHOLDS):
+        if accuracy_lower_bound(correct, hits) >= target_accuracy:
+            return threshold
+    return DISABLED_THRESHOLD
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cross-validate the local triage classifier per confidence threshold")
+    parser.add_argument("--train", nargs="+", default=DEFAULT_TRAINING_FILES, help="Labelled JSONL files")
+    parser.add_argument("--folds", type=int, default=10, help="Cross-validation folds")
+    parser.add_argument(
+        "--target-accuracy", type=float, default=0.9,
+        help="Local accuracy the recommended threshold must reach (the LLM's, from evaluate.py)"
+    )
+    args = parser.parse_args()
+
+    tickets = [t for path in args.train if os.path.exists(path) for t in read_labelled_tickets(path)]
+    classifier = LocalClassifier.train(tickets)
+    started = time.perf_counter()
+    for ticket in tickets:
+        classifier.predict(ticket["ticket_text"])
+    per_ticket_us = (time.perf_counter() - started) * 1e6 / len(tickets)
+
+    print(f"\n{classifier.examples} labelled tickets, {args.folds}-fold cross-validation, "
+          f"{per_ticket_us:,.0f} µs per prediction\n")
+    print("| Threshold | Local hit rate | Local accuracy |")
+    print("|----------:|---------------:|---------------:|")
+    for threshold, hits, correct in cross_validate(tickets, args.folds, [0.0, 0.2, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]):
+        print(f"| {threshold:.1f} | {hits / classifier.examples:.1%} | "
+              f"{(correct / hits if hits else 0.0):.1%} |")
+    threshold = calibrate_threshold(tickets, args.target_accuracy, args.folds)
+    if threshold == DISABLED_THRESHOLD:
+        print(f"\nNo threshold reaches {args.target_accuracy:.0%} local accuracy with 95% confidence on this data: "
+              "leave TRIAGE_LOCAL_THRESHOLD unset (fast path off), or train on more labelled tickets.")
+    else:
+        print(f"\nTRIAGE_LOCAL_THRESHOLD={threshold:g} reaches {args.target_accuracy:.0%} local accuracy "
+              "(lower end of the 95% interval).")
@@ -0,0 +1,371 @@
+"""Ticket triage with Azure OpenAI, outside Prompt Flow
+
+Renders the same prompts as `flow.dag.yaml` (`prompts/system.jinja2` and
+`prompts/classify.jinja2`), validates the JSON answer, and calls the model
+under requests-per-minute / tokens-per-minute budgets. Which errors are
+retried and how long to back off come from the RAG demo's `resilience.py`,
+so both demos handle 429s, timeouts and 5xx the same way; a 429 holds back
+every worker for the `Retry-After` the service asks for.
+
+`classify_batch` packs several tickets into one call
+(`prompts/classify_batch.jinja2`) so the system prompt is sent once per
+batch instead of once per ticket; tickets whose entry in the answer is
+missing or invalid are re-classified one at a time. Given a `TriageCache`,
+tickets seen before (exactly or nearly) are answered from it.
+"""
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from azure.identity import DefaultAzureCredential, get_bearer_token_provider
+from openai import AzureOpenAI
+
+from triage_cache import TriageCache
+
+# Helpers shared with the RAG function live next to its function_app.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "02-rag-search", "rag-function"))
+from resilience import ResiliencePolicy, is_retryable, is_throttled, retry_after_seconds  # noqa: E402
+
+DEMO_DIR = os.path.dirname(os.path.abspath(__file__))
+PROMPTS_DIR = os.path.join(DEMO_DIR, "prompts")
+
+CATEGORIES = ["Billing", "Technical", "Account", "Access"]
+PRIORITIES = ["High", "Medium", "Low"]
+MAX_COMPLETION_TOKENS = 200
+BATCH_COMPLETION_TOKENS_PER_TICKET = 40  # {"id": "12", "category": "Technical", "priority": "Medium"}
+
+
+def load_prompt(name: str) -> str:
+    with open(os.path.join(PROMPTS_DIR, name), "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def strip_role_header(prompt: str) -> str:
+    """Drop the Prompt Flow `system:` / `user:` role line from a template"""
+    lines = prompt.strip().splitlines()
+    if lines and lines[0].strip().rstrip(":") in ("system", "user"):
+        lines = lines[1:]
+    return "\n".join(lines).strip()
+
+
+SYSTEM_PROMPT = strip_role_header(load_prompt("system.jinja2"))
+CLASSIFY_TEMPLATE = strip_role_header(load_prompt("classify.jinja2").split("\nuser:", 1)[-1])
+BATCH_TEMPLATE = strip_role_header(load_prompt("classify_batch.jinja2"))
+# Changes whenever a prompt file changes, so cached answers from an older prompt are never reused
+PROMPT_VERSION = hashlib.sha256(
+    "\x00".join([SYSTEM_PROMPT, CLASSIFY_TEMPLATE, BATCH_TEMPLATE]).encode("utf-8")
+).hexdigest()[:16]
+
+
+def create_client(max_retries: int = 0) -> AzureOpenAI:
+    """API key if set, otherwise Azure CLI / Managed Identity; retries are left to `classify`"""
+    common = {
+        "api_version": os.getenv("AZURE_OPENAI_API_VERSION", "2024-08-01-preview"),
+        "azure_endpoint": os.getenv("AZURE_OPENAI_ENDPOINT"),
+        "max_retries": max_retries
+    }
+    if os.getenv("AZURE_OPENAI_API_KEY"):
+        return AzureOpenAI(api_key=os.getenv("AZURE_OPENAI_API_KEY"), **common)
+    token_provider = get_bearer_token_provider(DefaultAzureCredential(), "https://cognitiveservices.azure.com/.default")
+    return AzureOpenAI(azure_ad_token_provider=token_provider, **common)
+
+
+def default_deployment() -> str:
+    return os.getenv("AZURE_OPENAI_DEPLOYMENT") or os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT", "gpt-5-1-chat")
+
+
+def cache_namespace(deployment: str) -> str:
+    return f"{PROMPT_VERSION}:{deployment}"
+
+
+def build_messages(ticket_text: str) -> list:
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": CLASSIFY_TEMPLATE.replace("{{ ticket_text }}", ticket_text)}
+    ]
+
+
+def build_batch_messages(ticket_texts: List[str]) -> list:
+    """One request for several tickets; ids are the 1-based positions in `ticket_texts`"""
+    tickets = [{"id": str(i), "ticket": text} for i, text in enumerate(ticket_texts, 1)]
+    tickets_json = json.dumps(tickets, ensure_ascii=False)
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": BATCH_TEMPLATE.replace("{{ tickets_json }}", tickets_json)}
+    ]
+
+
+def batch_completion_tokens(count: int) -> int:
+    return MAX_COMPLETION_TOKENS + BATCH_COMPLETION_TOKENS_PER_TICKET * count
+
+
+def estimate_tokens(messages: list, max_completion_tokens: int = MAX_COMPLETION_TOKENS) -> int:
+    """Rough prompt size (~4 characters per token) plus the completion budget, for rate limiting"""
+    return sum(len(m["content"]) for m in messages) // 4 + max_completion_tokens
+
+
+def validate_classification(data) -> Optional[Dict[str, str]]:
+    """Return {"category", "priority"} if `data` is an object with allowed values, else None"""
+    if not isinstance(data, dict):
+        return None
+    category = {c.lower(): c for c in CATEGORIES}.get(str(data.get("category", "")).strip().lower())
+    priority = {p.lower(): p for p in PRIORITIES}.get(str(data.get("priority", "")).strip().lower())
+    if not category or not priority:
+        return None
+    return {"category": category, "priority": priority}
+
+
+def parse_classification(text: str) -> Optional[Dict[str, str]]:
+    """Return {"category", "priority"} if the answer is valid JSON with allowed values, else None"""
+    try:
+        return validate_classification(json.loads(text))
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_batch_classifications(text: str, count: int) -> List[Optional[Dict[str, str]]]:
+    """Validate a batch answer item by item; position i is None if ticket i+1 is missing or invalid"""
+    parsed: List[Optional[Dict[str, str]]] = [None] * count
+    try:
+        data = json.loads(text)
+    except (TypeError, ValueError):
+        return parsed
+    items = data.get("results") if isinstance(data, dict) else data
+    if not isinstance(items, list):
+        return parsed
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        try:
+            position = int(str(item.get("id")).strip()) - 1
+        except ValueError:
+            continue
+        if 0 <= position < count and parsed[position] is None:
+            parsed[position] = validate_classification(item)
+    return parsed
+
+
+def read_labelled_tickets(path: str) -> Iterator[Dict]:
+    """Yield {"line", "ticket_text", "category", "priority"} one line at a time
+
+    Accepts `data/eval.jsonl` rows (`expected_category` / `expected_priority`)
+    and `sample-data/tickets.jsonl` rows (`{"inputs": ..., "outputs": ...}`).
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            if "inputs" in row:
+                inputs, expected = row["inputs"], row.get("outputs", {})
+                category, priority = expected.get("category"), expected.get("priority")
+            else:
+                inputs = row
+                category, priority = row.get("expected_category"), row.get("expected_priority")
+            yield {
+                "line": number,
+                "ticket_text": inputs["ticket_text"],
+                "category": category,
+                "priority": priority
+            }
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled continuously at `per_minute`; a budget of 0 means unlimited"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.available = per_minute
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount: float = 1.0) -> float:
+        """Block until `amount` is available and take it; returns the seconds waited"""
+        if not self.capacity:
+            return 0.0
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.available >= amount:
+                    self.available -= amount
+                    return waited
+                delay = (amount - self.available) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def adjust(self, amount: float):
+        """Correct an estimate once the real usage is known (positive takes more, negative gives back)"""
+        if not self.capacity:
+            return
+        with self._lock:
+            self._refill(time.monotonic())
+            self.available = min(self.capacity, self.available - amount)
+
+    def pause(self, seconds: float) -> bool:
+        """Empty the bucket so every caller waits `seconds` (the service said it is over its limit)"""
+        if not self.capacity:
+            return False
+        with self._lock:
+            self._refill(time.monotonic())
+            self.available = min(self.available, -seconds * self.rate)
+        return True
+
+
+class RateLimits:
+    """Requests-per-minute and tokens-per-minute budgets shared by all worker threads"""
+
+    def __init__(self, requests_per_minute: float = 0, tokens_per_minute: float = 0):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+
+    def acquire(self, tokens: int) -> float:
+        return self.requests.acquire(1) + self.tokens.acquire(tokens)
+
+    def pause(self, seconds: float) -> bool:
+        """Hold back every worker; False when no budget is configured (callers must sleep themselves)"""
+        paused_requests = self.requests.pause(seconds)
+        paused_tokens = self.tokens.pause(seconds)
+        return paused_requests or paused_tokens
+
+
+def complete(
+    client: AzureOpenAI,
+    deployment: str,
+    messages: list,
+    limits: Optional[RateLimits] = None,
+    max_completion_tokens: int = MAX_COMPLETION_TOKENS,
+    max_retries: int = 5,
+    timeout: float = 30.0
+) -> Tuple[str, Dict]:
+    """One JSON-mode chat call under the rate limits; returns (answer text, call stats)
+
+    Stats: requests (attempts), tokens, retries, throttled (429 count) and
+    waited (seconds spent in the rate limiter or backing off). Errors
+    `resilience.is_retryable` rejects are raised; retryable ones are raised
+    too once `max_retries` is exhausted.
+    """
+    estimate = estimate_tokens(messages, max_completion_tokens)
+    stats = {"requests": 0, "tokens": 0, "retries": 0, "throttled": 0, "waited": 0.0}
+    limits = limits or RateLimits()
+    policy = ResiliencePolicy(max_retries=max_retries, timeout=timeout)
+
+    for attempt in range(max_retries + 1):
+        stats["waited"] += limits.acquire(estimate)
+        stats["requests"] += 1
+        try:
+            response = client.chat.completions.create(
+                model=deployment,
+                messages=messages,
+                max_completion_tokens=max_completion_tokens,
+                response_format={"type": "json_object"},
+                timeout=timeout
+            )
+        except Exception as e:
+            if not is_retryable(e) or attempt == max_retries:
+                raise
+            stats["retries"] += 1
+            if is_throttled(e):
+                stats["throttled"] += 1
+                # Every worker backs off, not just this one; the wait happens in the next acquire()
+                retry_after = retry_after_seconds(e)
+                if retry_after is not None and limits.pause(retry_after):
+                    continue
+            delay = policy.delay(attempt, e)
+            stats["waited"] += delay
+            time.sleep(delay)
+            continue
+
+        usage = getattr(response, "usage", None)
+        stats["tokens"] = getattr(usage, "total_tokens", 0) if usage else estimate
+        limits.tokens.adjust(stats["tokens"] - estimate)
+        return response.choices[0].message.content, stats
+
+
+def merge_stats(total: Dict, stats: Dict):
+    for key, value in stats.items():
+        total[key] = total.get(key, 0) + value
+
+
+def classify(
+    client: AzureOpenAI,
+    deployment: str,
+    ticket_text: str,
+    limits: Optional[RateLimits] = None,
+    max_retries: int = 5,
+    timeout: float = 30.0
+) -> Tuple[Optional[Dict[str, str]], Dict]:
+    """Classify one ticket; returns (classification or None if the answer was invalid, call stats)"""
+    answer, stats = complete(
+        client, deployment, build_messages(ticket_text), limits, max_retries=max_retries, timeout=timeout
+    )
+    return parse_classification(answer), stats
+
+
+def classify_batch(
+    client: AzureOpenAI,
+    deployment: str,
+    ticket_texts: List[str],
+    limits: Optional[RateLimits] = None,
+    max_retries: int = 5,
+    timeout: float = 30.0,
+    cache: Optional[TriageCache] = None
+) -> Tuple[List[Optional[Dict[str, str]]], Dict]:
+    """Classify several tickets in one call; returns (classifications in input order, call stats)
+
+    Items missing from the answer or failing validation are re-classified
+    with `classify`; `fallbacks` in the stats counts them. A single ticket
+    goes straight to `classify`. With a cache, cached tickets are not sent
+    (`cacheHits`) and valid answers are stored.
+    """
+    classifications: List[Optional[Dict[str, str]]] = [None] * len(ticket_texts)
+    stats: Dict = {"fallbacks": 0, "cacheHits": 0}
+    namespace = cache_namespace(deployment)
+    pending = list(range(len(ticket_texts)))
+    if cache is not None:
+        pending = []
+        for i, text in enumerate(ticket_texts):
+            cached = cache.lookup(text, namespace)
+            if cached:
+                classifications[i] = cached[0]
+                stats["cacheHits"] += 1
+            else:
+                pending.append(i)
+
+    if len(pending) == 1:
+        classifications[pending[0]], single_stats = classify(
+            client, deployment, ticket_texts[pending[0]], limits, max_retries, timeout
+        )
+        merge_stats(stats, single_stats)
+    elif pending:
+        answer, batch_stats = complete(
+            client, deployment, build_batch_messages([ticket_texts[i] for i in pending]), limits,
+            max_completion_tokens=batch_completion_tokens(len(pending)),
+            max_retries=max_retries, timeout=timeout
+        )
+        merge_stats(stats, batch_stats)
+        for i, classification in zip(pending, parse_batch_classifications(answer, len(pending))):
+            if classification is None:
+                classification, single_stats = classify(
+                    client, deployment, ticket_texts[i], limits, max_retries, timeout
+                )
+                merge_stats(stats, single_stats)
+                stats["fallbacks"] += 1
+            classifications[i] = classification
+
+    if cache is not None:
+        for i in pending:
+            if classifications[i] is not None:
+                cache.store(ticket_texts[i], namespace, classifications[i])
+    return classifications, stats
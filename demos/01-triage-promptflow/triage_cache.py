@@ -0,0 +1,206 @@
+"""Triage result cache for identical and near-identical tickets
+
+Classification runs at temperature 0, so a ticket seen before gets the same
+answer again. Two tiers:
+
+- exact: SHA-256 of the normalized ticket text (case, whitespace, dates,
+  times, digit runs of 5 or more, e-mail addresses, URLs and hex ids
+  folded, so auto-forwarded copies and monitoring alerts that differ only
+  in timestamps or long counters match). Short numbers such as status codes
+  and user counts stay in the key: "HTTP 500" and "HTTP 404" are different
+  tickets
+- near-duplicate: MinHash signatures over word 2-shingles; a ticket whose
+  estimated Jaccard similarity to a cached one reaches `min_similarity`
+  reuses its classification. Candidates are found through LSH band buckets
+  (16 bands of 4 hashes), so lookups don't scan the cache. SimHash was the
+  other option, but on ticket-length texts a handful of extra words flips
+  too many bits for a small Hamming threshold to catch them.
+
+Every key is scoped to a namespace (prompt version + deployment, see
+`triage.cache_namespace`), so editing the prompt files or switching the
+deployment never returns an answer produced by the old setup. Entries expire
+after a TTL and the cache is LRU-bounded.
+"""
+import hashlib
+import os
+import random
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set, Tuple
+
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16  # 4 hashes per band: pairs above ~0.5 Jaccard almost always share a bucket
+MIN_SHINGLES = 5  # shorter tickets only use the exact tier; a few words say too little about similarity
+_PRIME = (1 << 61) - 1
+_rng = random.Random(20251114)  # fixed seed: signatures must be comparable across processes
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(MINHASH_PERMUTATIONS)]
+
+_VOLATILE = [
+    (re.compile(r"https?://\S+"), " <url> "),
+    (re.compile(r"[\w.+-]+@[\w-]+(\.[\w-]+)+"), " <email> "),
+    (re.compile(r"\b\d{4}-\d{2}-\d{2}(t\d{2}:\d{2}(:\d{2}(\.\d+)?)?(z|[+-]\d{2}:?\d{2})?)?\b"), " <date> "),
+    (re.compile(r"\b\d{1,2}/\d{1,2}/\d{2,4}\b"), " <date> "),
+    (re.compile(r"\b\d{1,2}:\d{2}(:\d{2}(\.\d+)?)?\b"), " <time> "),
+    (re.compile(r"\b(?=[0-9a-f-]*\d)[0-9a-f]{8,}(-[0-9a-f]{4,})*\b"), " <id> "),
+    (re.compile(r"\d{5,}"), " <num> "),
+]
+_WORD = re.compile(r"\w+|<\w+>")
+
+
+def normalize_ticket(text: str) -> str:
+    """Fold case, unicode, whitespace and volatile tokens (dates, times, long numbers, addresses, ids)"""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    for pattern, replacement in _VOLATILE:
+        text = pattern.sub(replacement, text)
+    return " ".join(text.split())
+
+
+def minhash(normalized: str) -> Optional[Tuple[int, ...]]:
+    """MinHash signature of word 2-shingles, or None if the ticket is too short for the near tier"""
+    words = _WORD.findall(normalized)
+    shingles = {" ".join(words[i:i + 2]) for i in range(max(len(words) - 1, 0))}
+    if len(shingles) < MIN_SHINGLES:
+        return None
+    hashes = [
+        int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+        for shingle in shingles
+    ]
+    return tuple(min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMUTATIONS)
+
+
+def similarity(a: Tuple[int, ...], b: Tuple[int, ...]) -> float:
+    """Estimated Jaccard similarity: share of signature positions that agree"""
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+
+@dataclass
+class _Entry:
+    namespace: str
+    classification: Dict[str, str]
+    signature: Optional[Tuple[int, ...]]
+    expires_at: float
+
+
+class TriageCache:
+    """In-process, thread-safe two-tier cache of ticket classifications"""
+
+    def __init__(self, ttl_seconds: float = 86400, max_entries: int = 10000, min_similarity: float = 0.8):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.min_similarity = min_similarity  # > 1 turns the near-duplicate tier off
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()  # exact key -> entry, least recently used first
+        self._bands: Dict[Tuple, Set[str]] = {}  # (namespace, band, hashes) -> exact keys
+
+    @classmethod
+    def from_env(cls) -> Optional["TriageCache"]:
+        """Build the cache from TRIAGE_CACHE_* settings (TRIAGE_CACHE_MAX_ENTRIES=0 disables it)"""
+        max_entries = int(os.getenv("TRIAGE_CACHE_MAX_ENTRIES", "10000"))
+        if max_entries <= 0:
+            return None
+        return cls(
+            ttl_seconds=float(os.getenv("TRIAGE_CACHE_TTL_SECONDS", "86400")),
+            max_entries=max_entries,
+            min_similarity=float(os.getenv("TRIAGE_CACHE_MIN_SIMILARITY", "0.8"))
+        )
+
+    @staticmethod
+    def _key(namespace: str, normalized: str) -> str:
+        return hashlib.sha256(f"{namespace}\x00{normalized}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _band_keys(namespace: str, signature: Tuple[int, ...]) -> List[Tuple]:
+        rows = len(signature) // LSH_BANDS
+        return [(namespace, band, signature[band * rows:(band + 1) * rows]) for band in range(LSH_BANDS)]
+
+    def _signature(self, normalized: str) -> Optional[Tuple[int, ...]]:
+        return minhash(normalized) if self.min_similarity <= 1 else None
+
+    def lookup(self, ticket_text: str, namespace: str) -> Optional[Tuple[Dict[str, str], str]]:
+        """Return (classification, "exact" or "near") for a cached ticket, else None"""
+        normalized = normalize_ticket(ticket_text)
+        key = self._key(namespace, normalized)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry.expires_at > now:
+                self._entries.move_to_end(key)
+                self.exact_hits += 1
+                return dict(entry.classification), "exact"
+            if entry:
+                self._remove(key)
+
+            signature = self._signature(normalized)
+            if signature is not None:
+                best_key, best_similarity = None, self.min_similarity
+                candidates = set().union(*(self._bands.get(k, ()) for k in self._band_keys(namespace, signature)))
+                for candidate in candidates:
+                    entry = self._entries[candidate]
+                    score = similarity(entry.signature, signature)
+                    if score >= best_similarity and entry.expires_at > now:
+                        best_key, best_similarity = candidate, score
+                if best_key is not None:
+                    self._entries.move_to_end(best_key)
+                    self.near_hits += 1
+                    return dict(self._entries[best_key].classification), "near"
+
+            self.misses += 1
+            return None
+
+    def store(self, ticket_text: str, namespace: str, classification: Dict[str, str]):
+        normalized = normalize_ticket(ticket_text)
+        key = self._key(namespace, normalized)
+        signature = self._signature(normalized)
+        now = time.monotonic()
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._purge_expired(now)
+            while len(self._entries) >= self.max_entries:
+                self._remove(next(iter(self._entries)))
+            self._entries[key] = _Entry(namespace, dict(classification), signature, now + self.ttl_seconds)
+            if signature is not None:
+                for band_key in self._band_keys(namespace, signature):
+                    self._bands.setdefault(band_key, set()).add(key)
+
+    def clear(self) -> int:
+        with self._lock:
+            count = len(self._entries)
+            self._entries.clear()
+            self._bands.clear()
+            return count
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "exactHits": self.exact_hits,
+                "nearHits": self.near_hits,
+                "misses": self.misses
+            }
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key)
+        if entry.signature is None:
+            return
+        for band_key in self._band_keys(entry.namespace, entry.signature):
+            bucket = self._bands.get(band_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._bands[band_key]
+
+    def _purge_expired(self, now: float):
+        # Entries are in access order, not expiry order; stale ones behind a live entry are dropped on lookup
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry.expires_at > now:
+                break
+            self._remove(key)
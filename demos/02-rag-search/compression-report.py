@@ -0,0 +1,195 @@
+"""Recall vs. size report for reduced embedding dimensions and vector quantization
+
+Reads full-precision chunk vectors from a local index (`ingest-kb.py --backend
+local`, run WITHOUT AZURE_OPENAI_EMBEDDING_DIMENSIONS so vectors keep the
+model's native size) and measures, for each dimension x compression setting,
+how many of the full-precision top-k chunks (and top articles) are still
+retrieved. Truncating stored vectors is equivalent to requesting shorter
+vectors from text-embedding-3 models.
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+from dotenv import load_dotenv
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(SCRIPT_DIR, "rag-function"))
+from search_backends import (  # noqa: E402
+    LocalVectorBackend,
+    binary_scores,
+    int8_scores,
+    quantize_binary,
+    quantize_int8,
+    rescore,
+    top_k,
+    truncate,
+)
+
+load_dotenv()
+
+DEFAULT_QUESTIONS = [
+    "How do I reset my password?",
+    "I forgot my password and the reset email never arrived",
+    "My account is locked after too many login attempts",
+    "How do I set up multi-factor authentication?",
+    "VPN keeps disconnecting, what should I do?",
+    "VPN connects but I cannot reach internal sites",
+    "Where can I see my billing history?",
+    "I was charged twice for the same invoice",
+    "How do I update my payment method?",
+    "Outlook calendar is not syncing on my phone",
+    "How do I share my calendar with a colleague?",
+    "Software update fails with an installation error",
+]
+
+parser = argparse.ArgumentParser(
+    description="Report retrieval recall vs. vector size for dimension/compression settings"
+)
+parser.add_argument(
+    "--local-index",
+    default=os.getenv("RAG_LOCAL_INDEX_PATH", os.path.join(SCRIPT_DIR, "rag-function", "local-index")),
+    help="Local index with full-precision vectors"
+)
+parser.add_argument("--questions", help="Text file with one question per line (default: built-in support questions)")
+parser.add_argument(
+    "--offline",
+    action="store_true",
+    help="Use the chunk vectors themselves as queries instead of embedding questions (no API calls)"
+)
+parser.add_argument("--dimensions", default="3072,1536,1024,768,512,256", help="Comma-separated dimensions to test")
+parser.add_argument("--top-k", type=int, default=10, help="Chunks compared against the full-precision top-k")
+parser.add_argument(
+    "--oversampling", type=float, default=4.0, help="Candidates per result rescored after a quantized search"
+)
+args = parser.parse_args()
+
+backend = LocalVectorBackend(args.local_index, ann="exact")
+documents = backend.documents
+full = np.asarray(backend.vectors, dtype=np.float32)
+native_dimensions = full.shape[1]
+
+if args.offline:
+    queries = full
+    labels = [doc["id"] for doc in documents]
+else:
+    from azure.identity import DefaultAzureCredential, get_bearer_token_provider
+    from openai import AzureOpenAI
+    from embedding_cache import EmbeddingCache, embed_texts
+    from resilience import ResilientOpenAI
+
+    if args.questions:
+        with open(args.questions, "r", encoding="utf-8") as f:
+            labels = [line.strip() for line in f if line.strip()]
+    else:
+        labels = DEFAULT_QUESTIONS
+    if os.getenv("AZURE_OPENAI_API_KEY"):
+        openai_client = AzureOpenAI(
+            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+            api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-08-01-preview"),
+            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+            max_retries=0
+        )
+    else:
+        token_provider = get_bearer_token_provider(
+            DefaultAzureCredential(), "https://cognitiveservices.azure.com/.default"
+        )
+        openai_client = AzureOpenAI(
+            azure_ad_token_provider=token_provider,
+            api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-08-01-preview"),
+            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+            max_retries=0
+        )
+    openai_client = ResilientOpenAI(openai_client)
+    vectors, _, _ = embed_texts(
+        openai_client,
+        os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT", "text-embedding-3-large"),
+        native_dimensions,
+        labels,
+        cache=EmbeddingCache.from_env(default_path=os.path.join(SCRIPT_DIR, ".embedding-cache.sqlite3"))
+    )
+    queries = np.asarray(vectors, dtype=np.float32)
+    if queries.shape[1] != native_dimensions:
+        sys.exit(f"Question vectors have {queries.shape[1]} dimensions, the index {native_dimensions}")
+
+queries = truncate(queries, native_dimensions)
+k = min(args.top_k, len(documents) - (1 if args.offline else 0))
+candidates_per_query = max(k, int(k * args.oversampling))
+
+
+def candidates(scores, row):
+    """Rows handed to full-precision rescoring; rescoring would put an offline query's own chunk back first"""
+    rows = top_k(scores, candidates_per_query)
+    return rows[rows != row] if args.offline else rows
+
+
+def exclude_self(scores, row):
+    """Offline queries are chunk vectors and must not find themselves"""
+    if args.offline:
+        scores = scores.astype(np.float32)
+        scores[row] = -np.inf
+    return scores
+
+
+def ranking(scores, row):
+    return top_k(exclude_self(scores, row), k)
+
+
+def parents(rows, count=3):
+    """First `count` distinct articles in ranked order (what reaches the prompt)"""
+    seen = []
+    for row in rows:
+        parent = documents[row].get("parentId") or documents[row]["id"]
+        if parent not in seen:
+            seen.append(parent)
+        if len(seen) == count:
+            break
+    return set(seen)
+
+
+truth = [ranking(full @ query, row) for row, query in enumerate(queries)]
+
+print(f"\nLocal index: {args.local_index} ({len(documents)} chunks, {native_dimensions} dimensions)")
+print(f"Queries: {len(labels)} ({'chunk vectors' if args.offline else 'embedded questions'}), "
+      f"top-{k}, rescoring oversampling {args.oversampling:g}\n")
+print("| Dimensions | Vectors | Bytes/vector | Index size (KiB) | Recall@k | Recall@k (no rescoring) "
+      "| Top-3 articles match |")
+print("|-----------:|---------|-------------:|-----------------:|---------:|------------------------:"
+      "|---------------------:|")
+
+for dimensions in sorted({int(d) for d in args.dimensions.split(",") if d.strip()}, reverse=True):
+    if dimensions > native_dimensions:
+        continue
+    docs = truncate(full, dimensions)
+    short_queries = truncate(queries, dimensions)
+    codes, scales = quantize_int8(docs)
+    bits = quantize_binary(docs)
+
+    settings = [
+        ("float32", 4 * dimensions, lambda q: docs @ q),
+        ("int8", dimensions + 4, lambda q: int8_scores(codes, scales, q)),
+        ("binary", (dimensions + 7) // 8, lambda q: binary_scores(bits, q)),
+    ]
+    for name, size, score in settings:
+        recall = raw_recall = article_match = 0.0
+        for row, query in enumerate(short_queries):
+            expected = set(truth[row].tolist())
+            approximate = exclude_self(score(query), row)
+            raw = top_k(approximate, k)
+            if name == "float32":
+                rescored = raw
+            else:
+                rescored = rescore(docs, candidates(approximate, row), query, k)
+            recall += len(expected & set(rescored.tolist())) / k
+            raw_recall += len(expected & set(raw.tolist())) / k
+            article_match += parents(truth[row]) == parents(rescored)
+
+        count = len(short_queries)
+        print(f"| {dimensions} | {name} | {size:,} | {size * len(documents) / 1024:,.1f} | "
+              f"{recall / count:.3f} | {raw_recall / count:.3f} | {article_match / count:.0%} |")
+
+print("\nRecall@k: share of the full-precision top-k chunks retrieved after rescoring with full-precision vectors "
+      "at that dimension (Azure AI Search: rescore_storage_method=preserveOriginals).")
+print("Pick the smallest setting whose recall and article match stay where answers don't change, then set "
+      "AZURE_OPENAI_EMBEDDING_DIMENSIONS / INGEST_VECTOR_COMPRESSION and re-create the index.")
@@ -1,5 +1,14 @@
 """Ingest knowledge base documents into Azure AI Search"""
+import argparse
+import hashlib
+import json
 import os
+import re
+import sys
+import time
+import urllib.request
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
 from dotenv import load_dotenv
 from azure.search.documents import SearchClient
 from azure.search.documents.indexes import SearchIndexClient
@@ -15,19 +24,73 @@ from azure.search.documents.indexes.models import (
     SemanticPrioritizedFields,
     SemanticField,
     SemanticSearch,
+    ScalarQuantizationCompression,
+    ScalarQuantizationParameters,
+    BinaryQuantizationCompression,
+    RescoringOptions,
 )
 from azure.core.credentials import AzureKeyCredential
 from azure.identity import DefaultAzureCredential, get_bearer_token_provider
 from openai import AzureOpenAI
-import glob
+
+# Helpers shared with the RAG function live next to function_app.py
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(SCRIPT_DIR, "rag-function"))
+from chunking import chunk_markdown  # noqa: E402
+from dedup import MinHasher, cluster_chunks, decode, encode, sketch  # noqa: E402
+from embedding_cache import EmbeddingCache, embed_texts  # noqa: E402
+from resilience import ResilientOpenAI  # noqa: E402
+from search_backends import LocalVectorStore, metadata_index_name  # noqa: E402
+from tracing import RequestTrace  # noqa: E402
 
 # Load environment
 load_dotenv()
 
+parser = argparse.ArgumentParser(description="Ingest knowledge base documents into Azure AI Search")
+parser.add_argument(
+    "--incremental",
+    action="store_true",
+    help="Only embed new or changed files and delete index entries whose source file is gone"
+)
+parser.add_argument(
+    "--manifest",
+    default=os.getenv("INGEST_MANIFEST_PATH"),
+    help="Path of the content hash manifest used by --incremental "
+         "(default: .ingest-manifest.json, or manifest.json inside the local index)"
+)
+parser.add_argument(
+    "--backend",
+    choices=["azure", "local"],
+    default=os.getenv("RAG_SEARCH_BACKEND", "azure"),
+    help="Write to Azure AI Search, or to a local vector index for offline runs and benchmarks"
+)
+parser.add_argument(
+    "--local-index",
+    default=os.getenv("RAG_LOCAL_INDEX_PATH", os.path.join(SCRIPT_DIR, "rag-function", "local-index")),
+    help="Directory of the local vector index written by --backend local"
+)
+args = parser.parse_args()
+if args.manifest is None:
+    # Each backend tracks what it holds, so switching backends never skips documents
+    if args.backend == "local":
+        args.manifest = os.path.join(args.local_index, "manifest.json")
+    else:
+        args.manifest = os.path.join(SCRIPT_DIR, ".ingest-manifest.json")
+
 # Initialize clients
 search_endpoint = os.getenv("AZURE_AI_SEARCH_ENDPOINT")
 search_key = os.getenv("AZURE_AI_SEARCH_API_KEY")  # Still needed for index creation (admin operation)
 index_name = os.getenv("AZURE_AI_SEARCH_INDEX", "kb-support")
+embedding_deployment = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT", "text-embedding-3-large")
+embedding_dimensions = int(os.getenv("AZURE_OPENAI_EMBEDDING_DIMENSIONS", "3072"))
+# text-embedding-3 models can return shortened (Matryoshka) vectors; only ask when a size is configured
+request_dimensions = bool(os.getenv("AZURE_OPENAI_EMBEDDING_DIMENSIONS"))
+
+# Vector compression: int8 (scalar) or binary quantization, rescored with the full-precision vectors
+VECTOR_COMPRESSION = os.getenv("INGEST_VECTOR_COMPRESSION", "none").lower()
+VECTOR_OVERSAMPLING = float(os.getenv("INGEST_VECTOR_OVERSAMPLING", "4"))
+if VECTOR_COMPRESSION not in ("none", "int8", "binary"):
+    sys.exit(f"INGEST_VECTOR_COMPRESSION must be none, int8 or binary (got '{VECTOR_COMPRESSION}')")
 
 # Use API key if available (for deployment script), otherwise use DefaultAzureCredential (for local dev)
 openai_api_key = os.getenv("AZURE_OPENAI_API_KEY")
@@ -36,7 +99,8 @@ if openai_api_key:
     openai_client = AzureOpenAI(
         api_key=openai_api_key,
         api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-08-01-preview"),
-        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
+        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+        max_retries=0
     )
 else:
     # Use DefaultAzureCredential for OpenAI (local development via Azure CLI)
@@ -45,113 +109,668 @@ else:
     openai_client = AzureOpenAI(
         azure_ad_token_provider=token_provider,
         api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-08-01-preview"),
-        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
+        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+        max_retries=0
     )
+# Retries with Retry-After, per-deployment concurrency limits and a circuit breaker (OPENAI_* settings)
+openai_client = ResilientOpenAI(openai_client)
 
 print(f"\n{'='*70}")
 print(f"Demo 02 - Knowledge Base Ingestion")
 print(f"{'='*70}\n")
 
-# Create index
-print("Creating search index...")
-index_client = SearchIndexClient(search_endpoint, AzureKeyCredential(search_key))
-
-fields = [
-    SimpleField(name="id", type="Edm.String", key=True),
-    SearchableField(name="title", type="Edm.String"),
-    SearchableField(name="content", type="Edm.String"),
-    SearchField(
-        name="contentVector",
-        type="Collection(Edm.Single)",
-        searchable=True,
-        vector_search_dimensions=3072,
-        vector_search_profile_name="vector-profile"
-    ),
-]
-
-vector_search = VectorSearch(
-    algorithms=[HnswAlgorithmConfiguration(name="hnsw-config")],
-    profiles=[VectorSearchProfile(name="vector-profile", algorithm_configuration_name="hnsw-config")]
-)
+if args.backend == "azure":
+    # Create index
+    print("Creating search index...")
+    index_client = SearchIndexClient(search_endpoint, AzureKeyCredential(search_key))
+
+    fields = [
+        SimpleField(name="id", type="Edm.String", key=True),
+        SimpleField(name="parentId", type="Edm.String", filterable=True),
+        SimpleField(name="chunkIndex", type="Edm.Int32", filterable=True, sortable=True),
+        # Id of the chunk representing this chunk's near-duplicate cluster (itself unless it's a duplicate)
+        SimpleField(name="clusterId", type="Edm.String", filterable=True),
+        SearchableField(name="title", type="Edm.String"),
+        SearchableField(name="sectionPath", type="Edm.String"),
+        SearchableField(name="content", type="Edm.String"),
+        # Article metadata, repeated on each of its chunks
+        SimpleField(name="filename", type="Edm.String", filterable=True, facetable=True),
+        SimpleField(name="sourceUrl", type="Edm.String", filterable=True, facetable=True),
+        # An article can belong to several support categories (first one: the best match)
+        SimpleField(name="category", type="Collection(Edm.String)", filterable=True, facetable=True),
+        SimpleField(name="lastModified", type="Edm.DateTimeOffset", filterable=True, facetable=True, sortable=True),
+        SearchField(
+            name="contentVector",
+            type="Collection(Edm.Single)",
+            searchable=True,
+            # Compressed indexes keep the originals only for rescoring, not as a retrievable copy
+            stored=VECTOR_COMPRESSION == "none",
+            vector_search_dimensions=embedding_dimensions,
+            vector_search_profile_name="vector-profile"
+        ),
+    ]
 
-semantic_config = SemanticConfiguration(
-    name="semantic-config",
-    prioritized_fields=SemanticPrioritizedFields(
-        title_field=SemanticField(field_name="title"),
-        content_fields=[SemanticField(field_name="content")]
+    compressions = []
+    rescoring = RescoringOptions(
+        enable_rescoring=True,
+        default_oversampling=VECTOR_OVERSAMPLING,
+        rescore_storage_method="preserveOriginals"
     )
-)
+    if VECTOR_COMPRESSION == "int8":
+        compressions.append(ScalarQuantizationCompression(
+            compression_name="vector-compression",
+            parameters=ScalarQuantizationParameters(quantized_data_type="int8"),
+            rescoring_options=rescoring
+        ))
+    elif VECTOR_COMPRESSION == "binary":
+        compressions.append(BinaryQuantizationCompression(
+            compression_name="vector-compression",
+            rescoring_options=rescoring
+        ))
 
-index = SearchIndex(
-    name=index_name,
-    fields=fields,
-    vector_search=vector_search,
-    semantic_search=SemanticSearch(configurations=[semantic_config])
-)
+    vector_search = VectorSearch(
+        algorithms=[HnswAlgorithmConfiguration(name="hnsw-config")],
+        profiles=[VectorSearchProfile(
+            name="vector-profile",
+            algorithm_configuration_name="hnsw-config",
+            compression_name="vector-compression" if compressions else None
+        )],
+        compressions=compressions or None
+    )
 
-try:
-    result = index_client.create_or_update_index(index)
-    print(f"✓ Index '{index_name}' created successfully")
-except Exception as e:
-    if "already exists" in str(e).lower() or "resourceexists" in str(e).lower():
-        print(f"✓ Index '{index_name}' already exists, continuing...")
-    else:
-        print(f"Warning: {str(e)[:200]}")
-        print("Attempting to continue...")
+    semantic_config = SemanticConfiguration(
+        name="semantic-config",
+        prioritized_fields=SemanticPrioritizedFields(
+            title_field=SemanticField(field_name="title"),
+            content_fields=[SemanticField(field_name="content")],
+            keywords_fields=[SemanticField(field_name="sectionPath")]
+        )
+    )
 
-# Read and embed documents
-print("\nReading knowledge base documents...")
-docs_path = "content"
-documents = []
+    index = SearchIndex(
+        name=index_name,
+        fields=fields,
+        vector_search=vector_search,
+        semantic_search=SemanticSearch(configurations=[semantic_config])
+    )
 
-import os
-for filename in os.listdir(docs_path):
-    if not filename.endswith('.md'):
-        continue
+    try:
+        result = index_client.create_or_update_index(index)
+        print(f"✓ Index '{index_name}' created successfully")
+    except Exception as e:
+        if "already exists" in str(e).lower() or "resourceexists" in str(e).lower():
+            print(f"✓ Index '{index_name}' already exists, continuing...")
+        else:
+            print(f"Warning: {str(e)[:200]}")
+            print("Attempting to continue...")
 
-    filepath = os.path.join(docs_path, filename)
-    i = len(documents) + 1
+    # Kept out of the content index so searches, browsing and document counts only ever see chunks
+    metadata_index = SearchIndex(
+        name=metadata_index_name(index_name),
+        fields=[
+            SimpleField(name="id", type="Edm.String", key=True),
+            SimpleField(name="lastModified", type="Edm.DateTimeOffset")
+        ]
+    )
+    try:
+        index_client.create_or_update_index(metadata_index)
+    except Exception as e:
+        print(f"Warning: could not create index '{metadata_index.name}': {str(e)[:200]}")
+else:
+    print(f"Writing local vector index to {args.local_index}")
 
-    with open(filepath, 'r', encoding='utf-8') as f:
-        content = f.read()
+# Pipeline tuning (multi-input embedding requests, bounded in-flight batches, streamed uploads)
+EMBED_BATCH_SIZE = int(os.getenv("INGEST_EMBED_BATCH_SIZE", "16"))
+EMBED_CONCURRENCY = int(os.getenv("INGEST_EMBED_CONCURRENCY", "4"))
+UPLOAD_BATCH_SIZE = int(os.getenv("INGEST_UPLOAD_BATCH_SIZE", "100"))
+CHUNK_TOKENS = int(os.getenv("INGEST_CHUNK_TOKENS", "512"))
+CHUNK_OVERLAP = int(os.getenv("INGEST_CHUNK_OVERLAP", "64"))
+CHUNKING = f"{CHUNK_TOKENS}/{CHUNK_OVERLAP}"
+# Bumped whenever embedding_text() changes, so the next --incremental run re-embeds every document
+EMBEDDING_TEXT_VERSION = 2
 
-    # Extract title from first line
-    lines = content.split('\n')
-    title = lines[0].replace('#', '').strip() if lines else filename
+# Near-duplicate consolidation: chunks of different articles that match on MinHash (shingle Jaccard) or on
+# embedding cosine share a cluster, and only the cluster's representative keeps its vector
+DEDUP = os.getenv("INGEST_DEDUP", "true").lower() in ("1", "true", "yes")
+DEDUP_MIN_JACCARD = float(os.getenv("INGEST_DEDUP_MIN_JACCARD", "0.5"))
+DEDUP_MIN_COSINE = float(os.getenv("INGEST_DEDUP_MIN_COSINE", "0.92"))
+DEDUP_SKETCH_DIMENSIONS = int(os.getenv("INGEST_DEDUP_SKETCH_DIMENSIONS", "256"))
+minhasher = MinHasher()
 
-    print(f"  [{i}] {filename}: {title}")
+# Article metadata: where the source file is published, and its support categories in the triage taxonomy
+# (demos/01-triage-promptflow), picked by keyword counts (title words count three times)
+SOURCE_URL_BASE = os.getenv(
+    "INGEST_SOURCE_URL_BASE",
+    "https://github.com/LuiseFreese/espc25-smart-support-agent/blob/main/demos/02-rag-search/content"
+)
+CATEGORY_KEYWORDS = {
+    "Billing": ["billing", "invoice", "payment", "charge", "charged", "refund", "subscription"],
+    "Technical": ["vpn", "software", "install", "installation", "email", "calendar", "outlook", "network",
+                  "connection", "update", "error", "hardware"],
+    "Account": ["password", "account", "profile", "lockout", "locked", "mfa"],
+    "Access": ["access", "permission", "permissions", "role", "roles", "grant", "granted", "approval", "login",
+               "unlock", "authentication"],
+}
+DEFAULT_CATEGORY = "Technical"
+# A category is assigned when its keyword count reaches this share of the best-matching category's count
+CATEGORY_MIN_SHARE = float(os.getenv("INGEST_CATEGORY_MIN_SHARE", "0.25"))
 
-    # Generate embedding
-    try:
-        embedding_response = openai_client.embeddings.create(
-            model=os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT"),
-            input=content,
-            timeout=30
-        )
-        embedding = embedding_response.data[0].embedding
 
-        documents.append({
+def classify_categories(title, content):
+    """Support categories the article mentions enough, best match first (no matches: [DEFAULT_CATEGORY])
+
+    Triage labels a ticket with one category, but an article often answers tickets of several: a login
+    guide serves both Account (password reset) and Access (can't get in) tickets.
+    """
+    words = re.findall(r"\w+", content.lower())
+    title_words = re.findall(r"\w+", title.lower())
+    counts = {
+        category: sum(words.count(keyword) + 2 * title_words.count(keyword) for keyword in keywords)
+        for category, keywords in CATEGORY_KEYWORDS.items()
+    }
+    best = max(counts.values())
+    if best == 0:
+        return [DEFAULT_CATEGORY]
+    ranked = sorted(CATEGORY_KEYWORDS, key=lambda category: -counts[category])  # stable: ties keep taxonomy order
+    return [category for category in ranked if counts[category] and counts[category] >= CATEGORY_MIN_SHARE * best]
+
+
+def read_documents(docs_path):
+    """Yield one parent document per markdown file (lazily, so the corpus is never held in memory)"""
+    for filename in sorted(os.listdir(docs_path)):
+        if not filename.endswith('.md'):
+            continue
+
+        path = os.path.join(docs_path, filename)
+        with trace.span("read"), open(path, 'r', encoding='utf-8') as f:
+            content = f.read()
+            modified = datetime.fromtimestamp(os.fstat(f.fileno()).st_mtime, tz=timezone.utc)
+
+        # Extract title from first line
+        lines = content.split('\n')
+        title = lines[0].replace('#', '').strip() if lines else filename
+
+        yield {
             "id": filename.replace('.md', '').replace('-', '_'),
             "title": title,
             "content": content,
-            "contentVector": embedding
-        })
-        print(f"      ✓ Embedded successfully")
+            "filename": filename,
+            "sourceUrl": f"{SOURCE_URL_BASE.rstrip('/')}/{filename}",
+            "category": classify_categories(title, content),
+            "lastModified": modified.strftime("%Y-%m-%dT%H:%M:%SZ")
+        }
+
+
+def content_hash(doc):
+    """Hash everything that ends up in the index for a document (a new modification time alone doesn't count)"""
+    text = "\n".join([doc["title"], doc["filename"], doc["sourceUrl"], ",".join(doc["category"]), doc["content"]])
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def load_manifest(path):
+    """Load the manifest of ingested documents
+
+    {parent id: {hash, model, dimensions, chunking, embeddingText, chunks}}
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f).get("documents", {})
+    except (OSError, ValueError) as e:
+        print(f"Warning: could not read manifest {path} ({e}); treating every document as new")
+        return {}
+
+
+def save_manifest(path, documents):
+    """Write the manifest atomically so an interrupted run never leaves a truncated file"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"index": index_name, "documents": documents}, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def is_unchanged(doc_id, doc_hash, manifest):
+    """A document can be skipped only if its content, embedding and chunking settings are unchanged"""
+    entry = manifest.get(doc_id)
+    return (
+        entry is not None
+        and entry.get("hash") == doc_hash
+        and entry.get("model") == embedding_deployment
+        and entry.get("dimensions") == embedding_dimensions
+        and entry.get("chunking") == CHUNKING
+        and entry.get("embeddingText") == EMBEDDING_TEXT_VERSION
+    )
+
+
+def document_chunks(doc):
+    """Split a parent article into heading-aware chunks, one search document per chunk"""
+    with trace.span("chunk"):
+        chunks = chunk_markdown(doc["content"], max_tokens=CHUNK_TOKENS, overlap_tokens=CHUNK_OVERLAP)
+    return [
+        {
+            "id": f"{doc['id']}_c{chunk.index}",
+            "parentId": doc["id"],
+            "chunkIndex": chunk.index,
+            "title": doc["title"],
+            "sectionPath": chunk.section,
+            "content": chunk.content,
+            "filename": doc["filename"],
+            "sourceUrl": doc["sourceUrl"],
+            "category": doc["category"],
+            "lastModified": doc["lastModified"]
+        }
+        for chunk in chunks
+    ]
+
+
+def chunk_documents(docs):
+    """Chunk each parent article, recording its chunk ids (and MinHash signatures when deduplicating)"""
+    for doc in docs:
+        chunks = document_chunks(doc)
+        pending_chunks[doc["id"]] = [chunk["id"] for chunk in chunks]
+        for chunk in chunks:
+            if DEDUP:
+                with trace.span("minhash"):
+                    pending_signatures[chunk["id"]] = minhasher.signature(chunk["content"])
+            # Uploaded as its own cluster; consolidate_duplicates() regroups once every chunk is embedded
+            chunk["clusterId"] = chunk["id"]
+            yield chunk
+
+
+def embedding_text(chunk):
+    """Prefix the chunk with its title and heading path so the vector keeps the section's context
+
+    Below the article's H1 the heading path already starts with the title, so the title isn't repeated.
+    """
+    title, section = chunk["title"], chunk["sectionPath"]
+    if section == title or section.startswith(f"{title} > "):
+        return f"{section}\n\n{chunk['content']}"
+    return f"{title}\n{section}\n\n{chunk['content']}"
+
+
+def stamp_index_generation():
+    """Record when the index changed; every RAG worker polls this and drops answers cached before it
+
+    Azure: one document in the metadata index (see `metadata_index_name`); local: the index's meta.json.
+    """
+    stamp = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    if args.backend == "local":
+        search_client.generation = stamp  # written by save()
+        return
+    try:
+        metadata_client = SearchClient(
+            search_endpoint, metadata_index_name(index_name), AzureKeyCredential(search_key)
+        )
+        metadata_client.merge_or_upload_documents([{"id": index_name, "lastModified": stamp}])
     except Exception as e:
-        print(f"      ✗ Error embedding: {str(e)[:100]}")
+        print(f"  ⚠️ Could not record the index generation ({str(e)[:100]}); "
+              "cached answers expire after their TTL")
 
-# Upload to search
-if documents:
-    print(f"\nUploading {len(documents)} documents to Azure AI Search...")
-    search_client = SearchClient(search_endpoint, index_name, AzureKeyCredential(search_key))
+
+def invalidate_answer_cache():
+    """Tell the RAG function to drop cached answers, which may now be stale"""
+    function_url = os.getenv("RAG_FUNCTION_URL")
+    if not function_url:
+        print("  (RAG_FUNCTION_URL not set, skipping answer cache invalidation)")
+        return
+    request = urllib.request.Request(
+        f"{function_url.rstrip('/')}/api/rag-cache/invalidate",
+        data=b"{}",
+        headers={"Content-Type": "application/json", "x-functions-key": os.getenv("RAG_FUNCTION_KEY", "")},
+        method="POST"
+    )
     try:
-        result = search_client.upload_documents(documents)
-        print(f"✓ Uploaded {len(result)} documents successfully")
+        with urllib.request.urlopen(request, timeout=10) as response:
+            dropped = json.loads(response.read()).get("invalidated", 0)
+            print(f"  ✓ Answer cache invalidated: {dropped} entries dropped")
     except Exception as e:
-        print(f"✗ Upload error: {str(e)[:200]}")
+        print(f"  ⚠️ Could not invalidate answer cache ({str(e)[:100]}); cached answers expire after their TTL")
+
+
+def batched(iterable, size):
+    """Group an iterable into lists of at most `size` items"""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def embed_batch(batch):
+    """Embed a batch of documents; cache misses go out in a single multi-input embeddings request"""
+    with trace.span("embed"):
+        vectors, tokens, _ = embed_texts(
+            openai_client,
+            embedding_deployment,
+            embedding_dimensions,
+            [embedding_text(doc) for doc in batch],
+            cache=embedding_cache,
+            timeout=60,
+            request_dimensions=request_dimensions
+        )
+    for doc, vector in zip(batch, vectors):
+        doc["contentVector"] = vector
+    return batch, tokens
+
+
+class BatchUploader:
+    """Buffer embedded chunks and push them to the index in fixed-size batches"""
+
+    def __init__(self, search_client, batch_size, merge=False):
+        self.search_client = search_client
+        self.batch_size = batch_size
+        self.merge = merge
+        self.buffer = []
+        self.uploaded = 0
+        self.failed = 0
+        self.uploaded_ids = []
+
+    def add(self, docs):
+        self.buffer.extend(docs)
+        while len(self.buffer) >= self.batch_size:
+            self._upload(self.buffer[:self.batch_size])
+            self.buffer = self.buffer[self.batch_size:]
+
+    def flush(self):
+        if self.buffer:
+            self._upload(self.buffer)
+            self.buffer = []
+
+    def _upload(self, docs):
+        try:
+            with trace.span("upload"):
+                if self.merge:
+                    results = self.search_client.merge_or_upload_documents(docs)
+                else:
+                    results = self.search_client.upload_documents(docs)
+            succeeded_ids = [r.key for r in results if r.succeeded]
+            succeeded = len(succeeded_ids)
+            self.uploaded_ids.extend(succeeded_ids)
+            self.uploaded += succeeded
+            self.failed += len(docs) - succeeded
+            print(f"      ↑ Uploaded batch of {len(docs)} chunks ({succeeded} succeeded)")
+        except Exception as e:
+            self.failed += len(docs)
+            print(f"      ✗ Upload error: {str(e)[:200]}")
+
+
+# Read, embed and upload documents
+print("\nReading knowledge base documents...")
+print(f"  Embedding batch size: {EMBED_BATCH_SIZE}, concurrent batches: {EMBED_CONCURRENCY}, "
+      f"upload batch size: {UPLOAD_BATCH_SIZE}, chunking (tokens/overlap): {CHUNKING}")
+print(f"  Vectors: {embedding_dimensions} dimensions, compression: {VECTOR_COMPRESSION}")
+docs_path = "content"
+if args.backend == "local":
+    search_client = LocalVectorStore(args.local_index, compression=VECTOR_COMPRESSION)
 else:
+    search_client = SearchClient(search_endpoint, index_name, AzureKeyCredential(search_key))
+uploader = BatchUploader(search_client, UPLOAD_BATCH_SIZE, merge=args.incremental)
+embedding_cache = EmbeddingCache.from_env(default_path=os.path.join(SCRIPT_DIR, ".embedding-cache.sqlite3"))
+
+manifest = load_manifest(args.manifest)
+pending_hashes = {}
+pending_chunks = {}
+pending_signatures = {}
+pending_sketches = {}
+seen_ids = set()
+skipped_docs = 0
+
+if args.incremental:
+    print(f"  Incremental mode: {len(manifest)} documents in manifest {args.manifest}")
+
+
+def changed_documents(docs):
+    """Record every document's hash and, in incremental mode, drop the ones already in the index"""
+    global skipped_docs
+    for doc in docs:
+        with trace.span("hash"):
+            doc_hash = content_hash(doc)
+        seen_ids.add(doc["id"])
+        if args.incremental and is_unchanged(doc["id"], doc_hash, manifest):
+            skipped_docs += 1
+            continue
+        pending_hashes[doc["id"]] = doc_hash
+        yield doc
+
+
+embedded_chunks = 0
+embedded_tokens = 0
+embed_failures = 0
+started = time.perf_counter()
+# Per-stage timings; embed and upload run in overlapping batches, so their times are summed across batches
+trace = RequestTrace("ingest", index=index_name, incremental=args.incremental)
+
+
+def collect(future, batch):
+    global embedded_chunks, embedded_tokens, embed_failures
+    try:
+        docs, tokens = future.result()
+    except Exception as e:
+        embed_failures += len(batch)
+        print(f"      ✗ Error embedding batch ({', '.join(d['id'] for d in batch)}): {str(e)[:100]}")
+        return
+
+    embedded_chunks += len(docs)
+    embedded_tokens += tokens
+    actual_dimensions = len(docs[0]["contentVector"])
+    if actual_dimensions != embedding_dimensions:
+        print(f"      ⚠️ Embedding has {actual_dimensions} dimensions, index expects {embedding_dimensions}")
+    for doc in docs:
+        print(f"  ✓ Embedded {doc['id']}: {doc['title']} > {doc['sectionPath'] or '(intro)'}")
+        if DEDUP:
+            pending_sketches[doc["id"]] = sketch(doc["contentVector"], DEDUP_SKETCH_DIMENSIONS)
+    uploader.add(docs)
+
+
+def dedup_candidates():
+    """(chunk id, parent id, signature, sketch) of every chunk in the index, in document order, and their state
+
+    The state is what the index holds for the chunk: {"clusterId", "vector"}. Chunks uploaded by this run
+    come from the pipeline, unchanged articles from their manifest entry; articles ingested before
+    deduplication was enabled have no signatures recorded and stay out of clustering until a full run.
+    """
+    uploaded_ids = set(uploader.uploaded_ids)
+    candidates = []
+    states = {}
+    parents = set(pending_chunks) | (set(manifest) if args.incremental else set())
+    for parent_id in sorted(parents):
+        if parent_id in pending_chunks:
+            for chunk_id in pending_chunks[parent_id]:
+                if chunk_id in uploaded_ids and chunk_id in pending_sketches:
+                    candidates.append((chunk_id, parent_id, pending_signatures[chunk_id], pending_sketches[chunk_id]))
+                    states[chunk_id] = {"clusterId": chunk_id, "vector": True}
+            continue
+        records = manifest[parent_id].get("dedup") or {}
+        for chunk_id in manifest[parent_id].get("chunks") or []:
+            record = records.get(chunk_id)
+            if record is not None:
+                candidates.append((
+                    chunk_id,
+                    parent_id,
+                    decode(record["minhash"], "uint32"),
+                    decode(record["sketch"], "float16")
+                ))
+                states[chunk_id] = {"clusterId": record["clusterId"], "vector": record["vector"]}
+    return candidates, states
+
+
+def reembed(chunks):
+    """Embed chunks again from their source files (mostly embedding cache hits); chunks: {chunk id: parent id}"""
+    parents = set(chunks.values())
+    docs = [
+        chunk
+        for doc in read_documents(docs_path) if doc["id"] in parents
+        for chunk in document_chunks(doc) if chunk["id"] in chunks
+    ]
+    embedded = []
+    for batch in batched(docs, EMBED_BATCH_SIZE):
+        try:
+            embedded.extend(embed_batch(batch)[0])
+        except Exception as e:
+            print(f"      ✗ Error re-embedding ({', '.join(d['id'] for d in batch)}): {str(e)[:100]}")
+    return embedded
+
+
+def consolidate_duplicates():
+    """Group near-duplicate chunks and keep one vector per cluster; returns the manifest records per parent
+
+    A cluster's representative keeps its vector and is its own clusterId; the other members point at it
+    and lose their vector (they stay searchable by keyword). A chunk that becomes a representative after
+    being a member (its representative changed or was removed) is embedded again.
+    """
+    candidates, states = dedup_candidates()
+    with trace.span("dedup"):
+        clusters = cluster_chunks(candidates, minhasher, DEDUP_MIN_JACCARD, DEDUP_MIN_COSINE)
+
+    updates = []
+    promoted = {}
+    for chunk_id, parent_id, _, _ in candidates:
+        cluster_id = clusters[chunk_id]
+        state = states[chunk_id]
+        representative = cluster_id == chunk_id
+        if representative and not state["vector"]:
+            promoted[chunk_id] = parent_id
+        elif state["clusterId"] != cluster_id or (state["vector"] and not representative):
+            update = {"id": chunk_id, "clusterId": cluster_id}
+            if state["vector"] and not representative:
+                update["contentVector"] = None
+            updates.append(update)
+    if promoted:
+        with trace.span("embed"):
+            for doc in reembed(promoted):
+                updates.append({"id": doc["id"], "clusterId": doc["id"], "contentVector": doc["contentVector"]})
+
+    for batch in batched(updates, UPLOAD_BATCH_SIZE):
+        try:
+            with trace.span("upload"):
+                results = search_client.merge_or_upload_documents(batch)
+        except Exception as e:
+            print(f"      ✗ Cluster update error: {str(e)[:200]}")
+            continue
+        succeeded = {r.key for r in results if r.succeeded}
+        for update in batch:
+            if update["id"] in succeeded:
+                states[update["id"]]["clusterId"] = update["clusterId"]
+                if "contentVector" in update:
+                    states[update["id"]]["vector"] = update["contentVector"] is not None
+
+    duplicates = sum(1 for chunk_id, cluster_id in clusters.items() if chunk_id != cluster_id)
+    vectors = sum(1 for state in states.values() if state["vector"])
+    print(f"  🔗 Near-duplicates: {duplicates} of {len(clusters)} chunks share a cluster representative, "
+          f"{vectors} vectors stored ({len(updates)} index updates)")
+    trace.set(duplicateChunks=duplicates, storedVectors=vectors)
+
+    records = {}
+    for chunk_id, parent_id, signature, chunk_sketch in candidates:
+        records.setdefault(parent_id, {})[chunk_id] = {
+            "minhash": encode(signature),
+            "sketch": encode(chunk_sketch),
+            **states[chunk_id]
+        }
+    return records
+
+
+with ThreadPoolExecutor(max_workers=EMBED_CONCURRENCY) as executor:
+    in_flight = {}
+    for batch in batched(chunk_documents(changed_documents(read_documents(docs_path))), EMBED_BATCH_SIZE):
+        # Bound the number of batches in flight so slow calls can't pile up the whole corpus in memory
+        if len(in_flight) >= EMBED_CONCURRENCY:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                collect(future, in_flight.pop(future))
+        in_flight[executor.submit(embed_batch, batch)] = batch
+
+    for future in as_completed(list(in_flight)):
+        collect(future, in_flight.pop(future))
+
+uploader.flush()
+
+# Remove index entries that no longer exist: chunks of files that are gone (incremental runs) and
+# chunks a re-chunked file no longer produces. Entries without a chunk list predate chunking and were
+# indexed as a single document under the parent id.
+deleted_docs = 0
+removed_parents = sorted(set(manifest) - seen_ids) if args.incremental else []
+stale_ids = set()
+for parent_id in removed_parents + sorted(pending_chunks):
+    previous = manifest.get(parent_id, {}).get("chunks") or [parent_id]
+    stale_ids.update(set(previous) - set(pending_chunks.get(parent_id, [])))
+
+if stale_ids:
+    try:
+        with trace.span("delete"):
+            results = search_client.delete_documents([{"id": doc_id} for doc_id in sorted(stale_ids)])
+        deleted_docs = sum(1 for r in results if r.succeeded)
+        for parent_id in removed_parents:
+            manifest.pop(parent_id, None)
+        print(f"  🗑 Removed {deleted_docs} stale index entries"
+              + (f" (source file gone: {', '.join(removed_parents)})" if removed_parents else ""))
+    except Exception as e:
+        print(f"  ✗ Delete error: {str(e)[:200]}")
+
+dedup_records = consolidate_duplicates() if DEDUP else {}
+
+if uploader.uploaded_ids or deleted_docs:
+    stamp_index_generation()
+
+if args.backend == "local":
+    with trace.span("save"):
+        search_client.save()
+
+if not args.incremental:
+    # A full run re-uploads everything, so the manifest is rebuilt from scratch
+    manifest = {}
+
+# Only documents whose chunks were all acknowledged by the index are recorded, so failures are retried next run
+uploaded_ids = set(uploader.uploaded_ids)
+embedded_docs = 0
+for parent_id, chunk_ids in pending_chunks.items():
+    if all(chunk_id in uploaded_ids for chunk_id in chunk_ids):
+        embedded_docs += 1
+        manifest[parent_id] = {
+            "hash": pending_hashes[parent_id],
+            "model": embedding_deployment,
+            "dimensions": embedding_dimensions,
+            "chunking": CHUNKING,
+            "embeddingText": EMBEDDING_TEXT_VERSION,
+            "chunks": chunk_ids
+        }
+for parent_id, records in dedup_records.items():
+    if parent_id in manifest:
+        manifest[parent_id]["dedup"] = records
+with trace.span("manifest"):
+    save_manifest(args.manifest, manifest)
+
+if embedded_docs or deleted_docs:
+    with trace.span("invalidate"):
+        invalidate_answer_cache()
+elapsed = time.perf_counter() - started
+trace.set(embeddedDocs=embedded_docs, embeddedChunks=embedded_chunks, deletedDocs=deleted_docs, tokens=embedded_tokens)
+trace.emit("completed")
+
+if args.incremental:
+    print(f"\n✓ Incremental run: {skipped_docs} unchanged, {embedded_docs} embedded, "
+          f"{len(removed_parents)} removed")
+
+if embedded_chunks or embed_failures:
+    print(f"\n✓ Embedded {embedded_docs} documents as {embedded_chunks} chunks ({embed_failures} chunks failed), "
+          f"uploaded {uploader.uploaded} ({uploader.failed} failed)")
+    print(f"  Throughput: {embedded_docs / elapsed:.1f} docs/s, {embedded_chunks / elapsed:.1f} chunks/s, "
+          f"{embedded_tokens / elapsed:.0f} tokens/s ({embedded_tokens} tokens in {elapsed:.1f}s)")
+    if embedding_cache:
+        print(f"  Embedding cache: {embedding_cache.hits} hits, {embedding_cache.misses} misses "
+              f"({embedding_cache.path})")
+elif not (args.incremental and (skipped_docs or removed_parents)):
     print("\n✗ No documents found to upload!")
 
+stage_timings = trace.timings()
+stage_timings.pop("total")
+if stage_timings:
+    print("  Stage timings (ms): " + ", ".join(f"{stage} {ms:.0f}" for stage, ms in stage_timings.items()))
+
 print(f"\n{'='*70}")
 print(f"Ingestion Complete! Index '{index_name}' is ready for queries.")
 print(f"{'='*70}\n")
@@ -0,0 +1,140 @@
+"""Semantic answer cache in front of the RAG pipeline
+
+Answers are cached against the question embedding. A new question whose
+embedding is within a cosine-similarity threshold of a cached question gets
+the cached answer without a search or chat completion. Entries expire after
+a TTL and the cache is LRU-bounded.
+
+The cache lives in one worker's memory, so a re-ingest can't reach into it
+directly. Instead every worker polls the index generation (a stamp
+ingest-kb.py writes whenever it changes the index) and `set_generation()`
+drops everything once it moves; `invalidate()` does the same on demand for
+the worker that receives the call. An answer computed under an older
+generation is never stored. Answers retrieved from a filtered search
+(e.g. one support category) are stored under a scope and only served to
+questions asked in the same scope.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+
+
+@dataclass
+class _Entry:
+    question: str
+    payload: Dict
+    expires_at: float
+    scope: str = ""
+
+
+class SemanticAnswerCache:
+    """In-process, thread-safe semantic cache; vectors live in one preallocated float32 matrix"""
+
+    def __init__(self, threshold: float = 0.95, ttl_seconds: float = 3600, max_entries: int = 1000):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._vectors: Optional[np.ndarray] = None
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()  # slot -> entry, least recently used first
+        self._free_slots = list(range(max_entries - 1, -1, -1))
+        self.generation: Optional[str] = None  # index generation the cached answers were computed against
+
+    @classmethod
+    def from_env(cls) -> Optional["SemanticAnswerCache"]:
+        """Build the cache from RAG_ANSWER_CACHE_* settings (RAG_ANSWER_CACHE_MAX_ENTRIES=0 disables it)"""
+        max_entries = int(os.getenv("RAG_ANSWER_CACHE_MAX_ENTRIES", "1000"))
+        if max_entries <= 0:
+            return None
+        return cls(
+            threshold=float(os.getenv("RAG_ANSWER_CACHE_THRESHOLD", "0.95")),
+            ttl_seconds=float(os.getenv("RAG_ANSWER_CACHE_TTL_SECONDS", "3600")),
+            max_entries=max_entries
+        )
+
+    @staticmethod
+    def _normalize(vector: Sequence[float]) -> np.ndarray:
+        v = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(v)
+        return v / norm if norm else v
+
+    def lookup(self, vector: Sequence[float], scope: str = "") -> Optional[Dict]:
+        """Return the payload cached for the most similar question in `scope`, if it is similar enough"""
+        query = self._normalize(vector)
+        now = time.monotonic()
+        with self._lock:
+            self._purge_expired(now)
+            slots = [slot for slot, entry in self._entries.items() if entry.scope == scope]
+            if not slots or self._vectors is None or self._vectors.shape[1] != query.shape[0]:
+                self.misses += 1
+                return None
+
+            slots = np.array(slots, dtype=np.intp)
+            similarities = self._vectors[slots] @ query
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+
+            slot = int(slots[best])
+            self._entries.move_to_end(slot)
+            self.hits += 1
+            return dict(self._entries[slot].payload, similarity=float(similarities[best]))
+
+    def store(
+        self,
+        question: str,
+        vector: Sequence[float],
+        payload: Dict,
+        scope: str = "",
+        generation: Optional[str] = None
+    ):
+        """Cache the answer; skipped if it was computed under `generation` and the index has moved on since"""
+        normalized = self._normalize(vector)
+        with self._lock:
+            if generation != self.generation:
+                return
+            if self._vectors is None or self._vectors.shape[1] != normalized.shape[0]:
+                # First entry (or the embedding dimension changed): (re)allocate the matrix
+                self._vectors = np.zeros((self.max_entries, normalized.shape[0]), dtype=np.float32)
+                self._entries.clear()
+                self._free_slots = list(range(self.max_entries - 1, -1, -1))
+
+            if not self._free_slots:
+                slot, _ = self._entries.popitem(last=False)  # evict least recently used
+            else:
+                slot = self._free_slots.pop()
+            self._vectors[slot] = normalized
+            self._entries[slot] = _Entry(question, dict(payload), time.monotonic() + self.ttl_seconds, scope)
+
+    def invalidate(self) -> int:
+        """Drop every entry (e.g. after the index was re-ingested); returns how many were dropped"""
+        with self._lock:
+            dropped = len(self._entries)
+            self._entries.clear()
+            self._free_slots = list(range(self.max_entries - 1, -1, -1))
+            return dropped
+
+    def set_generation(self, generation: Optional[str]) -> int:
+        """Record the index generation; when it changed, drop every entry and return how many were dropped"""
+        with self._lock:
+            if generation == self.generation:
+                return 0
+            self.generation = generation
+        return self.invalidate()
+
+    def _purge_expired(self, now: float):
+        expired = [slot for slot, entry in self._entries.items() if entry.expires_at <= now]
+        for slot in expired:
+            del self._entries[slot]
+            self._free_slots.append(slot)
+
+    def __len__(self) -> int:
+        return len(self._entries)
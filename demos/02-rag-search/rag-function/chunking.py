@@ -0,0 +1,218 @@
+"""Heading-aware markdown chunking and chunk-to-parent collapsing
+
+Articles are split along their heading structure so each chunk covers one
+section (or a token-bounded slice of a long section) and carries the
+heading path it came from. At query time, retrieved chunks are folded back
+into their parent article.
+"""
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:  # tiktoken is optional; fall back to a character heuristic
+    _encoding = None
+
+HEADING_PATTERN = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+FENCE_PATTERN = re.compile(r"^\s*(```|~~~)")
+
+
+def count_tokens(text: str) -> int:
+    """Count tokens with tiktoken when installed, otherwise estimate ~4 characters per token"""
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return max(1, (len(text) + 3) // 4) if text else 0
+
+
+@dataclass
+class Chunk:
+    index: int
+    section_path: List[str]
+    content: str
+    tokens: int
+
+    @property
+    def section(self) -> str:
+        return " > ".join(self.section_path)
+
+
+def split_sections(markdown: str) -> List[Dict]:
+    """Split markdown into sections, one per heading, with the heading path leading to each"""
+    sections = []
+    stack = []  # [(level, heading text)]
+    lines = []
+    in_fence = False
+
+    def close_section():
+        body = "\n".join(lines).strip()
+        if body:
+            sections.append({"path": [text for _, text in stack], "content": body})
+
+    for line in markdown.splitlines():
+        if FENCE_PATTERN.match(line):
+            in_fence = not in_fence
+        match = None if in_fence else HEADING_PATTERN.match(line)
+        if match:
+            close_section()
+            level = len(match.group(1))
+            while stack and stack[-1][0] >= level:
+                stack.pop()
+            stack.append((level, match.group(2)))
+            lines = [line]
+        else:
+            lines.append(line)
+    close_section()
+    return sections
+
+
+def _split_oversized(block: str, max_tokens: int) -> List[str]:
+    """Split a single paragraph that is larger than the budget on line, then sentence, boundaries"""
+    pieces = [p for p in block.split("\n") if p.strip()]
+    if len(pieces) == 1:
+        pieces = re.split(r"(?<=[.!?])\s+", block)
+
+    parts, current = [], ""
+    for piece in pieces:
+        candidate = f"{current}\n{piece}" if current else piece
+        if current and count_tokens(candidate) > max_tokens:
+            parts.append(current)
+            current = piece
+        else:
+            current = candidate
+    if current:
+        parts.append(current)
+
+    # A single sentence can still be too long; hard-wrap it by characters as a last resort
+    wrapped = []
+    max_chars = max_tokens * 4
+    for part in parts:
+        while count_tokens(part) > max_tokens and len(part) > max_chars:
+            wrapped.append(part[:max_chars])
+            part = part[max_chars:]
+        wrapped.append(part)
+    return wrapped
+
+
+def _window(blocks: List[str], max_tokens: int, overlap_tokens: int) -> List[str]:
+    """Pack paragraphs into token-bounded windows, repeating trailing paragraphs as overlap"""
+    units = []
+    for block in blocks:
+        units.extend(_split_oversized(block, max_tokens) if count_tokens(block) > max_tokens else [block])
+
+    windows, current, current_tokens = [], [], 0
+    for unit in units:
+        unit_tokens = count_tokens(unit)
+        if current and current_tokens + unit_tokens > max_tokens:
+            windows.append("\n\n".join(current))
+            # Carry the tail of the previous window forward so answers spanning the cut stay retrievable
+            overlap, overlap_size = [], 0
+            for previous in reversed(current):
+                size = count_tokens(previous)
+                if overlap_size + size > overlap_tokens or size + unit_tokens > max_tokens:
+                    break
+                overlap.insert(0, previous)
+                overlap_size += size
+            current, current_tokens = overlap, overlap_size
+        current.append(unit)
+        current_tokens += unit_tokens
+    if current:
+        windows.append("\n\n".join(current))
+    return windows
+
+
+def _is_prefix(prefix: List[str], path: List[str]) -> bool:
+    return path[:len(prefix)] == prefix
+
+
+def _common_prefix(a: List[str], b: List[str]) -> List[str]:
+    common = []
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        common.append(x)
+    return common
+
+
+def chunk_markdown(markdown: str, max_tokens: int = 512, overlap_tokens: int = 64) -> List[Chunk]:
+    """Chunk a markdown article along its headings
+
+    Small neighbouring sections that share a parent heading are merged up to
+    `max_tokens`; sections larger than that are windowed by paragraph with
+    `overlap_tokens` of overlap.
+    """
+    chunks: List[Chunk] = []
+    pending: Optional[Dict] = None
+
+    def emit(path, content):
+        chunks.append(Chunk(index=len(chunks), section_path=path, content=content, tokens=count_tokens(content)))
+
+    for section in split_sections(markdown):
+        tokens = count_tokens(section["content"])
+        if tokens > max_tokens:
+            content = section["content"]
+            if pending:
+                if not pending["merged"] and _is_prefix(pending["path"], section["path"]):
+                    # Lead-in text of a parent heading belongs with its first subsection
+                    content = f"{pending['content']}\n\n{content}"
+                else:
+                    emit(pending["path"], pending["content"])
+                pending = None
+            for window in _window(re.split(r"\n\s*\n", content), max_tokens, overlap_tokens):
+                emit(section["path"], window)
+            continue
+
+        if pending:
+            related = _is_prefix(pending["path"][:-1], section["path"])
+            merged = f"{pending['content']}\n\n{section['content']}"
+            if related and count_tokens(merged) <= max_tokens:
+                pending["content"] = merged
+                pending["path"] = _common_prefix(pending["path"], section["path"])
+                pending["merged"] = True
+                continue
+            emit(pending["path"], pending["content"])
+        pending = {"path": section["path"], "content": section["content"], "merged": False}
+
+    if pending:
+        emit(pending["path"], pending["content"])
+    return chunks
+
+
+def collapse_to_parents(hits: List[Dict], max_chunks_per_parent: int = 3) -> List[Dict]:
+    """Fold ranked chunk hits into their parent articles, keeping the parents in rank order
+
+    Each hit needs `title`; `content`, `parentId`, `chunkIndex`,
+    `sectionPath`, `sourceUrl` and `score` are used when present (documents indexed before
+    chunking are treated as their own parent, hits retrieved without content
+    collapse to empty content). The parent's content is its
+    retrieved chunks in document order and its score is its best chunk's.
+    """
+    parents: Dict[str, Dict] = {}
+    for rank, hit in enumerate(hits):
+        parent_id = hit.get("parentId") or hit.get("id") or hit.get("title", "")
+        parent = parents.get(parent_id)
+        if parent is None:
+            parent = parents[parent_id] = {
+                "parentId": parent_id,
+                "title": hit.get("title", ""),
+                "sourceUrl": hit.get("sourceUrl") or "",
+                "rank": rank,
+                "chunks": []
+            }
+        if len(parent["chunks"]) < max_chunks_per_parent:
+            parent["chunks"].append(hit)
+
+    collapsed = []
+    for parent in sorted(parents.values(), key=lambda p: p["rank"]):
+        chunks = sorted(parent["chunks"], key=lambda c: c.get("chunkIndex") or 0)
+        collapsed.append({
+            "parentId": parent["parentId"],
+            "title": parent["title"],
+            "sourceUrl": parent["sourceUrl"],
+            "content": "\n\n".join(c.get("content") or "" for c in chunks),
+            "sections": [c["sectionPath"] for c in chunks if c.get("sectionPath")],
+            "score": max((c.get("score") or 0) for c in chunks),
+            "chunks": chunks
+        })
+    return collapsed
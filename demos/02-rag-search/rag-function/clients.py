@@ -0,0 +1,139 @@
+"""Lazily created, shared service clients for the RAG function
+
+Importing `openai`, `azure.identity` and `azure.search.documents` and building
+their clients used to happen at module import, so every cold start paid for
+all of it before the worker could accept a request. Now:
+
+- `start_background_imports()` (called at module import) loads the heavy
+  packages on a daemon thread while the host finishes indexing functions
+- `get_openai_client()` / `get_search_backend()` build each client on first
+  use and reuse it for the worker's lifetime
+- `warm_up()` is called first thing in every route; on the first request it
+  schedules the Entra ID token fetch so it runs while the request is parsed
+  and the caches are checked. The fetch is single-flight: the first real
+  call to Azure OpenAI awaits the same fetch instead of starting another.
+
+RAG_PREWARM=false disables the background imports (e.g. to measure them).
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import Awaitable, Callable, Optional
+
+from resilience import ResiliencePolicy, ResilientOpenAI
+from search_backends import SearchBackend, create_backend
+
+logger = logging.getLogger(__name__)
+
+COGNITIVE_SERVICES_SCOPE = "https://cognitiveservices.azure.com/.default"
+
+_lock = threading.Lock()
+_openai_client: Optional[ResilientOpenAI] = None
+openai_policy = ResiliencePolicy.from_env()  # retries, per-deployment limits, hedging, circuit breakers
+_token_provider: Optional["SingleFlightTokenProvider"] = None
+_search_backend: Optional[SearchBackend] = None
+_warmup_task: Optional[asyncio.Future] = None
+startup = {}  # backgroundImportMs once the background imports finish
+
+
+def _import_heavy_modules():
+    started = time.perf_counter()
+    try:
+        import openai  # noqa: F401
+        import azure.identity.aio  # noqa: F401
+        if os.getenv("RAG_SEARCH_BACKEND", "azure").lower() == "azure":
+            import azure.search.documents.aio  # noqa: F401
+    except Exception:  # the real import on first use raises with a proper traceback
+        logger.debug("Background import failed", exc_info=True)
+    startup["backgroundImportMs"] = round((time.perf_counter() - started) * 1000, 1)
+
+
+def start_background_imports():
+    if os.getenv("RAG_PREWARM", "true").lower() in ("1", "true", "yes"):
+        threading.Thread(target=_import_heavy_modules, name="rag-prewarm", daemon=True).start()
+
+
+class SingleFlightTokenProvider:
+    """Wraps an async bearer token provider so concurrent callers share one in-flight fetch"""
+
+    def __init__(self, provider: Callable[[], Awaitable[str]]):
+        self._provider = provider
+        self._inflight: Optional[asyncio.Future] = None
+
+    def _clear(self, _future):
+        self._inflight = None
+
+    async def __call__(self) -> str:
+        if self._inflight is None:
+            self._inflight = asyncio.ensure_future(self._provider())
+            self._inflight.add_done_callback(self._clear)
+        # shield: one caller being cancelled must not cancel the fetch the others are waiting on
+        return await asyncio.shield(self._inflight)
+
+
+def get_openai_client() -> ResilientOpenAI:
+    """AsyncAzureOpenAI (API key if set, otherwise Managed Identity / Azure CLI) behind `openai_policy`"""
+    global _openai_client, _token_provider
+    if _openai_client is not None:
+        return _openai_client
+    with _lock:
+        if _openai_client is None:
+            from openai import AsyncAzureOpenAI
+
+            common = {
+                "api_version": os.getenv("AZURE_OPENAI_API_VERSION", "2024-08-01-preview"),
+                "azure_endpoint": os.getenv("AZURE_OPENAI_ENDPOINT"),
+                "max_retries": 0  # retried by the policy, which honours Retry-After and feeds the breaker
+            }
+            api_key = os.getenv("AZURE_OPENAI_API_KEY")
+            if api_key:
+                client = AsyncAzureOpenAI(api_key=api_key, **common)
+            else:
+                from azure.identity.aio import DefaultAzureCredential, get_bearer_token_provider
+
+                _token_provider = SingleFlightTokenProvider(
+                    get_bearer_token_provider(DefaultAzureCredential(), COGNITIVE_SERVICES_SCOPE)
+                )
+                client = AsyncAzureOpenAI(azure_ad_token_provider=_token_provider, **common)
+            _openai_client = ResilientOpenAI(client, openai_policy)
+    return _openai_client
+
+
+def _create_search_client(index_name: str):
+    from azure.core.credentials import AzureKeyCredential
+    from azure.search.documents.aio import SearchClient
+
+    return SearchClient(
+        os.getenv("AZURE_AI_SEARCH_ENDPOINT"),
+        index_name,
+        AzureKeyCredential(os.getenv("AZURE_AI_SEARCH_API_KEY"))
+    )
+
+
+def get_search_backend() -> SearchBackend:
+    """Azure AI Search or the local index (RAG_SEARCH_BACKEND); the aiohttp session opens on first query"""
+    global _search_backend
+    if _search_backend is not None:
+        return _search_backend
+    with _lock:
+        if _search_backend is None:
+            _search_backend = create_backend(_create_search_client)
+    return _search_backend
+
+
+def _log_warmup_failure(task: asyncio.Future):
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("Token prefetch failed: %s", task.exception())
+
+
+def warm_up() -> Optional[asyncio.Future]:
+    """Create the clients and, on the first call, start fetching the Entra ID token in the background"""
+    global _warmup_task
+    get_openai_client()
+    get_search_backend()
+    if _warmup_task is None and _token_provider is not None:
+        _warmup_task = asyncio.ensure_future(_token_provider())
+        _warmup_task.add_done_callback(_log_warmup_failure)
+    return _warmup_task
@@ -0,0 +1,201 @@
+"""Single-flight coalescing of identical in-flight RAG requests
+
+When an outage hits, many users ask the same question within seconds. The
+first request for a key (the normalized question plus its filter) runs the
+pipeline; identical requests that arrive while it is in flight wait for it
+and get the same result, so the burst costs one embedding, one search and
+one chat completion instead of one each.
+
+- Per worker (always, unless RAG_COALESCE=false): one asyncio future per
+  key. Waiters are shielded, so a caller that disconnects never cancels the
+  flight the others are waiting on
+- Across the workers of a host (RAG_COALESCE_STORE_PATH set): the worker's
+  leader also takes a lease on the key in a shared SQLite file. A worker
+  that finds another worker's lease polls for the published result instead
+  of running the pipeline. Results stay readable for
+  RAG_COALESCE_RESULT_TTL_SECONDS after the flight lands, which also covers
+  requests that arrive just after it. A failed flight publishes nothing:
+  the waiting workers race for the next lease, and a worker that has waited
+  RAG_COALESCE_WAIT_SECONDS runs the pipeline itself.
+
+A broken shared store never takes a request down: the worker logs a
+warning and runs the pipeline on its own. Store calls block on SQLite (and
+on its busy timeout while another worker writes), so they run in a thread
+rather than on the event loop.
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STORE_PATH = os.path.join(tempfile.gettempdir(), "rag-coalescing.sqlite3")
+
+
+class SharedFlightStore:
+    """SQLite table through which workers elect one leader per key and hand its result to the others"""
+
+    def __init__(self, path: str = DEFAULT_STORE_PATH, result_ttl_seconds: float = 2.0, lease_seconds: float = 60.0):
+        self.path = path
+        self.result_ttl_seconds = result_ttl_seconds
+        self.lease_seconds = lease_seconds  # a lease older than this belongs to a leader that died mid-flight
+        self.owner = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=1.0)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS flights ("
+            "key TEXT PRIMARY KEY, owner TEXT NOT NULL, started REAL NOT NULL, finished REAL, result TEXT)"
+        )
+
+    def acquire(self, key: str) -> bool:
+        """Take the lease on `key`; False while another flight for it is running or its result is still fresh"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "DELETE FROM flights "
+                    "WHERE (finished IS NOT NULL AND finished < ?) OR (finished IS NULL AND started < ?)",
+                    (now - self.result_ttl_seconds, now - self.lease_seconds)
+                )
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO flights (key, owner, started) VALUES (?, ?, ?)",
+                    (key, self.owner, now)
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return cursor.rowcount == 1
+
+    def publish(self, key: str, result: str):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE flights SET finished = ?, result = ? WHERE key = ? AND owner = ?",
+                (time.time(), result, key, self.owner)
+            )
+
+    def release(self, key: str):
+        """Give up the lease without a result (the flight failed)"""
+        with self._lock:
+            self._conn.execute("DELETE FROM flights WHERE key = ? AND owner = ?", (key, self.owner))
+
+    def poll(self, key: str) -> Tuple[bool, Optional[str]]:
+        """(leased, result): the published result, or whether a flight for `key` still holds the lease"""
+        with self._lock:
+            row = self._conn.execute("SELECT finished, result FROM flights WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return False, None
+        if row[0] is not None and row[0] < time.time() - self.result_ttl_seconds:
+            return False, None
+        return True, row[1]
+
+
+class RequestCoalescer:
+    """Runs one flight per key at a time and hands its result (or exception) to every caller that asked for it"""
+
+    def __init__(
+        self,
+        store: Optional[SharedFlightStore] = None,
+        wait_seconds: float = 30.0,
+        poll_seconds: float = 0.05
+    ):
+        self.store = store
+        self.wait_seconds = wait_seconds
+        self.poll_seconds = poll_seconds
+        self.flights = 0  # pipelines run by this worker
+        self.coalesced = 0  # requests answered by another request's flight
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    @classmethod
+    def from_env(cls) -> Optional["RequestCoalescer"]:
+        """Build the coalescer from RAG_COALESCE* settings (RAG_COALESCE=false disables it)"""
+        if os.getenv("RAG_COALESCE", "true").lower() not in ("1", "true", "yes"):
+            return None
+        store = None
+        store_path = os.getenv("RAG_COALESCE_STORE_PATH")
+        if store_path:
+            try:
+                store = SharedFlightStore(
+                    store_path,
+                    result_ttl_seconds=float(os.getenv("RAG_COALESCE_RESULT_TTL_SECONDS", "2"))
+                )
+            except sqlite3.Error as e:
+                logger.warning(f"Coalescing across workers disabled, could not open {store_path}: {e}")
+        return cls(store, wait_seconds=float(os.getenv("RAG_COALESCE_WAIT_SECONDS", "30")))
+
+    async def run(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Return (result of factory(), coalesced); coalesced is True when another request's flight produced it
+
+        Results shared through the store are JSON round-tripped, so tuples come back as lists.
+        """
+        flight = self._inflight.get(key)
+        if flight is not None:
+            self.coalesced += 1
+            result, _ = await asyncio.shield(flight)
+            return result, True
+
+        flight = asyncio.ensure_future(self._fly(key, factory))
+        self._inflight[key] = flight
+        flight.add_done_callback(lambda done: self._land(key, done))
+        return await asyncio.shield(flight)
+
+    def _land(self, key: str, flight: asyncio.Future):
+        if self._inflight.get(key) is flight:
+            del self._inflight[key]
+        if not flight.cancelled():
+            flight.exception()  # retrieved here so a flight nobody awaits any more doesn't log "never retrieved"
+
+    async def _run_local(self, factory):
+        self.flights += 1
+        return await factory(), False
+
+    async def _fly(self, key: str, factory) -> Tuple[Any, bool]:
+        if self.store is None:
+            return await self._run_local(factory)
+
+        deadline = time.monotonic() + self.wait_seconds
+        try:
+            while time.monotonic() < deadline:
+                if await asyncio.to_thread(self.store.acquire, key):
+                    return await self._lead(key, factory)
+                # Another worker is answering the same question: wait for its result or for its lease to go
+                while time.monotonic() < deadline:
+                    leased, result = await asyncio.to_thread(self.store.poll, key)
+                    if result is not None:
+                        self.coalesced += 1
+                        return json.loads(result), True
+                    if not leased:
+                        break
+                    await asyncio.sleep(self.poll_seconds)
+        except sqlite3.Error as e:
+            logger.warning(f"Coalescing store failed, answering locally: {e}")
+        return await self._run_local(factory)
+
+    async def _lead(self, key: str, factory) -> Tuple[Any, bool]:
+        try:
+            result, _ = await self._run_local(factory)
+        except BaseException:
+            await self._release(key)
+            raise
+        try:
+            await asyncio.to_thread(self.store.publish, key, json.dumps(result))
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            logger.warning(f"Could not publish coalesced result: {e}")
+            await self._release(key)
+        return result, False
+
+    async def _release(self, key: str):
+        try:
+            await asyncio.to_thread(self.store.release, key)
+        except sqlite3.Error as e:
+            logger.warning(f"Could not release coalescing lease: {e}")
@@ -0,0 +1,138 @@
+"""Token-budgeted context packing for the answer prompt
+
+Retrieved articles are packed greedily by relevance score into a fixed token
+budget. Articles are trimmed at section (then paragraph) boundaries rather
+than mid-sentence, and passages that repeat something already packed - chunk
+overlap, or the same procedure described in two articles - are skipped.
+"""
+import hashlib
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Set
+
+from chunking import count_tokens
+
+HEADING_LINE = re.compile(r"^#{1,6}\s", re.MULTILINE)
+WORD = re.compile(r"\w+")
+
+
+@dataclass
+class PackedContext:
+    text: str
+    tokens: int
+    titles: List[str] = field(default_factory=list)
+    trimmed: int = 0
+    duplicates_skipped: int = 0
+
+
+def _sections(content: str) -> List[str]:
+    """Split content at markdown headings, keeping each heading with its body"""
+    starts = [m.start() for m in HEADING_LINE.finditer(content)]
+    if not starts or starts[0] != 0:
+        starts.insert(0, 0)
+    starts.append(len(content))
+    return [content[a:b].strip() for a, b in zip(starts, starts[1:]) if content[a:b].strip()]
+
+
+def _paragraphs(section: str) -> List[str]:
+    return [p.strip() for p in re.split(r"\n\s*\n", section) if p.strip()]
+
+
+def _shingles(text: str, size: int = 5) -> Set[int]:
+    words = WORD.findall(text.lower())
+    if len(words) < size:
+        return {hash(" ".join(words))} if words else set()
+    return {hash(" ".join(words[i:i + size])) for i in range(len(words) - size + 1)}
+
+
+class _Deduplicator:
+    """Remembers packed passages; flags exact repeats and passages mostly contained in packed text"""
+
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self.exact: Set[str] = set()
+        self.shingles: Set[int] = set()
+
+    def is_duplicate(self, passage: str) -> bool:
+        digest = hashlib.sha1(" ".join(WORD.findall(passage.lower())).encode("utf-8")).hexdigest()
+        if digest in self.exact:
+            return True
+        shingles = _shingles(passage)
+        if shingles and len(shingles & self.shingles) / len(shingles) >= self.threshold:
+            return True
+        return False
+
+    def add(self, passage: str):
+        self.exact.add(hashlib.sha1(" ".join(WORD.findall(passage.lower())).encode("utf-8")).hexdigest())
+        self.shingles |= _shingles(passage)
+
+
+def pack_context(
+    contexts: List[Dict],
+    token_budget: int = 1500,
+    max_documents: int = 3,
+    duplicate_threshold: float = 0.8
+) -> PackedContext:
+    """Pack the highest-scoring articles into `token_budget` tokens
+
+    `contexts` are collapsed articles with `title`, `content` and `score`
+    (higher is more relevant). Returns the prompt text and how many tokens it
+    uses, as counted by `chunking.count_tokens`.
+    """
+    ranked = sorted(contexts, key=lambda c: c.get("score") or 0, reverse=True)[:max_documents]
+    dedup = _Deduplicator(duplicate_threshold)
+    blocks: List[str] = []
+    packed = PackedContext(text="", tokens=0)
+    remaining = token_budget
+
+    for ctx in ranked:
+        header = f"**{ctx.get('title', '')}**"
+        header_tokens = count_tokens(header) + 1
+        if remaining <= header_tokens:
+            break
+
+        kept: List[str] = []
+        used = header_tokens
+        truncated = False
+        for section in _sections(ctx.get("content", "")):
+            section_tokens = count_tokens(section)
+            if not dedup.is_duplicate(section) and used + section_tokens <= remaining:
+                kept.append(section)
+                dedup.add(section)
+                used += section_tokens
+                continue
+
+            # Section doesn't fit whole (or partly repeats packed text): keep its leading new paragraphs,
+            # and its heading only if some of its body survives
+            heading = None
+            for paragraph in _paragraphs(section):
+                if HEADING_LINE.match(paragraph) and "\n" not in paragraph:
+                    heading = paragraph
+                    continue
+                if dedup.is_duplicate(paragraph):
+                    packed.duplicates_skipped += 1
+                    continue
+                pending = [heading, paragraph] if heading else [paragraph]
+                pending_tokens = sum(count_tokens(p) for p in pending)
+                if used + pending_tokens > remaining:
+                    truncated = True
+                    break
+                kept.extend(pending)
+                dedup.add(paragraph)
+                used += pending_tokens
+                heading = None
+            if truncated:
+                break
+
+        if kept:
+            blocks.append("\n".join([header, "\n\n".join(kept)]))
+            packed.titles.append(ctx.get("title", ""))
+            packed.trimmed += int(truncated)
+            remaining -= used
+        if truncated:
+            # The budget is spent; lower-ranked articles would only squeeze in fragments
+            break
+
+    packed.text = "\n\n".join(blocks)
+    packed.tokens = count_tokens(packed.text) if packed.text else 0
+    return packed
@@ -0,0 +1,140 @@
+"""Near-duplicate detection for knowledge base chunks
+
+Overlapping articles (a short how-to and a comprehensive guide on the same
+topic) produce chunks that say the same thing in different words. Ingestion
+groups them into clusters so the index can keep one vector per cluster and
+the query path can keep one hit per cluster:
+
+- MinHash signatures over word shingles, bucketed with LSH bands, catch
+  copied or lightly edited text without comparing every pair
+- A truncated, normalized copy of the chunk embedding (the "sketch") catches
+  rewritten text whose wording differs but whose meaning doesn't
+
+Clustering is greedy and deterministic: chunks are visited in document order
+and each joins the first matching cluster leader (an earlier chunk of another
+article), or becomes a leader itself. The leader's id is the cluster id.
+"""
+import base64
+import re
+import zlib
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+TOKEN = re.compile(r"\w+")
+MERSENNE_PRIME = (1 << 31) - 1  # keeps (a * x + b) within uint64 for 31-bit a and x
+
+
+class MinHasher:
+    """MinHash signatures of word shingles, with `bands` LSH bands of `num_perm / bands` rows"""
+
+    def __init__(self, num_perm: int = 64, bands: int = 16, shingle_size: int = 5, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands})")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, MERSENNE_PRIME, num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, MERSENNE_PRIME, num_perm, dtype=np.uint64)
+
+    def shingles(self, text: str) -> set:
+        tokens = TOKEN.findall(text.lower())
+        if len(tokens) < self.shingle_size:
+            return {" ".join(tokens)} if tokens else set()
+        return {" ".join(tokens[i:i + self.shingle_size]) for i in range(len(tokens) - self.shingle_size + 1)}
+
+    def signature(self, text: str) -> np.ndarray:
+        hashes = np.array([
+            zlib.crc32(shingle.encode("utf-8")) % MERSENNE_PRIME  # stable across processes, unlike hash()
+            for shingle in self.shingles(text)
+        ], dtype=np.uint64)
+        if not hashes.size:
+            return np.full(self.num_perm, MERSENNE_PRIME, dtype=np.uint32)
+        permuted = (np.outer(hashes, self.a) + self.b) % MERSENNE_PRIME
+        return permuted.min(axis=0).astype(np.uint32)
+
+    def band_keys(self, signature: np.ndarray) -> List[Tuple[int, bytes]]:
+        rows = self.num_perm // self.bands
+        return [(band, signature[band * rows:(band + 1) * rows].tobytes()) for band in range(self.bands)]
+
+
+def jaccard(a: np.ndarray, b: np.ndarray) -> float:
+    """Jaccard similarity of the underlying shingle sets, estimated from two signatures"""
+    return float(np.mean(a == b))
+
+
+def sketch(vector: Sequence[float], dimensions: int = 256) -> np.ndarray:
+    """Leading dimensions of an embedding, renormalized (valid for Matryoshka-trained text-embedding-3 vectors)"""
+    truncated = np.asarray(vector, dtype=np.float32)[:dimensions]
+    norm = np.linalg.norm(truncated)
+    return (truncated / norm if norm else truncated).astype(np.float16)
+
+
+def encode(array: np.ndarray) -> str:
+    return base64.b64encode(np.ascontiguousarray(array).tobytes()).decode("ascii")
+
+
+def decode(text: str, dtype) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(text), dtype=dtype)
+
+
+def cluster_chunks(
+    chunks: Sequence[Tuple[str, str, np.ndarray, Optional[np.ndarray]]],
+    hasher: MinHasher,
+    min_jaccard: float = 0.5,
+    min_cosine: float = 0.92
+) -> Dict[str, str]:
+    """Map each chunk id to its cluster id, given (chunk id, parent id, signature, sketch) in document order
+
+    Chunks of the same article never share a cluster: collapsing to parents
+    already keeps their sections together.
+    """
+    clusters: Dict[str, str] = {}
+    leaders: List[Tuple[str, str, np.ndarray]] = []
+    buckets: Dict[Tuple[int, bytes], List[int]] = {}
+    sketch_rows: List[int] = []  # leader index of each row of `sketches`
+    sketches: Optional[np.ndarray] = None
+
+    for chunk_id, parent_id, signature, chunk_sketch in chunks:
+        match = None
+        keys = hasher.band_keys(signature)
+        for leader in sorted({i for key in keys for i in buckets.get(key, ())}):
+            if leaders[leader][1] != parent_id and jaccard(signature, leaders[leader][2]) >= min_jaccard:
+                match = leader
+                break
+        if match is None and chunk_sketch is not None and sketch_rows:
+            similarities = sketches[:len(sketch_rows)].astype(np.float32) @ chunk_sketch.astype(np.float32)
+            for row in np.argsort(-similarities):
+                if similarities[row] < min_cosine:
+                    break
+                if leaders[sketch_rows[row]][1] != parent_id:
+                    match = sketch_rows[row]
+                    break
+
+        if match is not None:
+            clusters[chunk_id] = leaders[match][0]
+            continue
+        clusters[chunk_id] = chunk_id
+        leaders.append((chunk_id, parent_id, signature))
+        for key in keys:
+            buckets.setdefault(key, []).append(len(leaders) - 1)
+        if chunk_sketch is not None:
+            if sketches is None:
+                sketches = np.zeros((len(chunks), len(chunk_sketch)), dtype=np.float16)
+            sketches[len(sketch_rows)] = chunk_sketch
+            sketch_rows.append(len(leaders) - 1)
+    return clusters
+
+
+def one_per_cluster(hits: Iterable[Dict]) -> List[Dict]:
+    """Keep the best-ranked hit of each cluster (hits without a clusterId are their own cluster)"""
+    seen = set()
+    kept = []
+    for hit in hits:
+        cluster_id = hit.get("clusterId") or hit.get("id")
+        if cluster_id in seen:
+            continue
+        seen.add(cluster_id)
+        kept.append(hit)
+    return kept
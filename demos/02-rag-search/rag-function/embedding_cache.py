@@ -0,0 +1,209 @@
+"""Content-addressed, size-bounded on-disk embedding cache
+
+Shared by the RAG function and ingest-kb.py. Entries are keyed by
+(embedding deployment, dimension, normalized text) and stored as float32
+blobs in SQLite; the least recently used entries are evicted once the cache
+grows past `max_entries`.
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unicodedata
+from array import array
+from typing import List, Optional, Sequence, Tuple
+
+DEFAULT_CACHE_PATH = os.path.join(tempfile.gettempdir(), "rag-embedding-cache.sqlite3")
+DEFAULT_MAX_ENTRIES = 10000
+
+
+def normalize_text(text: str) -> str:
+    """Normalize unicode and whitespace so trivially different inputs share one entry"""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def cache_key(model: str, dimensions: int, text: str) -> str:
+    payload = f"{model}\x00{dimensions}\x00{normalize_text(text)}"
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """SQLite-backed embedding cache with LRU eviction (safe to share between threads)"""
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, model TEXT NOT NULL, dimensions INTEGER NOT NULL, "
+            "vector BLOB NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_access ON embeddings(last_access)")
+
+    @classmethod
+    def from_env(cls, default_path: str = DEFAULT_CACHE_PATH) -> Optional["EmbeddingCache"]:
+        """Build the cache from EMBEDDING_CACHE_PATH / EMBEDDING_CACHE_MAX_ENTRIES (0 disables it)"""
+        max_entries = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", str(DEFAULT_MAX_ENTRIES)))
+        if max_entries <= 0:
+            return None
+        path = os.getenv("EMBEDDING_CACHE_PATH") or default_path
+        try:
+            return cls(path, max_entries)
+        except sqlite3.Error as e:
+            # A broken cache must never take the caller down with it
+            logging.warning(f"Embedding cache disabled, could not open {path}: {e}")
+            return None
+
+    def get_many(self, model: str, dimensions: int, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        """Return the cached vector for each text, or None where there is no entry"""
+        keys = [cache_key(model, dimensions, text) for text in texts]
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                found.update(rows)
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                    [(now, key) for key in found]
+                )
+            hits = sum(1 for key in keys if key in found)
+            self.hits += hits
+            self.misses += len(keys) - hits
+
+        vectors = []
+        for key in keys:
+            blob = found.get(key)
+            if blob is None:
+                vectors.append(None)
+                continue
+            vector = array("f")
+            vector.frombytes(blob)
+            vectors.append(vector.tolist())
+        return vectors
+
+    def put_many(self, model: str, dimensions: int, texts: Sequence[str], vectors: Sequence[Sequence[float]]):
+        now = time.time()
+        rows = [
+            (cache_key(model, dimensions, text), model, dimensions, array("f", vector).tobytes(), now)
+            for text, vector in zip(texts, vectors)
+        ]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, model, dimensions, vector, last_access) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            self._evict()
+
+    def _evict(self):
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM embeddings WHERE key IN "
+                "(SELECT key FROM embeddings ORDER BY last_access ASC LIMIT ?)",
+                (overflow,)
+            )
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM embeddings")
+
+
+def _cached_vectors(cache, model, dimensions, texts):
+    if cache:
+        try:
+            return cache.get_many(model, dimensions, texts)
+        except sqlite3.Error as e:
+            logging.warning(f"Embedding cache read failed: {e}")
+    return [None] * len(texts)
+
+
+def _fill_vectors(cache, model, dimensions, texts, vectors, missing, response) -> int:
+    """Copy API results into `vectors`, write them to the cache and return the tokens billed"""
+    # Results carry their input index; don't rely on response ordering
+    for item in response.data:
+        vectors[missing[item.index]] = item.embedding
+
+    if cache:
+        try:
+            cache.put_many(model, dimensions, [texts[i] for i in missing], [vectors[i] for i in missing])
+        except sqlite3.Error as e:
+            logging.warning(f"Embedding cache write failed: {e}")
+
+    usage = getattr(response, "usage", None)
+    return getattr(usage, "total_tokens", 0) if usage else 0
+
+
+def embed_texts(
+    openai_client,
+    model: str,
+    dimensions: int,
+    texts: Sequence[str],
+    cache: Optional[EmbeddingCache] = None,
+    request_dimensions: bool = False,
+    **create_kwargs
+) -> Tuple[List[List[float]], int, int]:
+    """Embed texts, serving what we can from the cache and fetching the rest in one request
+
+    With `request_dimensions`, the API is asked for `dimensions`-long vectors
+    (text-embedding-3 models shorten them Matryoshka-style). Returns
+    (vectors, tokens billed, cache hits).
+    """
+    vectors = _cached_vectors(cache, model, dimensions, texts)
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    tokens = 0
+
+    if request_dimensions:
+        create_kwargs["dimensions"] = dimensions
+    if missing:
+        response = openai_client.embeddings.create(
+            model=model,
+            input=[texts[i] for i in missing],
+            **create_kwargs
+        )
+        tokens = _fill_vectors(cache, model, dimensions, texts, vectors, missing, response)
+
+    return vectors, tokens, len(texts) - len(missing)
+
+
+async def aembed_texts(
+    openai_client,
+    model: str,
+    dimensions: int,
+    texts: Sequence[str],
+    cache: Optional[EmbeddingCache] = None,
+    request_dimensions: bool = False,
+    **create_kwargs
+) -> Tuple[List[List[float]], int, int]:
+    """Async variant of `embed_texts` for `AsyncAzureOpenAI` clients"""
+    vectors = _cached_vectors(cache, model, dimensions, texts)
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    tokens = 0
+
+    if request_dimensions:
+        create_kwargs["dimensions"] = dimensions
+    if missing:
+        response = await openai_client.embeddings.create(
+            model=model,
+            input=[texts[i] for i in missing],
+            **create_kwargs
+        )
+        tokens = _fill_vectors(cache, model, dimensions, texts, vectors, missing, response)
+
+    return vectors, tokens, len(texts) - len(missing)
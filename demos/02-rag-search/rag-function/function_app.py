@@ -1,260 +1,798 @@
 import azure.functions as func
+import asyncio
+import hashlib
 import logging
 import json
 import os
-from azure.search.documents import SearchClient
-from azure.core.credentials import AzureKeyCredential
-from azure.identity import DefaultAzureCredential, get_bearer_token_provider
-from openai import AzureOpenAI
+import time
+from typing import Optional
+
+import numpy as np
+from answer_cache import SemanticAnswerCache
+from chunking import collapse_to_parents
+from clients import get_openai_client, get_search_backend, start_background_imports, warm_up
+from coalescing import RequestCoalescer
+from context_packing import pack_context
+from dedup import one_per_cluster
+from embedding_cache import EmbeddingCache, aembed_texts, normalize_text
+from resilience import CircuitOpenError, is_retryable
+from tracing import RequestTrace
+
+# HTTP streaming (server-sent events) needs the FastAPI extension; without it the stream route buffers
+try:
+    from azurefunctions.extensions.http.fastapi import Request, StreamingResponse
+    HTTP_STREAMING = True
+except ImportError:
+    HTTP_STREAMING = False
 
 app = func.FunctionApp()
 
-# KB article title to filename mapping for source URLs
-# Note: Titles must match what Azure AI Search returns (may differ from H1 in markdown)
-KB_ARTICLE_MAPPING = {
-    "Password Reset": "password-reset.md",
-    "Comprehensive Password Recovery and Reset Guide": "password-recovery-detailed.md",
-    "Account Access and Authentication Guide": "account-access-guide.md",
-    "Account Lockout and Access Issues Resolution Guide": "account-lockout-guide.md",
-    "VPN Connection Guide": "vpn-troubleshooting.md",
-    "Complete VPN Connection and Troubleshooting Guide": "vpn-comprehensive-guide.md",
-    "Billing and Payments": "billing-guide.md",
-    "Duplicate Charges and Double Billing Resolution Guide": "duplicate-charges-guide.md",
-    "Invoice Payment and Billing Updates Guide": "invoice-payment.md",
-    "Email and Calendar Support": "email-and-calendar.md",
-    "Software Installation and Update Guide": "software-installation-guide.md"
-}
+# Support categories of the triage taxonomy (demos/01-triage-promptflow); ingest-kb.py tags every article with one
+CATEGORIES = ["Billing", "Technical", "Account", "Access"]
+
+# Service clients
+# The OpenAI / Search clients (and the packages behind them) are created on first use, not at import, so a
+# cold start doesn't pay for them before the worker is ready; see clients.py. They are then shared by every
+# invocation, so their HTTP connection pools stay warm and one worker can serve many questions at once.
+# Retrieval runs against Azure AI Search, or offline against a local index (RAG_SEARCH_BACKEND=local).
+start_background_imports()
+
+embedding_deployment = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT", "text-embedding-3-large")
+chat_deployment = os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT", "gpt-5-1-chat")
+embedding_dimensions = int(os.getenv("AZURE_OPENAI_EMBEDDING_DIMENSIONS", "3072"))
+# Must match the index: shortened vectors are requested only when a size is configured (as in ingest-kb.py)
+request_dimensions = bool(os.getenv("AZURE_OPENAI_EMBEDDING_DIMENSIONS"))
+
+# Repeated questions skip the embedding round trip entirely
+embedding_cache = EmbeddingCache.from_env()
+
+# The index stores heading-aware chunks; this caps how many chunks of one article reach the prompt
+max_chunks_per_parent = int(os.getenv("RAG_MAX_CHUNKS_PER_PARENT", "3"))
+
+# Prompt context is packed into a fixed token budget so prompt size doesn't depend on which articles match
+context_token_budget = int(os.getenv("RAG_CONTEXT_TOKEN_BUDGET", "1500"))
+context_max_documents = int(os.getenv("RAG_CONTEXT_MAX_DOCUMENTS", "3"))
+
+# Retrieval starts shallow and widens only when the first pass is ambiguous (too few articles or low confidence);
+# results come back without their content, which is fetched only for the chunks that reach the prompt
+search_top = int(os.getenv("RAG_SEARCH_TOP", "10"))
+search_max_top = int(os.getenv("RAG_SEARCH_MAX_TOP", "50"))
+search_widen_below_confidence = float(os.getenv("RAG_SEARCH_WIDEN_BELOW_CONFIDENCE", "0.6"))
+# A category-filtered search that finds nothing this confident is rerun without the filter
+category_fallback_below_confidence = float(os.getenv("RAG_CATEGORY_FALLBACK_BELOW_CONFIDENCE", "0.3"))
+# clusterId groups near-duplicate chunks (see dedup.py); only the best-ranked chunk of each cluster is kept
+SEARCH_FIELDS = ["id", "parentId", "chunkIndex", "title", "sectionPath", "sourceUrl", "clusterId"]
+
+# Near-identical questions are answered from memory without search or chat completion
+answer_cache = SemanticAnswerCache.from_env()
+# Every worker reads the index generation at most this often and drops its cached answers once it changes, so a
+# re-ingest reaches all workers, not just the one that receives the invalidate call
+answer_cache_generation_check_seconds = float(os.getenv("RAG_ANSWER_CACHE_GENERATION_CHECK_SECONDS", "30"))
+_next_generation_check = 0.0
+
+# Identical questions in flight at the same time share one embed/search/answer run (per worker, or per host
+# with RAG_COALESCE_STORE_PATH); see coalescing.py
+coalescer = RequestCoalescer.from_env()
+
+# Batch route: size limit, questions answered in parallel, and the similarity at which two questions share an answer
+batch_max_questions = int(os.getenv("RAG_BATCH_MAX_QUESTIONS", "20"))
+batch_concurrency = int(os.getenv("RAG_BATCH_CONCURRENCY", "5"))
+batch_duplicate_threshold = float(
+    os.getenv("RAG_BATCH_DUPLICATE_THRESHOLD", os.getenv("RAG_ANSWER_CACHE_THRESHOLD", "0.95"))
+)
 
-# Base URL for KB articles in GitHub
-GITHUB_REPO_BASE = "https://github.com/LuiseFreese/espc25-smart-support-agent/blob/main/demos/02-rag-search/content"
-
-def get_source_url(title: str) -> str:
-    """Map KB article title to GitHub URL"""
-    filename = KB_ARTICLE_MAPPING.get(title)
-    if filename:
-        return f"{GITHUB_REPO_BASE}/{filename}"
-    return ""  # Return empty string instead of None for OpenAPI 2.0 compatibility
-
-# Initialize clients
-search_endpoint = os.getenv("AZURE_AI_SEARCH_ENDPOINT")
-search_key = os.getenv("AZURE_AI_SEARCH_API_KEY")
-index_name = os.getenv("AZURE_AI_SEARCH_INDEX", "kb-support")
-openai_api_key = os.getenv("AZURE_OPENAI_API_KEY")
-
-# Use API key if provided, otherwise fall back to Managed Identity
-if openai_api_key:
-    openai_client = AzureOpenAI(
-        api_key=openai_api_key,
-        api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-08-01-preview"),
-        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
-    )
-else:
-    credential = DefaultAzureCredential()
-    token_provider = get_bearer_token_provider(credential, "https://cognitiveservices.azure.com/.default")
-    openai_client = AzureOpenAI(
-        azure_ad_token_provider=token_provider,
-        api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-08-01-preview"),
-        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
-    )
+SYSTEM_PROMPT = """You are a helpful IT support assistant. Use the knowledge base context below to answer questions.
 
-search_client = SearchClient(
-    search_endpoint,
-    index_name,
-    AzureKeyCredential(search_key)
-)
+Context from knowledge base:
+{context_text}
 
-@app.route(route="rag-search", auth_level=func.AuthLevel.ANONYMOUS)
-def rag_search(req: func.HttpRequest) -> func.HttpResponse:
-    """RAG Search endpoint"""
-    logging.info('Python HTTP trigger function processed a request.')
+Answer concisely based on the context above. If the context doesn't contain the answer, say so."""
 
-    try:
-        req_body = req.get_json()
-        question = req_body.get('question')
+NO_RESULTS_PAYLOAD = {
+    "answer": "I couldn't find relevant information in the knowledge base.",
+    "confidence": 0.1,
+    "sources": []
+}
 
-        if not question:
-            return func.HttpResponse(
-                json.dumps({"error": "Missing 'question' in request body"}),
-                mimetype="application/json",
-                status_code=400
-            )
+# When the chat deployment is down (circuit open, or still failing after retries) the caller gets the articles
+# retrieval found instead of an error
+RETRIEVAL_ONLY_ANSWER = (
+    "The assistant is temporarily unavailable, but these knowledge base articles match your question: {titles}."
+)
 
-        logging.info(f"Processing question: {question}")
 
-        # Generate embedding for the question
-        embedding_deployment = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT", "text-embedding-3-large")
-        embedding_response = openai_client.embeddings.create(
-            input=question,
-            model=embedding_deployment
-        )
-        question_embedding = embedding_response.data[0].embedding
-        logging.info(f"Generated embedding with {len(question_embedding)} dimensions")
-
-        # Perform semantic search with vector + text hybrid
-        # Note: Using both vector and semantic together
-        results = search_client.search(
-            search_text=question,
-            vector_queries=[{
-                "kind": "vector",
-                "vector": question_embedding,
-                "fields": "contentVector",
-                "k": 50  # Increased for better RRF fusion
-            }],
-            query_type="semantic",  # SEMANTIC RANKING ENABLED
-            semantic_configuration_name="semantic-config",
-            top=50,
-            select=["title", "content"]  # Don't include @ fields in select
-        )
+def chat_unavailable(error: Exception) -> bool:
+    """True for errors that mean the chat deployment can't answer right now, not that the request was bad"""
+    return isinstance(error, CircuitOpenError) or is_retryable(error)
 
-        # Extract results
-        contexts = []
-        sources = []
-        scores = []
-
-        logging.info("━━━━━━━━━ SEARCH RESULTS DEBUG ━━━━━━━━━")
-
-        for result in results:
-            # Debug: log result type and all available keys
-            logging.info(f"\nResult type: {type(result)}")
-            logging.info(f"All result keys: {list(result.keys())}")
-            logging.info(f"Result object attributes: {dir(result)}")
-            logging.info(f"Result type: {type(result)}")
-            logging.info(f"All result keys: {list(result.keys())}")
-
-            contexts.append({
-                "title": result.get("title", ""),
-                "content": result.get("content", "")
-            })
-            sources.append(result.get("title", "Unknown"))
-
-            # Get semantic reranker score (SDK uses underscore, not camelCase!)
-            # Method 1: Dict-style access - CORRECT KEY with underscore
-            reranker_score = result.get("@search.reranker_score")
-            # Method 2: Attribute-style access (alternative)
-            if reranker_score is None:
-                reranker_score = getattr(result, 'reranker_score', None)
-
-            hybrid_score = result.get("@search.score", 0)
-
-            logging.info(f"Document: '{result.get('title')}'")
-            logging.info(f"  @search.reranker_score: {reranker_score}")
-            logging.info(f"  @search.score: {hybrid_score}")
-
-            # Prioritize semantic reranker score if available
-            if reranker_score is not None and reranker_score > 0:
-                scores.append(("semantic", reranker_score))
-                logging.info(f"  ✅ Using SEMANTIC score: {reranker_score}")
-            else:
-                scores.append(("hybrid", hybrid_score))
-                logging.info(f"  ⚠️ Using HYBRID score: {hybrid_score}")
-
-        logging.info("━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━")
-
-        if not contexts:
-            return func.HttpResponse(
-                json.dumps({
-                    "answer": "I couldn't find relevant information in the knowledge base.",
-                    "confidence": 0.1,
-                    "sources": []
-                }),
-                mimetype="application/json",
-                status_code=200
-            )
 
-        # Build context for LLM
-        context_text = "\n\n".join([
-            f"**{ctx['title']}**\n{ctx['content']}"
-            for ctx in contexts[:3]  # Top 3 results
-        ])
-
-        # Generate answer using GPT
-        chat_deployment = os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT", "gpt-5-1-chat")
-        chat_response = openai_client.chat.completions.create(
-            model=chat_deployment,
-            messages=[
-                {
-                    "role": "system",
-                    "content": f"""You are a helpful IT support assistant. Use the knowledge base context below to answer questions.
+def retrieval_only_payload(metadata: dict, trace: RequestTrace, error: Exception) -> dict:
+    logging.warning(f"Chat completion unavailable, answering with retrieval results only: {str(error)}")
+    trace.set(llmError=str(error)[:200])
+    return {"answer": RETRIEVAL_ONLY_ANSWER.format(titles="; ".join(metadata["sources"])), **metadata, "degraded": True}
 
-Context from knowledge base:
-{context_text}
 
-Answer concisely based on the context above. If the context doesn't contain the answer, say so."""
-                },
-                {
-                    "role": "user",
-                    "content": question
-                }
-            ],
-            max_completion_tokens=500
+async def embed_question(question: str, trace: RequestTrace) -> list:
+    """Embed the question (served from the on-disk cache when seen before)"""
+    with trace.span("embed"):
+        vectors, _, cache_hits = await aembed_texts(
+            get_openai_client(),
+            embedding_deployment,
+            embedding_dimensions,
+            [question],
+            cache=embedding_cache,
+            request_dimensions=request_dimensions
         )
+    trace.set(embeddingCacheHit=bool(cache_hits))
+    return vectors[0]
+
+
+async def search_knowledge_base(
+    question: str,
+    question_embedding: list,
+    trace: RequestTrace,
+    category: Optional[str] = None
+):
+    """Run the hybrid (+ semantic, on Azure AI Search) search; returns (chunk hits, [(score type, score)])
+
+    With a category only that category's articles are searched, unless that finds nothing with at least
+    `category_fallback_below_confidence`: triage categories are a guess, so the whole knowledge base is searched
+    instead. Hits carry no content yet; `build_context` fetches it for the chunks it uses.
+    """
+    hits, scores = await search_pass(question, question_embedding, trace, category)
+    if category and score_confidence(scores) < category_fallback_below_confidence:
+        trace.reset_results()
+        trace.set(categoryFallback=True)
+        hits, scores = await search_pass(question, question_embedding, trace)
+    return hits, scores
+
+
+async def search_pass(
+    question: str,
+    question_embedding: list,
+    trace: RequestTrace,
+    category: Optional[str] = None
+):
+    """One search, widened once to `search_max_top` when the shallow pass is ambiguous"""
+    top = search_top
+    while True:
+        with trace.span("search"):
+            results = await get_search_backend().search(
+                question, question_embedding, top=top, select=SEARCH_FIELDS, category=category
+            )
+        with trace.span("materialize"):
+            distinct = one_per_cluster(results)
+            hits, scores = materialize_results(distinct, trace)
+
+        if top >= search_max_top or len(results) < top or not is_ambiguous(hits, scores):
+            trace.set(searchTop=top, widened=top > search_top, duplicateHits=len(results) - len(distinct))
+            return hits, scores
+        # Widen once to the full depth; the deeper pass replaces the first one
+        top = search_max_top
+        trace.reset_results()
+
+
+def is_ambiguous(hits: list, scores: list) -> bool:
+    """A shallow pass is enough when it fills the context with distinct articles and scores confidently"""
+    articles = {hit["parentId"] or hit["id"] for hit in hits}
+    if len(articles) < context_max_documents:
+        return True
+    threshold = search_widen_below_confidence
+    if not any(score_type == "semantic" for score_type, _ in scores):
+        # Hybrid-only confidence tops out at 0.5 (best chunk near the top of both keyword and vector lists)
+        threshold = min(threshold, 0.5)
+    return score_confidence(scores) < threshold
+
+
+def materialize_results(results: list, trace: RequestTrace):
+    """Turn raw search results into chunk hits and their (score type, score)"""
+    # Extract results (one hit per chunk, collapsed to parent articles later)
+    hits = []
+    scores = []
+
+    for result in results:
+        # Get semantic reranker score (SDK uses underscore, not camelCase!)
+        # Method 1: Dict-style access - CORRECT KEY with underscore
+        reranker_score = result.get("@search.reranker_score")
+        # Method 2: Attribute-style access (alternative)
+        if reranker_score is None:
+            reranker_score = getattr(result, 'reranker_score', None)
+
+        hybrid_score = result.get("@search.score", 0)
+
+        # Prioritize semantic reranker score if available
+        if reranker_score is not None and reranker_score > 0:
+            scores.append(("semantic", reranker_score))
+        else:
+            scores.append(("hybrid", hybrid_score))
+        # One summary record per request; per-document details only with RAG_DEBUG_RESULTS
+        trace.add_result(result, *scores[-1])
+
+        hits.append({
+            "id": result.get("id"),
+            "parentId": result.get("parentId"),
+            "chunkIndex": result.get("chunkIndex"),
+            "title": result.get("title", ""),
+            "sectionPath": result.get("sectionPath", ""),
+            "sourceUrl": result.get("sourceUrl") or "",
+            "content": result.get("content"),
+            "score": scores[-1][1]
+        })
+
+    return hits, scores
+
+
+async def build_context(hits: list, trace: RequestTrace):
+    """Collapse chunk hits into articles and pack the prompt context; returns (articles, context text)"""
+    contexts = collapse_to_parents(hits, max_chunks_per_parent)
+
+    # Only the chunks of articles that can reach the prompt need their content
+    selected = contexts[:context_max_documents]
+    missing = [chunk["id"] for ctx in selected for chunk in ctx["chunks"] if chunk.get("content") is None]
+    if missing:
+        with trace.span("fetch"):
+            contents = await get_search_backend().get_contents(missing)
+        for hit in hits:
+            if hit["id"] in contents:
+                hit["content"] = contents[hit["id"]]
+        trace.set(contentFetched=len(contents))
+        selected = collapse_to_parents([hit for hit in hits if hit.get("content") is not None], max_chunks_per_parent)
+
+    with trace.span("context"):
+        # Best articles first, trimmed at section boundaries, repeats removed
+        packed = pack_context(selected, context_token_budget, context_max_documents)
+    trace.set(
+        articles=len(contexts),
+        packedTokens=packed.tokens,
+        packedArticles=len(packed.titles),
+        packedTrimmed=packed.trimmed,
+        duplicatePassagesSkipped=packed.duplicates_skipped
+    )
+    return contexts, packed.text
+
+
+def answer_metadata(contexts: list, scores: list, trace: RequestTrace) -> dict:
+    """Confidence, source titles and the primary article's URL (stored with each chunk by ingest-kb.py)"""
+    with trace.span("confidence"):
+        confidence = score_confidence(scores)
+    sources = [ctx["title"] or "Unknown" for ctx in contexts]
+    metadata = {
+        "confidence": round(confidence, 2),
+        "sources": list(set(sources[:5])),
+        # Empty string instead of None for OpenAPI 2.0 compatibility
+        "sourceUrl": contexts[0]["sourceUrl"] if contexts else ""
+    }
+    trace.set(confidence=metadata["confidence"])
+    return metadata
+
+
+def build_messages(question: str, context_text: str) -> list:
+    return [
+        {
+            "role": "system",
+            "content": SYSTEM_PROMPT.format(context_text=context_text)
+        },
+        {
+            "role": "user",
+            "content": question
+        }
+    ]
+
+
+def score_confidence(scores: list) -> float:
+    """Calculate confidence with proper thresholding for semantic vs hybrid scores"""
+    if not scores:
+        return 0.1
+
+    # Separate semantic and hybrid scores
+    semantic_scores = [score for score_type, score in scores if score_type == "semantic"]
+    hybrid_scores = [score for score_type, score in scores if score_type == "hybrid"]
+
+    if semantic_scores:
+        # We have semantic reranker scores (0-4 range)
+        best = max(semantic_scores)
+
+        # Map 0-4 range into confidence bands
+        if best >= 3.5:
+            return 0.9
+        elif best >= 3.0:
+            return 0.8
+        elif best >= 2.0:
+            return 0.6
+        elif best >= 1.0:
+            return 0.4
+        return 0.2
+
+    # Only BM25/hybrid scores (typical range: 0.01-0.05)
+    # Do NOT treat them as normalized 0-1 values!
+    best = max(hybrid_scores) if hybrid_scores else 0.0
+
+    # Use thresholding based on actual BM25 score ranges
+    if best >= 0.1:
+        return 0.7
+    elif best >= 0.03:
+        return 0.5
+    elif best > 0:
+        return 0.3
+    return 0.1
+
+
+def parse_category(value) -> Optional[str]:
+    """Normalize an optional support category ("billing" -> "Billing"); ValueError if it isn't one of CATEGORIES"""
+    if value is None or value == "":
+        return None
+    category = {c.lower(): c for c in CATEGORIES}.get(str(value).strip().lower())
+    if category is None:
+        raise ValueError(f"'category' must be one of {', '.join(CATEGORIES)}")
+    return category
+
+
+def bad_request(error: str) -> func.HttpResponse:
+    return func.HttpResponse(json.dumps({"error": error}), mimetype="application/json", status_code=400)
+
+
+def parse_question(req: func.HttpRequest):
+    """Return (question, category, None) or (None, None, 400 response)
+
+    `category` (optional, e.g. the triage result) restricts retrieval to that support category.
+    """
+    req_body = req.get_json()
+    question = req_body.get('question')
+    if not question:
+        return None, None, bad_request("Missing 'question' in request body")
+    try:
+        return question, parse_category(req_body.get("category")), None
+    except ValueError as e:
+        return None, None, bad_request(str(e))
+
 
-        answer = chat_response.choices[0].message.content
-
-        # Calculate confidence with proper thresholding for semantic vs hybrid scores
-        if scores:
-            # Separate semantic and hybrid scores
-            semantic_scores = [score for score_type, score in scores if score_type == "semantic"]
-            hybrid_scores = [score for score_type, score in scores if score_type == "hybrid"]
-
-            logging.info(f"Semantic scores: {semantic_scores}")
-            logging.info(f"Hybrid scores: {hybrid_scores}")
-
-            if semantic_scores:
-                # We have semantic reranker scores (0-4 range)
-                best = max(semantic_scores)
-                logging.info(f"Best semantic score: {best}")
-
-                # Map 0-4 range into confidence bands
-                if best >= 3.5:
-                    confidence = 0.9
-                elif best >= 3.0:
-                    confidence = 0.8
-                elif best >= 2.0:
-                    confidence = 0.6
-                elif best >= 1.0:
-                    confidence = 0.4
-                else:
-                    confidence = 0.2
-            else:
-                # Only BM25/hybrid scores (typical range: 0.01-0.05)
-                # Do NOT treat them as normalized 0-1 values!
-                best = max(hybrid_scores) if hybrid_scores else 0.0
-                logging.info(f"Best hybrid score: {best}")
-
-                # Use thresholding based on actual BM25 score ranges
-                if best >= 0.1:
-                    confidence = 0.7
-                elif best >= 0.03:
-                    confidence = 0.5
-                elif best > 0:
-                    confidence = 0.3
-                else:
-                    confidence = 0.1
+def wants_debug(req: func.HttpRequest) -> bool:
+    """`"debug": true` in the request body adds per-stage timings to the response"""
+    try:
+        return bool(req.get_json().get("debug"))
+    except ValueError:
+        return False
+
+
+async def check_index_generation(trace: RequestTrace) -> Optional[str]:
+    """Drop cached answers if the index changed since the last check; returns the generation answers are stored under"""
+    global _next_generation_check
+    now = time.monotonic()
+    if now >= _next_generation_check:
+        _next_generation_check = now + answer_cache_generation_check_seconds  # concurrent requests don't all check
+        try:
+            with trace.span("generation"):
+                generation = await get_search_backend().get_generation()
+        except Exception as e:
+            logging.warning(f"Could not read the index generation, keeping cached answers: {str(e)}")
         else:
-            confidence = 0.1
+            dropped = answer_cache.set_generation(generation)
+            if dropped:
+                logging.info(f"Index generation changed to {generation}, dropped {dropped} cached answers")
+                trace.set(answerCacheInvalidated=dropped)
+    return answer_cache.generation
+
+
+async def answer_question(
+    question: str,
+    question_embedding: list,
+    trace: RequestTrace,
+    category: Optional[str] = None
+):
+    """Answer one embedded question; returns (payload, outcome)
+
+    outcome is answer_cache_hit, no_results, answered, or retrieval_only when the chat deployment is unavailable.
+    """
+    if category:
+        trace.set(category=category)
+    generation = None
+    if answer_cache is not None:
+        generation = await check_index_generation(trace)
+        with trace.span("answer_cache"):
+            cached = answer_cache.lookup(question_embedding, scope=category or "")
+        if cached is not None:
+            trace.set(answerCacheSimilarity=round(cached.pop("similarity"), 4))
+            return cached, "answer_cache_hit"
+
+    hits, scores = await search_knowledge_base(question, question_embedding, trace, category)
+
+    if not hits:
+        return dict(NO_RESULTS_PAYLOAD), "no_results"
+
+    contexts, context_text = await build_context(hits, trace)
+    metadata = answer_metadata(contexts, scores, trace)
+
+    # Generate answer using GPT
+    try:
+        with trace.span("llm"):
+            chat_response = await get_openai_client().chat.completions.create(
+                model=chat_deployment,
+                messages=build_messages(question, context_text),
+                max_completion_tokens=500
+            )
+    except Exception as e:
+        if not chat_unavailable(e):
+            raise
+        # Not cached: the next request should get a real answer once the deployment recovers
+        return retrieval_only_payload(metadata, trace, e), "retrieval_only"
+
+    payload = {"answer": chat_response.choices[0].message.content, **metadata}
+    if answer_cache is not None:
+        answer_cache.store(question, question_embedding, payload, scope=category or "", generation=generation)
+
+    return payload, "answered"
+
+
+async def coalesce(question: str, category: Optional[str], trace: RequestTrace, pipeline):
+    """Run pipeline() -> (payload, outcome) once for every concurrent request with the same question and category
+
+    Returns (payload, outcome, coalesced); coalesced is True when another request's run produced the answer.
+    A coalesced request's trace gets a `coalesced` stage (the time it waited) and the stage timings of the
+    request that ran the pipeline (`leaderStagesMs`), so it doesn't look free in traces.
+    """
+    if coalescer is None:
+        payload, outcome = await pipeline()
+        return payload, outcome, False
+
+    async def flight():
+        payload, outcome = await pipeline()
+        return payload, outcome, trace.timings()  # `trace` is the leader's: only the first caller's flight runs
+
+    key = hashlib.sha256(f"{category or ''}\x00{normalize_text(question).casefold()}".encode("utf-8")).hexdigest()
+    started = time.perf_counter()
+    (payload, outcome, leader_timings), coalesced = await coalescer.run(key, flight)
+    if coalesced:
+        trace.record("coalesced", (time.perf_counter() - started) * 1000)
+        trace.set(coalesced=True, leaderStagesMs=leader_timings)
+    return payload, outcome, coalesced
+
+
+ANSWER_CACHE_HEADERS = {
+    "answer_cache_hit": {"X-Answer-Cache": "hit"},
+    "answered": {"X-Answer-Cache": "miss"},
+    "retrieval_only": {"X-Answer-Cache": "miss", "X-Answer-Mode": "retrieval-only"}
+}
 
-        logging.info(f"Final confidence: {confidence}")
 
-        # Get URL for primary source
-        primary_source = sources[0] if sources else None
-        source_url = get_source_url(primary_source) if primary_source else ""
+@app.route(route="rag-search", auth_level=func.AuthLevel.ANONYMOUS)
+async def rag_search(req: func.HttpRequest) -> func.HttpResponse:
+    """RAG Search endpoint"""
+    trace = RequestTrace("rag-search")
 
+    try:
+        with trace.span("warmup"):
+            warm_up()  # first request: creates the clients and starts the token fetch while we parse
+        with trace.span("parse"):
+            question, category, error_response = parse_question(req)
+            debug = wants_debug(req)
+        if error_response:
+            trace.emit("bad_request")
+            return error_response
+
+        trace.set(question=question[:200])
+
+        async def pipeline():
+            question_embedding = await embed_question(question, trace)
+            return await answer_question(question, question_embedding, trace, category)
+
+        payload, outcome, coalesced = await coalesce(question, category, trace, pipeline)
+
+        trace.emit(outcome)
+        if debug:
+            payload = dict(payload, timings=trace.timings())
+            if coalesced:
+                payload["leaderTimings"] = trace.fields["leaderStagesMs"]
+        headers = dict(ANSWER_CACHE_HEADERS.get(outcome, {}), **{"Server-Timing": trace.server_timing()})
+        if coalesced:
+            headers["X-Coalesced"] = "true"
         return func.HttpResponse(
-            json.dumps({
-                "answer": answer,
-                "confidence": round(confidence, 2),
-                "sources": list(set(sources[:5])),
-                "sourceUrl": source_url
-            }),
+            json.dumps(payload),
             mimetype="application/json",
+            headers=headers,
             status_code=200
         )
 
     except Exception as e:
         logging.error(f"Error in RAG search: {str(e)}", exc_info=True)
+        trace.set(error=str(e)[:200])
+        trace.emit("error", level=logging.ERROR)
+        return func.HttpResponse(
+            json.dumps({"error": f"Internal server error: {str(e)}"}),
+            mimetype="application/json",
+            status_code=500
+        )
+
+
+def parse_questions(req: func.HttpRequest):
+    """Return (questions, category, None) or (None, None, 400 response) for a batch request
+
+    The optional `category` applies to every question in the batch.
+    """
+    try:
+        body = req.get_json()
+    except ValueError:
+        body = {}
+    questions = body.get("questions")
+    error = None
+    if not isinstance(questions, list) or not questions:
+        error = "Expected a non-empty 'questions' array in request body"
+    elif not all(isinstance(question, str) and question.strip() for question in questions):
+        error = "Every entry in 'questions' must be a non-empty string"
+    elif len(questions) > batch_max_questions:
+        error = f"At most {batch_max_questions} questions per batch"
+    if error:
+        return None, None, bad_request(error)
+    try:
+        return questions, parse_category(body.get("category")), None
+    except ValueError as e:
+        return None, None, bad_request(str(e))
+
+
+def group_duplicates(vectors: list) -> list:
+    """Map each question to the first question it (nearly) repeats: identical vectors or cosine >= threshold"""
+    matrix = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    similarities = (matrix / norms) @ (matrix / norms).T
+
+    representatives = []
+    for row in range(len(vectors)):
+        earlier = [rep for rep in set(representatives) if similarities[row, rep] >= batch_duplicate_threshold]
+        representatives.append(min(earlier) if earlier else row)
+    return representatives
+
+
+@app.route(route="rag-search/batch", methods=["POST"], auth_level=func.AuthLevel.ANONYMOUS)
+async def rag_search_batch(req: func.HttpRequest) -> func.HttpResponse:
+    """Answer several questions at once: one embeddings request, concurrent searches, per-question results"""
+    trace = RequestTrace("rag-search/batch")
+
+    with trace.span("warmup"):
+        warm_up()
+    questions, category, error_response = parse_questions(req)
+    if error_response:
+        trace.emit("bad_request")
+        return error_response
+
+    # Identical questions (after whitespace/case/unicode normalization) are embedded and answered once
+    unique_questions = []
+    question_rows = []
+    rows_by_text = {}
+    for question in questions:
+        key = normalize_text(question).casefold()
+        if key not in rows_by_text:
+            rows_by_text[key] = len(unique_questions)
+            unique_questions.append(question)
+        question_rows.append(rows_by_text[key])
+
+    try:
+        with trace.span("embed"):
+            vectors, _, cache_hits = await aembed_texts(
+                get_openai_client(),
+                embedding_deployment,
+                embedding_dimensions,
+                unique_questions,
+                cache=embedding_cache,
+                request_dimensions=request_dimensions
+            )
+    except Exception as e:
+        logging.error(f"Error embedding RAG batch: {str(e)}", exc_info=True)
+        trace.set(questions=len(questions), error=str(e)[:200])
+        trace.emit("error", level=logging.ERROR)
         return func.HttpResponse(
             json.dumps({"error": f"Internal server error: {str(e)}"}),
             mimetype="application/json",
             status_code=500
         )
+
+    # Near-identical questions share the answer of the first one in the batch
+    representatives = group_duplicates(vectors)
+    semaphore = asyncio.Semaphore(batch_concurrency)
+
+    async def answer(row: int):
+        item_trace = RequestTrace("rag-search/batch-item", question=unique_questions[row][:200])
+        async with semaphore:
+            try:
+                # Also joins a single-question request for the same question that is already in flight
+                payload, outcome, _ = await coalesce(
+                    unique_questions[row], category, item_trace,
+                    lambda: answer_question(unique_questions[row], vectors[row], item_trace, category)
+                )
+            except Exception as e:
+                logging.error(f"Error in RAG batch question: {str(e)}", exc_info=True)
+                item_trace.set(error=str(e)[:200])
+                item_trace.emit("error", level=logging.ERROR)
+                raise
+        item_trace.emit(outcome)
+        return payload
+
+    answered_rows = sorted(set(representatives))
+    with trace.span("answer"):
+        answers = dict(zip(answered_rows, await asyncio.gather(
+            *(answer(row) for row in answered_rows), return_exceptions=True
+        )))
+
+    results = []
+    first_index = {}
+    for index, question in enumerate(questions):
+        answer_row = representatives[question_rows[index]]
+        result = {"question": question}
+        if isinstance(answers[answer_row], Exception):
+            result.update(status=500, error=f"Internal server error: {str(answers[answer_row])}")
+        else:
+            result.update(answers[answer_row], status=200)
+        if first_index.setdefault(answer_row, index) != index:
+            result["duplicateOf"] = first_index[answer_row]
+        results.append(result)
+
+    failed = sum(1 for result in results if result["status"] != 200)
+    summary = {
+        "questions": len(questions),
+        "answered": len(answered_rows),
+        "duplicates": len(questions) - len(answered_rows),
+        "embeddingCacheHits": cache_hits,
+        "failed": failed
+    }
+    trace.set(**summary)
+    trace.emit("partial_failure" if failed else "answered")
+    return func.HttpResponse(
+        json.dumps({"results": results, "summary": summary}),
+        mimetype="application/json",
+        headers={"Server-Timing": trace.server_timing()},
+        # 207 Multi-Status: the per-question status fields say which ones failed
+        status_code=207 if failed else 200
+    )
+
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def rag_search_events(question: str, debug: bool = False, category: Optional[str] = None):
+    """Yield the RAG answer as server-sent events: sources first, then answer tokens as they arrive"""
+    trace = RequestTrace("rag-search/stream", question=question[:200])
+    if category:
+        trace.set(category=category)
+
+    def done_event(answer: str) -> str:
+        return sse_event("done", dict(answer=answer, timings=trace.timings()) if debug else {"answer": answer})
+
+    try:
+        question_embedding = await embed_question(question, trace)
+
+        generation = None
+        if answer_cache is not None:
+            generation = await check_index_generation(trace)
+            with trace.span("answer_cache"):
+                cached = answer_cache.lookup(question_embedding, scope=category or "")
+            if cached is not None:
+                trace.set(answerCacheSimilarity=round(cached.pop("similarity"), 4))
+                trace.emit("answer_cache_hit")
+                answer = cached.pop("answer")
+                yield sse_event("sources", dict(cached, cached=True))
+                yield sse_event("token", {"delta": answer})
+                yield done_event(answer)
+                return
+
+        hits, scores = await search_knowledge_base(question, question_embedding, trace, category)
+        if not hits:
+            trace.emit("no_results")
+            yield sse_event("sources", {key: value for key, value in NO_RESULTS_PAYLOAD.items() if key != "answer"})
+            yield sse_event("token", {"delta": NO_RESULTS_PAYLOAD["answer"]})
+            yield done_event(NO_RESULTS_PAYLOAD["answer"])
+            return
+
+        contexts, context_text = await build_context(hits, trace)
+        metadata = answer_metadata(contexts, scores, trace)
+        # Retrieval is done: the client can render sources while the answer is generated
+        yield sse_event("sources", metadata)
+
+        # Time spent waiting on the model is measured separately from time the client spends reading tokens
+        llm_wait_ms = 0.0
+        llm_started = request_started = time.perf_counter()
+        try:
+            stream = await get_openai_client().chat.completions.create(
+                model=chat_deployment,
+                messages=build_messages(question, context_text),
+                max_completion_tokens=500,
+                stream=True
+            )
+        except Exception as e:
+            if not chat_unavailable(e):
+                raise
+            # Nothing has been streamed yet, so the retrieval-only answer can still take the answer's place
+            answer = retrieval_only_payload(metadata, trace, e)["answer"]
+            trace.emit("retrieval_only")
+            yield sse_event("token", {"delta": answer, "degraded": True})
+            yield done_event(answer)
+            return
+        parts = []
+        async for chunk in stream:
+            llm_wait_ms += (time.perf_counter() - llm_started) * 1000
+            if not chunk.choices:
+                llm_started = time.perf_counter()
+                continue  # Azure sends a leading chunk with content filter results only
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if not parts:
+                    trace.record("llm_first_token", (time.perf_counter() - request_started) * 1000)
+                parts.append(delta)
+                yield sse_event("token", {"delta": delta})
+            llm_started = time.perf_counter()
+        trace.record("llm", llm_wait_ms)
+
+        answer = "".join(parts)
+        if answer_cache is not None:
+            answer_cache.store(
+                question, question_embedding, dict(metadata, answer=answer), scope=category or "", generation=generation
+            )
+        trace.emit("answered")
+        yield done_event(answer)
+
+    except Exception as e:
+        logging.error(f"Error in streaming RAG search: {str(e)}", exc_info=True)
+        trace.set(error=str(e)[:200])
+        trace.emit("error", level=logging.ERROR)
+        yield sse_event("error", {"error": f"Internal server error: {str(e)}"})
+
+
+if HTTP_STREAMING:
+    @app.route(route="rag-search/stream", methods=["POST"], auth_level=func.AuthLevel.ANONYMOUS)
+    async def rag_search_stream(req: Request) -> StreamingResponse:
+        """Streaming RAG Search endpoint (server-sent events)"""
+        warm_up()
+        try:
+            body = await req.json()
+        except ValueError:
+            body = {}
+        question, debug = body.get("question"), bool(body.get("debug"))
+        error = None if question else "Missing 'question' in request body"
+        try:
+            category = parse_category(body.get("category"))
+        except ValueError as e:
+            category, error = None, error or str(e)
+        if error:
+            return StreamingResponse(
+                iter([sse_event("error", {"error": error})]),
+                media_type="text/event-stream",
+                status_code=400
+            )
+        return StreamingResponse(
+            rag_search_events(question, debug, category),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache"}
+        )
+else:
+    @app.route(route="rag-search/stream", methods=["POST"], auth_level=func.AuthLevel.ANONYMOUS)
+    async def rag_search_stream(req: func.HttpRequest) -> func.HttpResponse:
+        """Streaming RAG Search endpoint, buffered: HTTP streaming extension not installed"""
+        warm_up()
+        try:
+            question, category, error_response = parse_question(req)
+        except ValueError:
+            question, category, error_response = None, None, None
+        if not question:
+            return error_response or func.HttpResponse(
+                json.dumps({"error": "Missing 'question' in request body"}),
+                mimetype="application/json",
+                status_code=400
+            )
+        return func.HttpResponse(
+            "".join([event async for event in rag_search_events(question, wants_debug(req), category)]),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache"},
+            status_code=200
+        )
+
+
+@app.route(route="rag-cache/invalidate", methods=["POST"], auth_level=func.AuthLevel.FUNCTION)
+def invalidate_answer_cache(req: func.HttpRequest) -> func.HttpResponse:
+    """Drop this worker's cached answers; called by ingest-kb.py after the index changed (the other workers
+    notice the new index generation within RAG_ANSWER_CACHE_GENERATION_CHECK_SECONDS)"""
+    dropped = answer_cache.invalidate() if answer_cache is not None else 0
+    logging.info(f"Answer cache invalidated ({dropped} entries dropped)")
+    return func.HttpResponse(
+        json.dumps({"invalidated": dropped}),
+        mimetype="application/json",
+        status_code=200
+    )
@@ -0,0 +1,369 @@
+"""Retries, concurrency limits, hedging and circuit breaking for Azure OpenAI calls
+
+`ResilientOpenAI(client)` is a drop-in proxy for an `AzureOpenAI` or
+`AsyncAzureOpenAI` client: `chat.completions.create` and `embeddings.create`
+go through the policy, everything else is passed through. Create the
+underlying client with `max_retries=0` so the SDK doesn't retry underneath.
+
+- Retries: 429, 5xx, timeouts and connection errors are retried with
+  full-jitter exponential backoff; a `Retry-After` / `retry-after-ms` header
+  from the service wins over the computed delay. Every call gets a timeout.
+- Concurrency: at most OPENAI_MAX_CONCURRENCY calls per deployment are in
+  flight per process (OPENAI_CONCURRENCY_LIMITS overrides it per deployment),
+  so a burst queues here instead of turning into a wall of 429s.
+- Hedging (async clients only): with OPENAI_HEDGE_AFTER_MS set, a
+  non-streaming call still running after that long is sent a second time if
+  the deployment has a free slot; the first answer wins and the other call
+  is cancelled.
+- Circuit breaker: after OPENAI_CIRCUIT_FAILURES consecutive failures
+  (5xx, timeouts, connection errors, or retries exhausted) calls to that
+  deployment raise `CircuitOpenError` immediately for
+  OPENAI_CIRCUIT_RESET_SECONDS; then one trial call decides whether it closes.
+
+Shared by the RAG function, ingest-kb.py, the manual test scripts and the
+triage demo (demos/01-triage-promptflow/triage.py), whose rate-limited retry
+loop uses `is_retryable`, `retry_after_seconds` and `ResiliencePolicy.delay`.
+"""
+import asyncio
+import inspect
+import logging
+import os
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(RuntimeError):
+    """The deployment failed repeatedly; calls are refused until the reset period has passed"""
+
+    def __init__(self, deployment: str, retry_in: float):
+        super().__init__(f"Circuit open for deployment '{deployment}' (retry in {retry_in:.0f}s)")
+        self.deployment = deployment
+        self.retry_in = retry_in
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """Read `retry-after-ms` / `retry-after` (seconds) from a failed response"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:  # an HTTP date; fall back to backoff
+        pass
+    return None
+
+
+def is_retryable(error: Exception) -> bool:
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError, ConnectionError)):
+        return True
+    try:
+        import openai
+    except ImportError:
+        return False
+    return isinstance(error, openai.APIConnectionError)  # includes APITimeoutError
+
+
+def is_throttled(error: Exception) -> bool:
+    return getattr(error, "status_code", None) == 429
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker: closed -> open (fail fast) -> half-open (one trial call) -> closed"""
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_seconds: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time.monotonic() - self.opened_at >= self.reset_seconds else "open"
+
+    def check(self):
+        """Raise CircuitOpenError unless a call may go out now"""
+        if self.failure_threshold <= 0:
+            return
+        with self._lock:
+            if self.opened_at is None:
+                return
+            waited = time.monotonic() - self.opened_at
+            if waited < self.reset_seconds or self._trial_running:
+                raise CircuitOpenError(self.name, max(self.reset_seconds - waited, 0.0))
+            self._trial_running = True
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info("Circuit for '%s' closed", self.name)
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def abandon_trial(self):
+        """The trial call ended without telling us anything (cancelled); let the next call try again"""
+        with self._lock:
+            self._trial_running = False
+
+    def record_failure(self):
+        if self.failure_threshold <= 0:
+            return
+        with self._lock:
+            self.failures += 1
+            if self._trial_running or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self._trial_running:
+                    logger.warning("Circuit for '%s' opened after %d failures", self.name, self.failures)
+                self.opened_at = time.monotonic()
+                self._trial_running = False
+
+
+def _parse_limits(value: str) -> Dict[str, int]:
+    """"gpt-5-1-chat=8,text-embedding-3-large=16" -> {deployment: limit}"""
+    limits = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        deployment, _, limit = item.partition("=")
+        limits[deployment.strip()] = int(limit)
+    return limits
+
+
+class ResiliencePolicy:
+    """Settings plus per-deployment state (breakers, semaphores, counters) shared by all calls in a process"""
+
+    def __init__(
+        self,
+        max_retries: int = 4,
+        timeout: float = 30.0,
+        base_delay: float = 0.5,
+        max_delay: float = 20.0,
+        max_concurrency: int = 16,
+        concurrency_limits: Optional[Dict[str, int]] = None,
+        hedge_after: float = 0.0,
+        circuit_failures: int = 5,
+        circuit_reset_seconds: float = 30.0
+    ):
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_concurrency = max_concurrency
+        self.concurrency_limits = concurrency_limits or {}
+        self.hedge_after = hedge_after
+        self.circuit_failures = circuit_failures
+        self.circuit_reset_seconds = circuit_reset_seconds
+        self.counters = {"calls": 0, "retries": 0, "throttled": 0, "hedges": 0, "hedgeWins": 0, "circuitRejected": 0}
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._thread_semaphores: Dict[str, threading.BoundedSemaphore] = {}
+        self._async_semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "ResiliencePolicy":
+        return cls(
+            max_retries=int(os.getenv("OPENAI_MAX_RETRIES", "4")),
+            timeout=float(os.getenv("OPENAI_TIMEOUT_SECONDS", "30")),
+            max_concurrency=int(os.getenv("OPENAI_MAX_CONCURRENCY", "16")),
+            concurrency_limits=_parse_limits(os.getenv("OPENAI_CONCURRENCY_LIMITS", "")),
+            hedge_after=float(os.getenv("OPENAI_HEDGE_AFTER_MS", "0")) / 1000,
+            circuit_failures=int(os.getenv("OPENAI_CIRCUIT_FAILURES", "5")),
+            circuit_reset_seconds=float(os.getenv("OPENAI_CIRCUIT_RESET_SECONDS", "30"))
+        )
+
+    def limit(self, deployment: str) -> int:
+        return self.concurrency_limits.get(deployment, self.max_concurrency)
+
+    def breaker(self, deployment: str) -> CircuitBreaker:
+        with self._lock:
+            if deployment not in self._breakers:
+                self._breakers[deployment] = CircuitBreaker(
+                    deployment, self.circuit_failures, self.circuit_reset_seconds
+                )
+            return self._breakers[deployment]
+
+    def thread_semaphore(self, deployment: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            if deployment not in self._thread_semaphores:
+                self._thread_semaphores[deployment] = threading.BoundedSemaphore(self.limit(deployment))
+            return self._thread_semaphores[deployment]
+
+    def async_semaphore(self, deployment: str) -> asyncio.Semaphore:
+        with self._lock:
+            if deployment not in self._async_semaphores:
+                self._async_semaphores[deployment] = asyncio.Semaphore(self.limit(deployment))
+            return self._async_semaphores[deployment]
+
+    def delay(self, attempt: int, error: Exception) -> float:
+        """Retry-After if the service sent one, else full-jitter exponential backoff"""
+        retry_after = retry_after_seconds(error)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay * 3)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def count(self, key: str, amount: int = 1):
+        with self._lock:
+            self.counters[key] += amount
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self.counters, circuits={name: b.state for name, b in self._breakers.items()})
+
+    def before_attempt(self, deployment: str):
+        try:
+            self.breaker(deployment).check()
+        except CircuitOpenError:
+            self.count("circuitRejected")
+            raise
+
+    def after_failure(self, deployment: str, error: Exception, attempt: int) -> bool:
+        """Record a failed attempt; True if it should be retried"""
+        retryable = is_retryable(error)
+        if not retryable:
+            # A 4xx answer (bad request, content filter) still means the deployment is up
+            self.breaker(deployment).record_success()
+            return False
+        if retryable and is_throttled(error):
+            self.count("throttled")
+        # Throttling is a capacity signal handled by backoff; it only trips the breaker once retries run out
+        if retryable and (not is_throttled(error) or attempt >= self.max_retries):
+            self.breaker(deployment).record_failure()
+        if attempt >= self.max_retries:
+            return False
+        self.count("retries")
+        return True
+
+
+class _SyncCreate:
+    def __init__(self, create: Callable, policy: ResiliencePolicy):
+        self._create = create
+        self._policy = policy
+
+    def __call__(self, **kwargs):
+        policy = self._policy
+        deployment = kwargs.get("model", "")
+        kwargs.setdefault("timeout", policy.timeout)
+        policy.count("calls")
+        for attempt in range(policy.max_retries + 1):
+            policy.before_attempt(deployment)
+            try:
+                with policy.thread_semaphore(deployment):
+                    result = self._create(**kwargs)
+            except Exception as e:
+                if not policy.after_failure(deployment, e, attempt):
+                    raise
+                time.sleep(policy.delay(attempt, e))
+                continue
+            except BaseException:
+                policy.breaker(deployment).abandon_trial()
+                raise
+            policy.breaker(deployment).record_success()
+            return result
+
+
+class _AsyncCreate:
+    def __init__(self, create: Callable, policy: ResiliencePolicy):
+        self._create = create
+        self._policy = policy
+
+    async def _send(self, semaphore: asyncio.Semaphore, kwargs: Dict):
+        async with semaphore:
+            return await self._create(**kwargs)
+
+    async def _hedged(self, semaphore: asyncio.Semaphore, kwargs: Dict):
+        """Send once; if no answer after `hedge_after` and a slot is free, send again and take the first answer"""
+        first = asyncio.ensure_future(self._send(semaphore, kwargs))
+        pending = {first}
+        error: Optional[BaseException] = None
+        try:
+            await asyncio.wait(pending, timeout=self._policy.hedge_after)
+            if first.done() or semaphore.locked():
+                return await first
+            self._policy.count("hedges")
+            second = asyncio.ensure_future(self._send(semaphore, kwargs))
+            pending = {first, second}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self._policy.count("hedgeWins")
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def __call__(self, **kwargs):
+        policy = self._policy
+        deployment = kwargs.get("model", "")
+        kwargs.setdefault("timeout", policy.timeout)
+        hedge = policy.hedge_after > 0 and not kwargs.get("stream")
+        policy.count("calls")
+        for attempt in range(policy.max_retries + 1):
+            policy.before_attempt(deployment)
+            semaphore = policy.async_semaphore(deployment)
+            try:
+                result = await (self._hedged(semaphore, kwargs) if hedge else self._send(semaphore, kwargs))
+            except Exception as e:
+                if not policy.after_failure(deployment, e, attempt):
+                    raise
+                await asyncio.sleep(policy.delay(attempt, e))
+                continue
+            except BaseException:  # cancelled
+                policy.breaker(deployment).abandon_trial()
+                raise
+            policy.breaker(deployment).record_success()
+            return result
+
+
+class _Namespace:
+    """Stands in for `client.chat.completions` / `client.embeddings`, replacing only `create`"""
+
+    def __init__(self, target, create):
+        self._target = target
+        self.create = create
+
+    def __getattr__(self, name):
+        return getattr(self._target, name)
+
+
+class _ChatNamespace:
+    def __init__(self, chat, completions):
+        self._chat = chat
+        self.completions = completions
+
+    def __getattr__(self, name):
+        return getattr(self._chat, name)
+
+
+class ResilientOpenAI:
+    """Proxy for an (Async)AzureOpenAI client whose chat and embeddings calls follow a `ResiliencePolicy`"""
+
+    def __init__(self, client, policy: Optional[ResiliencePolicy] = None):
+        self.client = client
+        self.policy = policy or ResiliencePolicy.from_env()
+        wrapper = _AsyncCreate if inspect.iscoroutinefunction(client.embeddings.create) else _SyncCreate
+        self.chat = _ChatNamespace(
+            client.chat,
+            _Namespace(client.chat.completions, wrapper(client.chat.completions.create, self.policy))
+        )
+        self.embeddings = _Namespace(client.embeddings, wrapper(client.embeddings.create, self.policy))
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
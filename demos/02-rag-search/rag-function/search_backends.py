@@ -0,0 +1,527 @@
+"""Pluggable retrieval backends for the RAG function
+
+`AzureSearchBackend` runs the hybrid + semantic query against Azure AI Search.
+`LocalVectorBackend` answers the same query offline from a directory written
+by `ingest-kb.py --backend local`: a memory-mapped float32 matrix of
+normalized chunk vectors searched by exact cosine top-k (or an HNSW index
+when `hnswlib` is installed and the corpus is large), and a BM25 keyword
+index, fused by reciprocal rank fusion (RRF) the way Azure AI Search fuses
+hybrid queries. Both return result dicts shaped like Azure AI Search results
+(document fields plus `@search.score`), and both can restrict a query to one
+support category before ranking (a pre-filter on the `category` collection).
+
+Like Azure AI Search vector compression, the local index can keep int8 or
+binary quantized copies of the vectors: candidates are ranked on the
+compact codes, oversampled, and rescored against the full-precision rows of
+the memory-mapped matrix.
+"""
+import json
+import logging
+import math
+import os
+import re
+from abc import ABC, abstractmethod
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+try:
+    import hnswlib
+except ImportError:  # the ANN index is optional; exact search is used without it
+    hnswlib = None
+
+DOCUMENTS_FILE = "documents.jsonl"
+VECTORS_FILE = "vectors.npy"
+META_FILE = "meta.json"
+HNSW_FILE = "hnsw.bin"
+INT8_FILE = "vectors.int8.npy"
+SCALES_FILE = "scales.npy"
+BINARY_FILE = "vectors.bits.npy"
+COMPRESSIONS = ("none", "int8", "binary")
+
+RRF_K = 60  # rank constant used by Azure AI Search for hybrid fusion
+ANN_MIN_DOCUMENTS = int(os.getenv("RAG_LOCAL_ANN_MIN_DOCUMENTS", "20000"))
+SEARCHABLE_FIELDS = ("title", "sectionPath", "content")
+TOKEN = re.compile(r"\w+")
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+class SearchBackend(ABC):
+    """Hybrid (keyword + vector) search over the knowledge base chunks"""
+
+    score_type = "hybrid"
+
+    @abstractmethod
+    async def search(
+        self,
+        text: str,
+        vector: Optional[Sequence[float]],
+        top: int,
+        select: List[str],
+        category: Optional[str] = None
+    ) -> List[Dict]:
+        """Top chunks for the query; with `category`, only chunks of that category are searched"""
+
+    @abstractmethod
+    async def get_contents(self, ids: List[str]) -> Dict[str, str]:
+        """Fetch the `content` of specific chunks (search results are retrieved without it)"""
+
+    @abstractmethod
+    async def get_generation(self) -> Optional[str]:
+        """When the index was last changed by ingest-kb.py (None for indexes ingested before it recorded that)"""
+
+    async def close(self):
+        pass
+
+
+def metadata_index_name(index_name: str) -> str:
+    """Small index, next to the content index, where ingest-kb.py records when it last changed `index_name`
+
+    One document per content index: `id` is the content index name, `lastModified` the time of the change.
+    """
+    return os.getenv("AZURE_AI_SEARCH_METADATA_INDEX") or f"{index_name}-meta"
+
+
+class AzureSearchBackend(SearchBackend):
+    """Azure AI Search: RRF hybrid query with semantic reranking"""
+
+    score_type = "semantic"
+
+    def __init__(
+        self,
+        search_client,
+        semantic_configuration: str = "semantic-config",
+        vector_field: str = "contentVector",
+        oversampling: Optional[float] = None,
+        metadata_client=None,
+        index_name: str = "kb-support"
+    ):
+        self.search_client = search_client
+        self.metadata_client = metadata_client  # client for metadata_index_name(index_name)
+        self.index_name = index_name
+        self.semantic_configuration = semantic_configuration
+        self.vector_field = vector_field
+        # Only valid when the vector field is compressed with rescoring; overrides the index default
+        self.oversampling = oversampling
+
+    async def search(self, text, vector, top, select, category=None):
+        vector_queries = None
+        if vector is not None:
+            vector_queries = [{
+                "kind": "vector",
+                "vector": vector,
+                "fields": self.vector_field,
+                "k": top
+            }]
+            if self.oversampling:
+                vector_queries[0]["oversampling"] = self.oversampling
+        results = await self.search_client.search(
+            search_text=text,
+            vector_queries=vector_queries,
+            query_type="semantic",
+            semantic_configuration_name=self.semantic_configuration,
+            top=top,
+            select=select,  # Don't include @ fields in select
+            # Filtered before the HNSW search, so the vector query still returns its k nearest in the category
+            filter=f"category/any(c: c eq '{category}')" if category else None,
+            vector_filter_mode="preFilter" if category else None
+        )
+        # The query (and semantic rerank) runs when the results are paged in
+        return [result async for result in results]
+
+    async def get_contents(self, ids):
+        # One filtered query for all chunks instead of a key lookup per chunk (document keys can't contain commas)
+        try:
+            results = await self.search_client.search(
+                search_text="*",
+                filter=f"search.in(id, '{','.join(ids)}', ',')",
+                select=["id", "content"],
+                top=len(ids)
+            )
+            return {document["id"]: document.get("content", "") async for document in results}
+        except Exception as e:
+            logging.warning(f"Could not fetch content of {len(ids)} chunks: {e}")
+            return {}
+
+    async def get_generation(self):
+        from azure.core.exceptions import ResourceNotFoundError
+
+        if self.metadata_client is None:
+            return None
+        try:
+            document = await self.metadata_client.get_document(key=self.index_name, selected_fields=["lastModified"])
+        except ResourceNotFoundError:  # no ingest has recorded a change yet (or the metadata index doesn't exist)
+            return None
+        return str(document.get("lastModified"))
+
+    async def close(self):
+        await self.search_client.close()
+        if self.metadata_client is not None:
+            await self.metadata_client.close()
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN.findall(text.lower())
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def truncate(matrix: np.ndarray, dimensions: int) -> np.ndarray:
+    """Keep the leading dimensions and renormalize (valid for Matryoshka-trained text-embedding-3 vectors)"""
+    return _normalize_rows(np.asarray(matrix, dtype=np.float32)[:, :dimensions])
+
+
+def quantize_int8(matrix: np.ndarray):
+    """Symmetric per-row int8 quantization; returns (codes, scales) with row ~= codes * scale"""
+    scales = np.abs(matrix).max(axis=1, initial=0) / 127
+    scales[scales == 0] = 1
+    codes = np.clip(np.rint(matrix / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def quantize_binary(matrix: np.ndarray) -> np.ndarray:
+    """One sign bit per dimension, packed eight to a byte"""
+    return np.packbits(np.asarray(matrix) > 0, axis=1)
+
+
+def int8_scores(codes: np.ndarray, scales: np.ndarray, query: np.ndarray, block: int = 8192) -> np.ndarray:
+    """Approximate cosine from int8 codes, a block of rows at a time to bound the float copy"""
+    scores = np.empty(codes.shape[0], dtype=np.float32)
+    for start in range(0, codes.shape[0], block):
+        rows = slice(start, start + block)
+        scores[rows] = (codes[rows].astype(np.float32) @ query) * scales[rows]
+    return scores
+
+
+def binary_scores(bits: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """Negative Hamming distance between sign bits (higher is more similar)"""
+    query_bits = quantize_binary(query[None, :])[0]
+    return -_POPCOUNT[np.bitwise_xor(bits, query_bits)].sum(axis=1, dtype=np.int32)
+
+
+def rescore(vectors: np.ndarray, candidates: np.ndarray, query: np.ndarray, k: int) -> np.ndarray:
+    """Re-rank compressed-search candidates with full-precision cosine; reads only the candidate rows"""
+    candidates = np.sort(candidates)
+    exact = np.asarray(vectors[candidates]) @ query
+    return candidates[np.argsort(-exact)][:k]
+
+
+@dataclass
+class IndexingResult:
+    """Mirrors the per-document result of the Azure AI Search indexing calls"""
+    key: str
+    succeeded: bool
+
+
+class LocalVectorStore:
+    """Writable on-disk index with the document-level API of `SearchClient` used by ingest-kb.py
+
+    Changes are kept in memory until `save()`, which rewrites the directory.
+    Like Azure AI Search, documents may have no vector (ingest-kb.py stores one
+    vector per near-duplicate cluster); they are found by keyword search only.
+    `compression` (`none`, `int8` or `binary`) adds a quantized copy of the
+    vectors for the first search pass; the full-precision matrix is always kept
+    for rescoring.
+    """
+
+    def __init__(self, path: str, compression: str = "none", vector_field: str = "contentVector"):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression '{compression}' (expected one of {', '.join(COMPRESSIONS)})")
+        self.path = path
+        self.compression = compression
+        self.vector_field = vector_field
+        self.documents: Dict[str, Dict] = {}
+        self.vectors: Dict[str, Optional[np.ndarray]] = {}
+        self.generation: Optional[str] = None  # when ingest-kb.py last changed the index; saved in the metadata
+        if os.path.exists(os.path.join(path, META_FILE)):
+            documents, matrix, meta = _read_index(path, mmap=False)
+            self.generation = meta.get("generation")
+            keyword_only = set(meta.get("keywordOnly", []))
+            for row, (doc, vector) in enumerate(zip(documents, matrix)):
+                self.documents[doc["id"]] = doc
+                self.vectors[doc["id"]] = None if row in keyword_only else np.array(vector, dtype=np.float32)
+
+    def upload_documents(self, documents: Iterable[Dict]) -> List[IndexingResult]:
+        results = []
+        for doc in documents:
+            doc = dict(doc)
+            vector = doc.pop(self.vector_field, None)
+            if not doc.get("id"):
+                results.append(IndexingResult(doc.get("id"), False))
+                continue
+            self.documents[doc["id"]] = doc
+            self.vectors[doc["id"]] = None if vector is None else np.asarray(vector, dtype=np.float32)
+            results.append(IndexingResult(doc["id"], True))
+        return results
+
+    def merge_or_upload_documents(self, documents: Iterable[Dict]) -> List[IndexingResult]:
+        merged = []
+        for doc in documents:
+            existing = dict(self.documents.get(doc["id"], {}))
+            # An explicit None removes the vector; leaving the field out keeps it
+            if self.vector_field not in doc and doc["id"] in self.vectors:
+                existing[self.vector_field] = self.vectors[doc["id"]]
+            existing.update(doc)
+            merged.append(existing)
+        return self.upload_documents(merged)
+
+    def delete_documents(self, documents: Iterable[Dict]) -> List[IndexingResult]:
+        results = []
+        for doc in documents:
+            found = self.documents.pop(doc["id"], None) is not None
+            self.vectors.pop(doc["id"], None)
+            results.append(IndexingResult(doc["id"], found))
+        return results
+
+    def save(self):
+        """Write documents, the normalized vector matrix and (when worthwhile) the HNSW graph"""
+        os.makedirs(self.path, exist_ok=True)
+        ids = sorted(self.documents)
+        dimensions = next((len(vector) for vector in self.vectors.values() if vector is not None), 0)
+        matrix = np.zeros((len(ids), dimensions), dtype=np.float32)
+        keyword_only = []
+        for row, doc_id in enumerate(ids):
+            if self.vectors[doc_id] is None:
+                keyword_only.append(row)  # stays a zero row, excluded from vector search
+            else:
+                matrix[row] = self.vectors[doc_id]
+        matrix = _normalize_rows(matrix)
+
+        _write_atomic(os.path.join(self.path, VECTORS_FILE), lambda f: np.save(f, matrix), binary=True)
+        for name in (INT8_FILE, SCALES_FILE, BINARY_FILE):
+            if os.path.exists(os.path.join(self.path, name)):
+                os.remove(os.path.join(self.path, name))
+        if self.compression == "int8":
+            codes, scales = quantize_int8(matrix)
+            _write_atomic(os.path.join(self.path, INT8_FILE), lambda f: np.save(f, codes), binary=True)
+            _write_atomic(os.path.join(self.path, SCALES_FILE), lambda f: np.save(f, scales), binary=True)
+        elif self.compression == "binary":
+            bits = quantize_binary(matrix)
+            _write_atomic(os.path.join(self.path, BINARY_FILE), lambda f: np.save(f, bits), binary=True)
+        _write_atomic(
+            os.path.join(self.path, DOCUMENTS_FILE),
+            lambda f: f.writelines(json.dumps(self.documents[doc_id]) + "\n" for doc_id in ids)
+        )
+
+        hnsw_path = os.path.join(self.path, HNSW_FILE)
+        if hnswlib is not None and len(ids) >= ANN_MIN_DOCUMENTS:
+            graph = hnswlib.Index(space="ip", dim=dimensions)  # vectors are normalized: inner product is cosine
+            graph.init_index(max_elements=len(ids), ef_construction=200, M=16)
+            graph.add_items(matrix, np.arange(len(ids)))
+            graph.save_index(hnsw_path)
+        elif os.path.exists(hnsw_path):
+            os.remove(hnsw_path)
+
+        # Written last: readers only trust files that agree with the metadata
+        _write_atomic(
+            os.path.join(self.path, META_FILE),
+            lambda f: json.dump({
+                "count": len(ids),
+                "dimensions": dimensions,
+                "compression": self.compression,
+                "keywordOnly": keyword_only,
+                "generation": self.generation
+            }, f)
+        )
+
+
+def _write_atomic(path: str, write, binary: bool = False):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb" if binary else "w", encoding=None if binary else "utf-8") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def _read_index(path: str, mmap: bool = True):
+    with open(os.path.join(path, META_FILE), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    with open(os.path.join(path, DOCUMENTS_FILE), "r", encoding="utf-8") as f:
+        documents = [json.loads(line) for line in f if line.strip()]
+    matrix = np.load(os.path.join(path, VECTORS_FILE), mmap_mode="r" if mmap else None)
+    if len(documents) != meta["count"] or matrix.shape[0] != meta["count"]:
+        raise ValueError(f"Local index at {path} is inconsistent; re-run ingest-kb.py --backend local")
+    return documents, matrix, meta
+
+
+class BM25Index:
+    """In-memory Okapi BM25 over the searchable fields"""
+
+    def __init__(self, documents: List[Dict], k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.count = len(documents)
+        postings = defaultdict(list)
+        lengths = np.zeros(self.count, dtype=np.float32)
+        for row, doc in enumerate(documents):
+            terms = Counter(tokenize(" ".join(str(doc.get(name) or "") for name in SEARCHABLE_FIELDS)))
+            lengths[row] = sum(terms.values())
+            for term, frequency in terms.items():
+                postings[term].append((row, frequency))
+
+        self.length_norm = k1 * (1 - b + b * lengths / max(float(lengths.mean()) if self.count else 1.0, 1.0))
+        self.postings = {
+            term: (
+                np.array([row for row, _ in rows], dtype=np.intp),
+                np.array([tf for _, tf in rows], dtype=np.float32)
+            )
+            for term, rows in postings.items()
+        }
+        self.idf = {
+            term: math.log(1 + (self.count - len(rows) + 0.5) / (len(rows) + 0.5))
+            for term, rows in postings.items()
+        }
+
+    def scores(self, text: str) -> np.ndarray:
+        scores = np.zeros(self.count, dtype=np.float32)
+        for term in set(tokenize(text)):
+            if term not in self.postings:
+                continue
+            rows, tf = self.postings[term]
+            scores[rows] += self.idf[term] * tf * (self.k1 + 1) / (tf + self.length_norm[rows])
+        return scores
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Row indexes of the k highest scores, best first"""
+    if k >= len(scores):
+        return np.argsort(-scores)
+    candidates = np.argpartition(-scores, k)[:k]
+    return candidates[np.argsort(-scores[candidates])]
+
+
+class LocalVectorBackend(SearchBackend):
+    """Offline stand-in for Azure AI Search: exact or HNSW vector search + BM25, fused with RRF"""
+
+    def __init__(self, path: str, ann: str = "auto", oversampling: float = 4.0):
+        self.path = path
+        self.oversampling = oversampling
+        self.documents, self.vectors, meta = _read_index(path)
+        self.rows = {doc["id"]: row for row, doc in enumerate(self.documents)}
+        self.compression = meta.get("compression", "none")
+        self.generation = meta.get("generation")
+        self.keyword_only = np.zeros(len(self.documents), dtype=bool)
+        self.keyword_only[meta.get("keywordOnly", [])] = True
+        if self.compression == "int8":
+            self.codes = np.load(os.path.join(path, INT8_FILE), mmap_mode="r")
+            self.scales = np.load(os.path.join(path, SCALES_FILE))
+        elif self.compression == "binary":
+            self.codes = np.load(os.path.join(path, BINARY_FILE), mmap_mode="r")
+        self.bm25 = BM25Index(self.documents)
+        # Indexes written before `category` became a collection hold one string per chunk
+        self.categories = [
+            {category} if isinstance(category, str) else set(category or ())
+            for category in (doc.get("category") for doc in self.documents)
+        ]
+        self.graph = None
+        hnsw_path = os.path.join(path, HNSW_FILE)
+        if ann != "exact" and hnswlib is not None and os.path.exists(hnsw_path):
+            self.graph = hnswlib.Index(space="ip", dim=self.vectors.shape[1])
+            self.graph.load_index(hnsw_path, max_elements=len(self.documents))
+            self.graph.set_ef(int(os.getenv("RAG_LOCAL_HNSW_EF", "100")))
+        elif ann == "hnsw":
+            logging.warning(
+                "HNSW index requested but unavailable (hnswlib missing or corpus too small); using exact search"
+            )
+
+    @classmethod
+    def from_env(cls) -> "LocalVectorBackend":
+        return cls(
+            os.getenv("RAG_LOCAL_INDEX_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "local-index")),
+            ann=os.getenv("RAG_LOCAL_ANN", "auto"),
+            oversampling=float(os.getenv("RAG_VECTOR_OVERSAMPLING") or 4.0)
+        )
+
+    def vector_ranking(self, vector: Sequence[float], k: int, exclude: Optional[np.ndarray] = None) -> np.ndarray:
+        exclude = self.keyword_only if exclude is None else exclude | self.keyword_only
+        excluded = int(exclude.sum())
+        if not excluded:
+            return self._vector_ranking(vector, k)
+        # Documents without a vector (zero rows) or outside the filter are ranked past and dropped
+        ranked = self._vector_ranking(vector, min(k + excluded, len(self.documents)))
+        return ranked[~exclude[ranked]][:k]
+
+    def _vector_ranking(self, vector: Sequence[float], k: int) -> np.ndarray:
+        query = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+        if self.graph is not None:
+            labels, _ = self.graph.knn_query(query, k=min(k, len(self.documents)))
+            return labels[0].astype(np.intp)
+        if self.compression == "none":
+            return top_k(self.vectors @ query, k)
+
+        if self.compression == "int8":
+            approximate = int8_scores(self.codes, self.scales, query)
+        else:
+            approximate = binary_scores(self.codes, query)
+        candidates = top_k(approximate, max(k, int(k * self.oversampling)))
+        return rescore(self.vectors, candidates, query, k)
+
+    def keyword_ranking(self, text: str, k: int, exclude: Optional[np.ndarray] = None) -> np.ndarray:
+        scores = self.bm25.scores(text)
+        if exclude is not None:
+            scores[exclude] = 0
+        ranked = top_k(scores, k)
+        return ranked[scores[ranked] > 0]
+
+    def query(
+        self,
+        text: str,
+        vector: Optional[Sequence[float]],
+        top: int,
+        select: List[str],
+        category: Optional[str] = None
+    ) -> List[Dict]:
+        if not self.documents:
+            return []
+        exclude = np.array([category not in categories for categories in self.categories]) if category else None
+        fused: Dict[int, float] = defaultdict(float)
+        rankings = [self.keyword_ranking(text, top, exclude)] if text else []
+        if vector is not None:
+            rankings.append(self.vector_ranking(vector, top, exclude))
+        for ranking in rankings:
+            for rank, row in enumerate(ranking):
+                fused[int(row)] += 1.0 / (RRF_K + rank + 1)
+
+        results = []
+        for row, score in sorted(fused.items(), key=lambda item: item[1], reverse=True)[:top]:
+            doc = self.documents[row]
+            result = {name: doc.get(name) for name in select} if select else dict(doc)
+            result["@search.score"] = score
+            results.append(result)
+        return results
+
+    async def search(self, text, vector, top, select, category=None):
+        # Sub-millisecond for a KB of this size, so it runs inline rather than in a thread
+        return self.query(text, vector, top, select, category)
+
+    async def get_contents(self, ids):
+        return {doc_id: self.documents[self.rows[doc_id]].get("content", "") for doc_id in ids if doc_id in self.rows}
+
+    async def get_generation(self):
+        # The local index is loaded once per process, so its generation can't change underneath the cache
+        return self.generation
+
+
+def create_backend(search_client_factory=None) -> SearchBackend:
+    """Pick the backend from RAG_SEARCH_BACKEND (`azure`, the default, or `local`)"""
+    backend = os.getenv("RAG_SEARCH_BACKEND", "azure").lower()
+    if backend == "local":
+        return LocalVectorBackend.from_env()
+    if backend != "azure":
+        raise ValueError(f"Unknown RAG_SEARCH_BACKEND '{backend}' (expected 'azure' or 'local')")
+    oversampling = os.getenv("RAG_VECTOR_OVERSAMPLING")
+    index_name = os.getenv("AZURE_AI_SEARCH_INDEX", "kb-support")
+    return AzureSearchBackend(
+        search_client_factory(index_name),
+        oversampling=float(oversampling) if oversampling else None,
+        metadata_client=search_client_factory(metadata_index_name(index_name)),
+        index_name=index_name
+    )
@@ -0,0 +1,150 @@
+"""Structured, level-gated request tracing for the RAG function
+
+Each request collects its facts on a `RequestTrace` and emits a single
+summary record when it finishes, instead of logging per search result. The
+per-document dump is only produced when RAG_DEBUG_RESULTS is enabled and the
+`rag.trace` logger is at DEBUG level.
+
+Stages of a request are timed with `trace.span(name)`. Stage durations go
+into the summary record and the `Server-Timing` header, and - when the
+OpenTelemetry API is installed and a meter provider is configured - into the
+`rag.stage.duration` and `rag.request.duration` histograms (milliseconds), so
+p95 per stage can be charted and alerted on.
+"""
+import json
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+try:
+    from opentelemetry import metrics
+    _meter = metrics.get_meter("rag")
+    _stage_histogram = _meter.create_histogram(
+        "rag.stage.duration", unit="ms", description="Duration of one stage of a RAG request or ingestion run"
+    )
+    _request_histogram = _meter.create_histogram(
+        "rag.request.duration", unit="ms", description="End-to-end duration of a RAG request"
+    )
+except ImportError:  # OpenTelemetry is optional; timings are still logged and returned in Server-Timing
+    _stage_histogram = _request_histogram = None
+
+logger = logging.getLogger("rag.trace")
+
+DEBUG_RESULTS = os.getenv("RAG_DEBUG_RESULTS", "false").lower() in ("1", "true", "yes")
+if DEBUG_RESULTS:
+    logger.setLevel(logging.DEBUG)
+
+TOP_SCORES = 5
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Nearest-rank percentile of a non-empty list: the smallest value with at least p% of the list at or below it
+
+    Shared by the benchmark and evaluation scripts. `p * n / 100` rather than `p / 100 * n`, which is a hair
+    above a whole number for some p (7% of 100 is 7.000000000000001) and would pick the next rank.
+    """
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p * len(ordered) / 100) - 1)]
+
+
+class RequestTrace:
+    """Collects one request's summary fields and emits them as one log record"""
+
+    def __init__(self, operation: str, **fields: Any):
+        self.operation = operation
+        self.fields: Dict[str, Any] = dict(fields)
+        self.started = time.perf_counter()
+        self._scores: List[float] = []
+        self._score_types: Dict[str, int] = {}
+        self._emitted = False
+        self._lock = threading.Lock()
+        self.stages: Dict[str, float] = {}  # stage -> milliseconds, in the order stages first ran
+
+    def set(self, **fields: Any):
+        self.fields.update(fields)
+
+    @contextmanager
+    def span(self, stage: str):
+        """Time a stage; repeated (or concurrent) spans of one stage add up"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, (time.perf_counter() - started) * 1000)
+
+    def record(self, stage: str, duration_ms: float):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + duration_ms
+        if _stage_histogram is not None:
+            _stage_histogram.record(duration_ms, {"operation": self.operation, "stage": stage})
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+    def timings(self) -> Dict[str, float]:
+        """Stage durations (ms) plus the total so far"""
+        with self._lock:
+            timings = {stage: round(ms, 1) for stage, ms in self.stages.items()}
+        timings["total"] = round(self.elapsed_ms(), 1)
+        return timings
+
+    def server_timing(self) -> str:
+        """Format the stage durations as a Server-Timing header value"""
+        return ", ".join(f"{stage};dur={ms}" for stage, ms in self.timings().items())
+
+    def add_result(self, result: Dict, score_type: str, score: float):
+        """Record one search result; the full document is only logged in debug mode"""
+        self._scores.append(score)
+        self._score_types[score_type] = self._score_types.get(score_type, 0) + 1
+        if DEBUG_RESULTS and logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "search result %s",
+                json.dumps({
+                    "operation": self.operation,
+                    "rank": len(self._scores),
+                    "id": result.get("id"),
+                    "title": result.get("title"),
+                    "sectionPath": result.get("sectionPath"),
+                    "scoreType": score_type,
+                    "score": score,
+                    "rerankerScore": result.get("@search.reranker_score"),
+                    "searchScore": result.get("@search.score"),
+                    "keys": sorted(result.keys())
+                }, default=str)
+            )
+
+    def reset_results(self):
+        """Forget recorded search results (a wider search pass replaces the first one)"""
+        self._scores = []
+        self._score_types = {}
+
+    def summary(self) -> Dict[str, Any]:
+        record = {"operation": self.operation}
+        if self._scores:
+            record["resultCount"] = len(self._scores)
+            record["topScores"] = [round(s, 4) for s in sorted(self._scores, reverse=True)[:TOP_SCORES]]
+            record["scoreType"] = max(self._score_types, key=self._score_types.get)
+        record.update(self.fields)
+        timings = self.timings()
+        record["durationMs"] = timings.pop("total")
+        if timings:
+            record["stagesMs"] = timings
+        return record
+
+    def emit(self, outcome: Optional[str] = None, level: int = logging.INFO):
+        """Emit the summary record (once per request)"""
+        if self._emitted:
+            return
+        self._emitted = True
+        if outcome:
+            self.fields["outcome"] = outcome
+        if _request_histogram is not None:
+            _request_histogram.record(
+                self.elapsed_ms(), {"operation": self.operation, "outcome": outcome or "unknown"}
+            )
+        if logger.isEnabledFor(level):
+            logger.log(level, "%s %s", self.operation, json.dumps(self.summary(), default=str))
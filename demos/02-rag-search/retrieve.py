@@ -1,47 +1,275 @@
+"""Prompt Flow retrieval tool: semantic search against Azure AI Search (or the local index)
+
+Batch flow runs call the tool once per line, so the per-call overhead matters:
+
+- One pooled `requests.Session` per process keeps connections to the search
+  service alive, so only the first call pays for the TCP + TLS handshake
+- Every call has a connect and read timeout; 429 and 5xx answers are retried
+  with backoff, honouring `Retry-After`
+- Results are cached in-process for RETRIEVE_CACHE_TTL_SECONDS, keyed by
+  (endpoint, index, question, top_k), so repeated questions in an evaluation
+  set don't query the service again
+- Near-duplicate chunks (same clusterId, see ingest-kb.py) come back once:
+  the query over-fetches and keeps the best-ranked chunk of each cluster
+- `aretrieve` is the async variant (aiohttp, one pooled session per event
+  loop) for async flows and batch runs that fan out many questions at once;
+  `retrieve_async.py` exposes it as a flow node (a node file holds one tool)
+"""
+import asyncio
+import copy
 import os
-import json
-from typing import List, Dict
-from promptflow.core import tool
+import random
+import sys
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
 import requests
+from promptflow.core import tool
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+SEARCH_API_VERSION = "2023-11-01"
+# Fields defined by the index in ingest-kb.py
+SELECT_FIELDS = "id,clusterId,title,sectionPath,content,sourceUrl"
+# Results fetched per requested context, so dropping near-duplicates still leaves top_k contexts
+CLUSTER_OVERFETCH = 2
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+TIMEOUT = (
+    float(os.getenv("RETRIEVE_CONNECT_TIMEOUT_SECONDS", "3.05")),
+    float(os.getenv("RETRIEVE_READ_TIMEOUT_SECONDS", "10"))
+)
+MAX_RETRIES = int(os.getenv("RETRIEVE_MAX_RETRIES", "3"))
+POOL_SIZE = int(os.getenv("RETRIEVE_POOL_SIZE", "16"))  # connections kept per host; match the flow's worker count
+CACHE_TTL_SECONDS = float(os.getenv("RETRIEVE_CACHE_TTL_SECONDS", "300"))
+CACHE_MAX_ENTRIES = int(os.getenv("RETRIEVE_CACHE_MAX_ENTRIES", "1024"))  # 0 disables the cache
+
+
+def _create_session() -> requests.Session:
+    retry = Retry(
+        total=MAX_RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=RETRY_STATUS,
+        allowed_methods=frozenset(["POST"]),  # a search query is safe to repeat
+        respect_retry_after_header=True,
+        raise_on_status=False  # the last response is returned and raise_for_status() reports it
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
-@tool
-def retrieve(
-    question: str,
-    search_endpoint: str,
-    search_key: str,
-    search_index: str,
-    top_k: int = 5
-) -> List[Dict[str, str]]:
-    """
-    Retrieve relevant documents from Azure AI Search using hybrid search.
-    """
-    search_url = f"{search_endpoint}/indexes/{search_index}/docs/search?api-version=2023-11-01"
 
+_session = _create_session()
+# aiohttp sessions are bound to the event loop they were created on
+_async_sessions: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, object]" = weakref.WeakKeyDictionary()
+
+
+class ResultCache:
+    """Thread-safe TTL + LRU cache of retrieval results"""
+
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Tuple, Tuple[float, List[Dict]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple) -> Optional[List[Dict]]:
+        if self.max_entries <= 0:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            # Flow nodes downstream may modify what they get; hand out copies
+            return copy.deepcopy(entry[1])
+
+    def put(self, key: Tuple, contexts: List[Dict]):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, copy.deepcopy(contexts))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+result_cache = ResultCache(CACHE_TTL_SECONDS, CACHE_MAX_ENTRIES)
+
+# Local backends are loaded once per process and reused across flow runs
+_local_backends = {}
+
+
+def retrieve_local(question: str, index_path: str, top_k: int) -> List[Dict[str, str]]:
+    """Keyword (BM25) retrieval from the local index written by `ingest-kb.py --backend local`"""
+    if index_path not in _local_backends:
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "rag-function"))
+        from search_backends import LocalVectorBackend
+        _local_backends[index_path] = LocalVectorBackend(index_path)
+
+    # The flow has no embedding step, so only the keyword half of the hybrid query runs
+    results = _local_backends[index_path].query(question, None, top_k * CLUSTER_OVERFETCH, SELECT_FIELDS.split(","))
+    return _contexts({"value": results}, top_k)
+
+
+def _cache_key(search_endpoint: str, search_index: str, question: str, top_k: int) -> Tuple:
+    return (search_endpoint.rstrip("/"), search_index, " ".join(question.split()).lower(), top_k)
+
+
+def _search_request(search_endpoint: str, search_key: str, search_index: str, question: str, top_k: int):
+    """(url, headers, body) of the semantic search query"""
+    url = f"{search_endpoint.rstrip('/')}/indexes/{search_index}/docs/search?api-version={SEARCH_API_VERSION}"
     headers = {
         "Content-Type": "application/json",
         "api-key": search_key
     }
-
     body = {
         "search": question,
         "queryType": "semantic",
         "semanticConfiguration": "semantic-config",
-        "top": top_k,
-        "select": "title,content,url"
+        "top": top_k * CLUSTER_OVERFETCH,
+        "select": SELECT_FIELDS
     }
+    return url, headers, body
 
-    response = requests.post(search_url, headers=headers, json=body)
-    response.raise_for_status()
-
-    results = response.json()
 
+def _contexts(results: Dict, top_k: int) -> List[Dict[str, str]]:
+    """The top_k best-ranked results, one per near-duplicate cluster"""
     contexts = []
-    for idx, doc in enumerate(results.get("value", []), 1):
+    clusters = set()
+    for doc in results.get("value", []):
+        if len(contexts) == top_k:
+            break
+        cluster_id = doc.get("clusterId") or doc.get("id")
+        if cluster_id is not None:
+            if cluster_id in clusters:
+                continue
+            clusters.add(cluster_id)
         contexts.append({
-            "index": idx,
+            "index": len(contexts) + 1,
             "title": doc.get("title", ""),
+            "section": doc.get("sectionPath", ""),
             "content": doc.get("content", ""),
-            "url": doc.get("url", "")
+            "url": doc.get("sourceUrl") or ""
         })
+    return contexts
+
+
+def _local_index_path(local_index_path: str) -> str:
+    return local_index_path or os.path.join(os.path.dirname(os.path.abspath(__file__)), "rag-function", "local-index")
+
+
+@tool
+def retrieve(
+    question: str,
+    search_endpoint: str,
+    search_key: str,
+    search_index: str,
+    top_k: int = 5,
+    search_backend: str = "azure",
+    local_index_path: str = ""
+) -> List[Dict[str, str]]:
+    """
+    Retrieve relevant documents from Azure AI Search using semantic search,
+    or from a local index when search_backend is "local".
+    """
+    if search_backend == "local":
+        return retrieve_local(question, _local_index_path(local_index_path), top_k)
+
+    key = _cache_key(search_endpoint, search_index, question, top_k)
+    cached = result_cache.get(key)
+    if cached is not None:
+        return cached
+
+    url, headers, body = _search_request(search_endpoint, search_key, search_index, question, top_k)
+    response = _session.post(url, headers=headers, json=body, timeout=TIMEOUT)
+    response.raise_for_status()
 
+    contexts = _contexts(response.json(), top_k)
+    result_cache.put(key, contexts)
     return contexts
+
+
+def _async_session():
+    import aiohttp
+
+    loop = asyncio.get_running_loop()
+    session = _async_sessions.get(loop)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit_per_host=POOL_SIZE),
+            timeout=aiohttp.ClientTimeout(sock_connect=TIMEOUT[0], sock_read=TIMEOUT[1])
+        )
+        _async_sessions[loop] = session
+    return session
+
+
+async def close_async_session():
+    """Close the current event loop's session (call before the loop ends, e.g. at the end of a batch)"""
+    session = _async_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+def _retry_delay(attempt: int, headers) -> float:
+    """Retry-After if the service sent one, else jittered exponential backoff"""
+    retry_after = headers.get("Retry-After")
+    try:
+        if retry_after is not None:
+            return min(float(retry_after), 30.0)
+    except ValueError:
+        pass
+    return random.uniform(0, 0.5 * 2 ** attempt)
+
+
+async def aretrieve(
+    question: str,
+    search_endpoint: str,
+    search_key: str,
+    search_index: str,
+    top_k: int = 5,
+    search_backend: str = "azure",
+    local_index_path: str = ""
+) -> List[Dict[str, str]]:
+    """Async `retrieve`: same inputs, output and cache, over a pooled aiohttp session"""
+    import aiohttp
+
+    if search_backend == "local":
+        return retrieve_local(question, _local_index_path(local_index_path), top_k)
+
+    key = _cache_key(search_endpoint, search_index, question, top_k)
+    cached = result_cache.get(key)
+    if cached is not None:
+        return cached
+
+    url, headers, body = _search_request(search_endpoint, search_key, search_index, question, top_k)
+    session = _async_session()
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            async with session.post(url, headers=headers, json=body) as response:
+                if response.status in RETRY_STATUS and attempt < MAX_RETRIES:
+                    delay = _retry_delay(attempt, response.headers)
+                else:
+                    response.raise_for_status()
+                    contexts = _contexts(await response.json(), top_k)
+                    result_cache.put(key, contexts)
+                    return contexts
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if attempt == MAX_RETRIES:
+                raise
+            delay = _retry_delay(attempt, {})
+        await asyncio.sleep(delay)
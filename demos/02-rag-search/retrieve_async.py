@@ -0,0 +1,21 @@
+"""Async Prompt Flow retrieval node: same inputs and output as retrieve.py, over a pooled aiohttp session"""
+from typing import Dict, List
+
+from promptflow.core import tool
+
+from retrieve import aretrieve
+
+
+@tool
+async def retrieve_async(
+    question: str,
+    search_endpoint: str,
+    search_key: str,
+    search_index: str,
+    top_k: int = 5,
+    search_backend: str = "azure",
+    local_index_path: str = ""
+) -> List[Dict[str, str]]:
+    return await aretrieve(
+        question, search_endpoint, search_key, search_index, top_k, search_backend, local_index_path
+    )
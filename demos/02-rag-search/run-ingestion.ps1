@@ -1,7 +1,10 @@
 # Quick script to run KB ingestion with proper environment variables
 param(
     [Parameter(Mandatory=$false)]
-    [string]$ResourceGroup = "rg-smart-agents-dev"
+    [string]$ResourceGroup = "rg-smart-agents-dev",
+
+    [Parameter(Mandatory=$false)]
+    [switch]$Incremental
 )
 
 Write-Host "Setting up environment variables..." -ForegroundColor Cyan
@@ -23,4 +26,8 @@ Write-Host "  OpenAI: $env:AZURE_OPENAI_ENDPOINT" -ForegroundColor Gray
 Write-Host "  Deployment: $env:AZURE_OPENAI_EMBEDDING_DEPLOYMENT`n" -ForegroundColor Gray
 
 Write-Host "Running ingestion..." -ForegroundColor Cyan
-python ingest-kb.py
+if ($Incremental) {
+    python ingest-kb.py --incremental
+} else {
+    python ingest-kb.py
+}
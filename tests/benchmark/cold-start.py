@@ -0,0 +1,124 @@
+"""Cold-start benchmark for the Demo 02 RAG function
+
+Each run starts a fresh Python process that imports `function_app` (what the
+Functions host does on a cold start) and then calls the `rag-search` route
+twice, timing:
+
+- import:  `import function_app` until the module is ready
+- first:   the first request (clients created, token fetched, pools opened)
+- second:  a warm request, for comparison
+
+Uses the same settings as the function (`.env` / environment): Azure
+OpenAI plus Azure AI Search, or RAG_SEARCH_BACKEND=local for an offline
+index. Run from the repository root:
+
+    python tests/benchmark/cold-start.py --runs 5
+    python tests/benchmark/cold-start.py --runs 5 --compare-prewarm
+    python tests/benchmark/cold-start.py --importtime
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+FUNCTION_DIR = os.path.join(REPO_ROOT, "demos", "02-rag-search", "rag-function")
+
+
+def child(question: str):
+    """Runs inside the fresh process; prints one JSON line of timings"""
+    import asyncio
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    started = time.perf_counter()
+    sys.path.insert(0, FUNCTION_DIR)
+    import function_app
+    imported = time.perf_counter()
+
+    import azure.functions as func
+
+    # Routes are FunctionBuilders; call the user function the way the worker does
+    body = json.dumps({"question": question}).encode("utf-8")
+    loop = asyncio.new_event_loop()
+    timings = {"importMs": (imported - started) * 1000}
+    for name in ("first", "second"):
+        request = func.HttpRequest(method="POST", url="/api/rag-search", body=body)
+        request_started = time.perf_counter()
+        response = loop.run_until_complete(function_app.rag_search.build().get_user_function()(request))
+        timings[f"{name}Ms"] = (time.perf_counter() - request_started) * 1000
+        timings[f"{name}Status"] = response.status_code
+        timings[f"{name}ServerTiming"] = response.headers.get("Server-Timing", "")
+    from clients import startup
+    timings.update(startup)
+    print(json.dumps(timings))
+
+
+def run(runs: int, question: str, prewarm: bool) -> list:
+    results = []
+    env = dict(os.environ, RAG_PREWARM="true" if prewarm else "false")
+    for _ in range(runs):
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", "--question", question],
+            cwd=REPO_ROOT, env=env, capture_output=True, text=True
+        )
+        lines = [line for line in completed.stdout.splitlines() if line.startswith("{")]
+        if completed.returncode != 0 or not lines:
+            sys.exit(f"Benchmark run failed:\n{completed.stderr[-2000:]}")
+        results.append(json.loads(lines[-1]))
+    return results
+
+
+def summarize(label: str, results: list):
+    print(f"\n{label} ({len(results)} cold starts)")
+    print("| Measure | median (ms) | min (ms) | max (ms) |")
+    print("|---------|------------:|---------:|---------:|")
+    measures = (("importMs", "import function_app"), ("firstMs", "first request"), ("secondMs", "second request"))
+    for key, name in measures:
+        values = [r[key] for r in results]
+        print(f"| {name} | {statistics.median(values):,.0f} | {min(values):,.0f} | {max(values):,.0f} |")
+    statuses = sorted({r["firstStatus"] for r in results} | {r["secondStatus"] for r in results})
+    print(f"HTTP status: {', '.join(map(str, statuses))}")
+    print(f"First request stages (last run): {results[-1]['firstServerTiming']}")
+
+
+def importtime(top: int):
+    """Slowest modules imported by function_app (python -X importtime, cumulative microseconds)"""
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import function_app"],
+        cwd=FUNCTION_DIR, env=dict(os.environ, RAG_PREWARM="false"), capture_output=True, text=True
+    )
+    rows = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, module = line[len("import time:"):].split("|")
+        rows.append((int(cumulative_us), module.strip()))
+    print(f"\nSlowest imports under `import function_app` (cumulative, top {top})")
+    print("| Module | ms |")
+    print("|--------|---:|")
+    for cumulative_us, module in sorted(rows, reverse=True)[:top]:
+        print(f"| {module} | {cumulative_us / 1000:,.1f} |")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure import time and first-request latency of the RAG function")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh processes to measure")
+    parser.add_argument("--question", default="How do I reset my password?")
+    parser.add_argument("--compare-prewarm", action="store_true", help="Also measure with RAG_PREWARM=false")
+    parser.add_argument("--importtime", action="store_true", help="List the slowest imports instead")
+    parser.add_argument("--top", type=int, default=15, help="Modules listed with --importtime")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.question)
+    elif args.importtime:
+        importtime(args.top)
+    else:
+        summarize("RAG_PREWARM=true", run(args.runs, args.question, prewarm=True))
+        if args.compare_prewarm:
+            summarize("RAG_PREWARM=false", run(args.runs, args.question, prewarm=False))
@@ -0,0 +1,509 @@
+"""Local stand-ins for Azure OpenAI and Azure AI Search, for offline benchmarks
+
+One HTTP server answers both APIs, so pointing AZURE_OPENAI_ENDPOINT and
+AZURE_AI_SEARCH_ENDPOINT at it is all the code under test needs:
+
+- POST /openai/deployments/{name}/embeddings: deterministic unit vectors
+  (hash of the input), float lists or base64 (what the openai SDK asks for)
+- POST /openai/deployments/{name}/chat/completions: a canned answer, as one
+  JSON response or as server-sent event chunks (`"stream": true`), with the
+  leading content-filter chunk Azure sends
+- /indexes/{index}/docs/search and /indexes('{index}')/docs/search.post.search:
+  BM25 over an in-memory index seeded with the chunked KB articles; semantic
+  queries also get an `@search.rerankerScore` (0-4). `filter` supports
+  `field eq 'value'`, `field/any(c: c eq 'value')` and
+  `search.in(field, 'a,b', ',')` clauses joined with `and`; `"search": "*"`
+  with a filter returns the matching documents
+- GET /indexes('{index}')/docs('{key}'), POST .../docs/search.index (upload,
+  merge, delete) and PUT /indexes('{index}') (create or update). Only the
+  content index (`kb-support`) is seeded; any other name (e.g. the
+  `kb-support-meta` index ingest-kb.py writes) is a separate index that
+  starts empty
+- GET /_stats: request, 429 and latency counters per endpoint; POST /_reset clears them
+
+Every endpoint sleeps for a latency drawn from its `Latency` profile
+(log-normal with the given median and p95) and answers a share of requests
+with 429 and a `retry-after-ms` header. Streaming chat adds a delay per token.
+
+Run standalone (e.g. for the manual scripts or the function host):
+
+    python tests/benchmark/fake_services.py --port 8765 --chat-latency 400:1200 --throttle-rate 0.05
+"""
+import argparse
+import base64
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import struct
+import sys
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlparse
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+RAG_DIR = os.path.join(REPO_ROOT, "demos", "02-rag-search")
+sys.path.insert(0, os.path.join(RAG_DIR, "rag-function"))
+from chunking import chunk_markdown  # noqa: E402
+from search_backends import BM25Index, top_k  # noqa: E402
+
+DEFAULT_DIMENSIONS = 3072
+CHAT_ANSWER = (
+    "To resolve this, follow the steps in the knowledge base article: sign in to the self-service portal, "
+    "verify your identity, and complete the guided reset. If the problem continues, contact the service desk."
+)
+
+_OPENAI_PATH = re.compile(r"^/openai/deployments/(?P<deployment>[^/]+)/(?P<operation>embeddings|chat/completions)$")
+_INDEX = r"^/indexes(?:/(?P<plain>[^/]+)|\('(?P<quoted>[^']+)'\))"  # /indexes/{name} or /indexes('{name}')
+_SEARCH_PATH = re.compile(_INDEX + r"/docs/(?:search|search\.post\.search)$")
+_GET_DOC_PATH = re.compile(_INDEX + r"/docs(?:/(?P<key>[^/]+)|\('(?P<qkey>[^']+)'\))$")
+_INDEX_DOCS_PATH = re.compile(_INDEX + r"/docs/(?:index|search\.index)$")
+_INDEX_PATH = re.compile(_INDEX + r"$")
+_FILTER_CLAUSE = re.compile(r"(\w+) eq '([^']*)'")
+_ANY_CLAUSE = re.compile(r"(\w+)/any\((\w+):\s*\2 eq '([^']*)'\)")
+_SEARCH_IN_CLAUSE = re.compile(r"search\.in\((\w+),\s*'([^']*)'(?:,\s*'([^']*)')?\)")
+
+
+def parse_filter(expression: str) -> Dict[str, set]:
+    """Allowed values per field, from the `eq` and `search.in` clauses of an OData filter"""
+    filters: Dict[str, set] = {}
+    for field, _, value in _ANY_CLAUSE.findall(expression):
+        filters.setdefault(field, set()).add(value)
+    expression = _ANY_CLAUSE.sub("", expression)
+    for field, value in _FILTER_CLAUSE.findall(expression):
+        filters.setdefault(field, set()).add(value)
+    for field, values, delimiters in _SEARCH_IN_CLAUSE.findall(expression):
+        filters.setdefault(field, set()).update(re.split(f"[{re.escape(delimiters or ' ,')}]", values))
+    return filters
+
+
+@dataclass
+class Latency:
+    """Log-normal latency with the given median and p95 (milliseconds); p95 == median means constant"""
+
+    median_ms: float = 0.0
+    p95_ms: float = 0.0
+
+    @classmethod
+    def parse(cls, value: str) -> "Latency":
+        """"40" (constant) or "40:120" (median:p95)"""
+        median, _, p95 = value.partition(":")
+        return cls(float(median), float(p95 or median))
+
+    def sample(self, rng: random.Random) -> float:
+        if self.median_ms <= 0:
+            return 0.0
+        if self.p95_ms <= self.median_ms:
+            return self.median_ms / 1000
+        sigma = math.log(self.p95_ms / self.median_ms) / 1.645
+        return rng.lognormvariate(math.log(self.median_ms), sigma) / 1000
+
+    def __str__(self):
+        return f"{self.median_ms:g}:{self.p95_ms:g}"
+
+
+@dataclass
+class FakeServiceConfig:
+    embeddings_latency: Latency
+    chat_latency: Latency  # until the first token (streaming) or the whole answer
+    chat_token_ms: float  # per streamed token after the first
+    search_latency: Latency
+    throttle_rate: float = 0.0  # share of OpenAI and Search requests answered with 429
+    retry_after_ms: int = 200
+    seed: int = 0
+
+    @classmethod
+    def from_args(cls, args) -> "FakeServiceConfig":
+        return cls(
+            embeddings_latency=Latency.parse(args.embeddings_latency),
+            chat_latency=Latency.parse(args.chat_latency),
+            chat_token_ms=args.chat_token_ms,
+            search_latency=Latency.parse(args.search_latency),
+            throttle_rate=args.throttle_rate,
+            retry_after_ms=args.retry_after_ms,
+            seed=args.seed
+        )
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """Latency and throttling options shared by this module and load-test.py"""
+    parser.add_argument("--embeddings-latency", default="40:120", help="Embeddings median:p95 ms")
+    parser.add_argument("--chat-latency", default="400:1200", help="Chat median:p95 ms (to first token when streaming)")
+    parser.add_argument("--chat-token-ms", type=float, default=5.0, help="Delay per streamed chat token")
+    parser.add_argument("--search-latency", default="30:90", help="Search median:p95 ms")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Share of requests answered with 429")
+    parser.add_argument("--retry-after-ms", type=int, default=200, help="retry-after-ms sent with each 429")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for latencies and throttling")
+
+
+def fake_embedding(text: str, dimensions: int) -> np.ndarray:
+    """Unit vector seeded by the text: identical inputs always get identical vectors"""
+    seed = int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "big")
+    vector = np.random.default_rng(seed).standard_normal(dimensions).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def seed_documents(content_dir: str = os.path.join(RAG_DIR, "content")) -> List[Dict]:
+    """The KB articles chunked the way ingest-kb.py chunks them (without vectors)"""
+    documents = []
+    for filename in sorted(os.listdir(content_dir)):
+        if not filename.endswith(".md"):
+            continue
+        with open(os.path.join(content_dir, filename), "r", encoding="utf-8") as f:
+            content = f.read()
+        parent_id = filename[:-3].replace("-", "_")
+        title = content.split("\n")[0].replace("#", "").strip()
+        for chunk in chunk_markdown(content):
+            documents.append({
+                "id": f"{parent_id}_c{chunk.index}",
+                "parentId": parent_id,
+                "chunkIndex": chunk.index,
+                "title": title,
+                "sectionPath": chunk.section,
+                "content": chunk.content
+            })
+    return documents
+
+
+def _matches(value, allowed: set) -> bool:
+    """A field value passes a filter when it (or, for a collection, any of its items) is allowed"""
+    if isinstance(value, list):
+        return any(item in allowed for item in value)
+    return value in allowed
+
+
+class FakeSearchIndex:
+    """Documents by key plus a BM25 index rebuilt lazily after writes"""
+
+    def __init__(self, documents: List[Dict], key_field: str = "id"):
+        self.key_field = key_field
+        self.documents: Dict[str, Dict] = {doc[key_field]: doc for doc in documents}
+        self.definition: Optional[Dict] = None
+        self._lock = threading.Lock()
+        self._bm25: Optional[BM25Index] = None
+        self._rows: List[Dict] = []
+
+    def write(self, actions: List[Dict]) -> List[Dict]:
+        results = []
+        with self._lock:
+            for action in actions:
+                kind = action.pop("@search.action", "upload")
+                key = action.get(self.key_field)
+                if kind == "delete":
+                    self.documents.pop(key, None)
+                elif kind in ("merge", "mergeOrUpload") and key in self.documents:
+                    self.documents[key].update(action)
+                else:
+                    self.documents[key] = action
+                results.append({"key": key, "status": True, "errorMessage": None, "statusCode": 200})
+            self._bm25 = None
+        return results
+
+    def search(
+        self,
+        text: str,
+        top: int,
+        select: Optional[List[str]],
+        semantic: bool,
+        filters: Optional[Dict[str, set]] = None
+    ) -> List[Dict]:
+        with self._lock:
+            if self._bm25 is None:
+                self._rows = list(self.documents.values())
+                self._bm25 = BM25Index(self._rows)
+            bm25, rows = self._bm25, self._rows
+        if not rows:
+            return []
+        if filters and text in ("", "*"):
+            scores = np.ones(len(rows), dtype=np.float32)  # filter-only query: every matching document, unranked
+        else:
+            scores = bm25.scores(text or "")
+        for field, values in (filters or {}).items():
+            scores[[row for row, doc in enumerate(rows) if not _matches(doc.get(field), values)]] = 0
+        ranked = [row for row in top_k(scores, top) if scores[row] > 0]
+        best = float(scores[ranked[0]]) if ranked else 1.0
+        results = []
+        for row in ranked:
+            doc = rows[row]
+            result = {name: doc.get(name) for name in select} if select else {
+                name: value for name, value in doc.items() if not name.endswith("Vector")
+            }
+            result["@search.score"] = float(scores[row])
+            if semantic:
+                result["@search.rerankerScore"] = round(3.6 * float(scores[row]) / best, 4)
+            results.append(result)
+        return results
+
+
+class FakeAzureServices:
+    """The server plus its counters; use as a context manager or call start()/stop()"""
+
+    def __init__(self, config: FakeServiceConfig, port: int = 0, documents: Optional[List[Dict]] = None):
+        self.config = config
+        self.index_name = "kb-support"
+        self.index = FakeSearchIndex(seed_documents() if documents is None else documents)
+        self._indexes: Dict[str, FakeSearchIndex] = {self.index_name: self.index}
+        self._indexes_lock = threading.Lock()
+        self.stats: Dict[str, Dict[str, float]] = defaultdict(
+            lambda: {"requests": 0, "throttled": 0, "latencySeconds": 0.0}
+        )
+        self._rng = random.Random(config.seed)
+        self._rng_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        handler = type("Handler", (_Handler,), {"services": self})
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+        self.server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeAzureServices":
+        self._thread = threading.Thread(target=self.server.serve_forever, name="fake-azure", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def env(self) -> Dict[str, str]:
+        """Settings that point the RAG function, ingest-kb.py and retrieve.py at this server"""
+        return {
+            "AZURE_OPENAI_ENDPOINT": self.url,
+            "AZURE_OPENAI_API_KEY": "fake-key",
+            "AZURE_AI_SEARCH_ENDPOINT": self.url,
+            "AZURE_AI_SEARCH_API_KEY": "fake-key",
+            "AZURE_AI_SEARCH_INDEX": self.index_name,
+            "RAG_SEARCH_BACKEND": "azure"
+        }
+
+    def index_for(self, name: str) -> FakeSearchIndex:
+        with self._indexes_lock:
+            if name not in self._indexes:
+                self._indexes[name] = FakeSearchIndex([])
+            return self._indexes[name]
+
+    def draw(self, latency: Latency) -> Tuple[float, bool]:
+        """(seconds to sleep, whether to throttle) for one request"""
+        with self._rng_lock:
+            return latency.sample(self._rng), self._rng.random() < self.config.throttle_rate
+
+    def record(self, endpoint: str, seconds: float, throttled: bool):
+        with self._stats_lock:
+            stats = self.stats[endpoint]
+            stats["requests"] += 1
+            stats["throttled"] += int(throttled)
+            stats["latencySeconds"] += seconds
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self._stats_lock:
+            return {endpoint: dict(stats) for endpoint, stats in self.stats.items()}
+
+    def reset(self):
+        with self._stats_lock:
+            self.stats.clear()
+
+
+def _index_name(match) -> str:
+    return unquote(match.group("plain") or match.group("quoted"))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    services: FakeAzureServices
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real services; pooled clients reuse connections
+
+    def log_message(self, format, *args):  # noqa: A002 - quiet; counters are in /_stats
+        pass
+
+    def _body(self) -> Dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def _send_json(self, status: int, payload, headers: Optional[Dict[str, str]] = None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _delay(self, endpoint: str, latency: Latency) -> bool:
+        """Sleep for the endpoint's latency; answer 429 and return False if this request is throttled"""
+        seconds, throttled = self.services.draw(latency)
+        self.services.record(endpoint, seconds, throttled)
+        if throttled:
+            retry_after_ms = self.services.config.retry_after_ms
+            self._send_json(429, {"error": {"code": "429", "message": "Rate limit is exceeded."}}, {
+                "retry-after-ms": str(retry_after_ms),
+                "retry-after": str(max(1, math.ceil(retry_after_ms / 1000)))
+            })
+            return False
+        time.sleep(seconds)
+        return True
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/_stats":
+            return self._send_json(200, self.services.snapshot())
+        match = _GET_DOC_PATH.match(path)
+        if match:
+            if not self._delay("search.get", self.services.config.search_latency):
+                return
+            key = unquote(match.group("key") or match.group("qkey"))
+            doc = self.services.index_for(_index_name(match)).documents.get(key)
+            if doc is None:
+                return self._send_json(404, {"error": {"code": "", "message": f"Document '{key}' not found"}})
+            selected = parse_qs(urlparse(self.path).query).get("$select", [""])[0]
+            fields = [name for name in selected.split(",") if name]
+            return self._send_json(200, {name: doc.get(name) for name in fields} if fields else doc)
+        match = _INDEX_PATH.match(path)
+        if match and self.services.index_for(_index_name(match)).definition is not None:
+            return self._send_json(200, self.services.index_for(_index_name(match)).definition)
+        self._send_json(404, {"error": {"code": "", "message": f"No fake for GET {path}"}})
+
+    def do_PUT(self):
+        match = _INDEX_PATH.match(urlparse(self.path).path)
+        if not match:
+            return self._send_json(404, {"error": {"code": "", "message": "No fake for this PUT"}})
+        definition = dict(self._body(), name=_index_name(match))
+        definition.setdefault("@odata.etag", '"0x1"')
+        self.services.index_for(definition["name"]).definition = definition
+        self._send_json(201, definition)
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        if path == "/_reset":
+            self.services.reset()
+            return self._send_json(200, {})
+        match = _OPENAI_PATH.match(path)
+        if match:
+            body = self._body()
+            if match.group("operation") == "embeddings":
+                return self._embeddings(match.group("deployment"), body)
+            return self._chat(match.group("deployment"), body)
+        match = _SEARCH_PATH.match(path)
+        if match:
+            return self._search(self.services.index_for(_index_name(match)), self._body())
+        match = _INDEX_DOCS_PATH.match(path)
+        if match:
+            body = self._body()
+            if not self._delay("search.index", self.services.config.search_latency):
+                return
+            index = self.services.index_for(_index_name(match))
+            return self._send_json(200, {"value": index.write(body.get("value", []))})
+        self._send_json(404, {"error": {"code": "", "message": f"No fake for POST {path}"}})
+
+    def _embeddings(self, deployment: str, body: Dict):
+        if not self._delay("embeddings", self.services.config.embeddings_latency):
+            return
+        inputs = body.get("input", [])
+        inputs = [inputs] if isinstance(inputs, str) else inputs
+        dimensions = int(body.get("dimensions") or DEFAULT_DIMENSIONS)
+        data = []
+        for index, text in enumerate(inputs):
+            vector = fake_embedding(str(text), dimensions)
+            if body.get("encoding_format") == "base64":
+                embedding = base64.b64encode(struct.pack(f"<{dimensions}f", *vector.tolist())).decode("ascii")
+            else:
+                embedding = vector.tolist()
+            data.append({"object": "embedding", "index": index, "embedding": embedding})
+        tokens = sum(len(str(text).split()) for text in inputs)
+        self._send_json(200, {
+            "object": "list",
+            "data": data,
+            "model": deployment,
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens}
+        })
+
+    def _chat(self, deployment: str, body: Dict):
+        if not self._delay("chat", self.services.config.chat_latency):
+            return
+        prompt_tokens = sum(len(str(m.get("content", "")).split()) for m in body.get("messages", []))
+        completion = {"id": "chatcmpl-fake", "created": int(time.time()), "model": deployment}
+        if not body.get("stream"):
+            return self._send_json(200, dict(
+                completion,
+                object="chat.completion",
+                choices=[{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": CHAT_ANSWER},
+                    "finish_reason": "stop"
+                }],
+                usage={
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": len(CHAT_ANSWER.split()),
+                    "total_tokens": prompt_tokens + len(CHAT_ANSWER.split())
+                }
+            ))
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")  # the stream ends when the connection does
+        self.end_headers()
+        self.close_connection = True
+        chunk = dict(completion, object="chat.completion.chunk")
+        # Azure leads with a chunk that only carries the prompt filter results
+        events = [dict(chunk, choices=[], prompt_filter_results=[])]
+        words = CHAT_ANSWER.split(" ")
+        events += [
+            dict(chunk, choices=[{"index": 0, "delta": {"content": (" " if i else "") + word}, "finish_reason": None}])
+            for i, word in enumerate(words)
+        ]
+        events.append(dict(chunk, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+        for i, event in enumerate(events):
+            if i > 1 and self.services.config.chat_token_ms:
+                time.sleep(self.services.config.chat_token_ms / 1000)
+            self.wfile.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def _search(self, index: FakeSearchIndex, body: Dict):
+        if not self._delay("search", self.services.config.search_latency):
+            return
+        select = body.get("select")
+        if isinstance(select, str):
+            select = [name.strip() for name in select.split(",") if name.strip()]
+        vector_k = max((query.get("k", 0) for query in body.get("vectorQueries") or []), default=0)
+        top = int(body.get("top") or max(vector_k, 50))
+        filters = parse_filter(body.get("filter") or "")
+        results = index.search(
+            body.get("search", ""), top, select, semantic=body.get("queryType") == "semantic", filters=filters
+        )
+        self._send_json(200, {"value": results})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve fake Azure OpenAI and Azure AI Search endpoints")
+    parser.add_argument("--port", type=int, default=8765)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    services = FakeAzureServices(FakeServiceConfig.from_args(args), port=args.port).start()
+    print(f"Fake Azure OpenAI + AI Search on {services.url} ({len(services.index.documents)} documents)", flush=True)
+    for name, value in services.env().items():
+        print(f"  {name}={value}", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        services.stop()
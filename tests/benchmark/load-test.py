@@ -0,0 +1,527 @@
+"""Offline load test for the RAG function, retrieve.py and ingest-kb.py
+
+Starts `fake_services.py` (local Azure OpenAI + AI Search stand-ins with
+configurable latency and 429 injection) in its own process, then runs each
+scenario in a fresh child process so memory is measured per scenario:
+
+- rag-search:  the `rag-search` route, in-process, at --concurrency
+- rag-burst:   the `rag-search` route hit by bursts of --concurrency identical
+               questions, with request coalescing on (adds pipeline runs)
+- rag-stream:  the streaming route's event generator (adds time to first token)
+- retrieve:    the Prompt Flow retrieval tool (needs `promptflow`), from a thread pool
+- retrieve-async: its async variant, `aretrieve`, from one event loop
+- ingest:      `ingest-kb.py --backend azure` against the fakes, on a corpus of
+               --corpus-copies copies of the KB articles, --runs times
+
+Each scenario reports throughput, p50/p95/p99 latency, errors, peak RSS and
+what the fakes saw (requests and 429s per endpoint). Embedding and answer
+caches and request coalescing (except in rag-burst) are disabled so every
+request reaches the fakes. Run from the
+repository root; no Azure credentials are needed:
+
+    python tests/benchmark/load-test.py all --output benchmark-results.json
+    python tests/benchmark/load-test.py rag-search --requests 400 --concurrency 32 --throttle-rate 0.05
+    python tests/benchmark/load-test.py all --baseline tests/benchmark/baseline.json --max-regression 0.3
+
+With --baseline (an earlier --output) the run fails (exit code 1) when a
+scenario has more errors, or makes more calls to a fake service per request,
+than the baseline. A p95 latency that rose, or a throughput that fell, by
+more than --max-regression is reported but doesn't fail the run: timings
+depend on the machine.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:  # Windows: peak RSS is not reported
+    resource = None
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(os.path.dirname(BENCHMARK_DIR))
+RAG_DIR = os.path.join(REPO_ROOT, "demos", "02-rag-search")
+FUNCTION_DIR = os.path.join(RAG_DIR, "rag-function")
+sys.path.insert(0, FUNCTION_DIR)
+from tracing import percentile  # noqa: E402
+
+SCENARIOS = ["rag-search", "rag-burst", "rag-stream", "retrieve", "retrieve-async", "ingest"]
+
+QUESTIONS = [
+    "How do I reset my password?",
+    "My account is locked after too many login attempts",
+    "VPN keeps disconnecting every few minutes",
+    "How do I connect to the VPN from home?",
+    "I was charged twice this month",
+    "Where can I download my invoice?",
+    "How do I update my payment method?",
+    "Outlook calendar is not syncing",
+    "How do I share my calendar with a colleague?",
+    "How do I install the latest software update?",
+    "Multi-factor authentication code is not arriving",
+    "Can I get a refund for a duplicate charge?",
+]
+
+# Every request reaches the fakes: no embedding or answer cache, no coalescing, no cache invalidation call from ingest
+BENCHMARK_ENV = {
+    "EMBEDDING_CACHE_MAX_ENTRIES": "0",
+    "RAG_ANSWER_CACHE_MAX_ENTRIES": "0",
+    "RAG_COALESCE": "false",
+    "RAG_COALESCE_STORE_PATH": "",
+    "RAG_FUNCTION_URL": "",
+    "RAG_PREWARM": "false",
+    "RETRIEVE_CACHE_MAX_ENTRIES": "0",
+}
+
+
+def peak_rss_mb(who: int = 0) -> Optional[float]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(who or resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)  # bytes on macOS, KiB elsewhere
+
+
+def summarize(latencies_ms: List[float], errors: int, elapsed: float, **extra) -> Dict:
+    completed = len(latencies_ms)
+    result = {
+        "requests": completed + errors,
+        "errors": errors,
+        "throughput": round(completed / elapsed, 2) if elapsed else 0.0,
+        "elapsedSeconds": round(elapsed, 2),
+    }
+    if latencies_ms:
+        result.update({f"p{p}Ms": round(percentile(latencies_ms, p), 1) for p in (50, 95, 99)})
+    result.update(extra)
+    return result
+
+
+def run_rag_search(args) -> Dict:
+    sys.path.insert(0, FUNCTION_DIR)
+    import azure.functions as func
+    import function_app
+
+    handler = function_app.rag_search.build().get_user_function()
+
+    async def main():
+        semaphore = asyncio.Semaphore(args.concurrency)
+        latencies, statuses = [], {}
+
+        async def one(i: int):
+            body = json.dumps({"question": QUESTIONS[i % len(QUESTIONS)]}).encode("utf-8")
+            async with semaphore:
+                started = time.perf_counter()
+                response = await handler(func.HttpRequest(method="POST", url="/api/rag-search", body=body))
+                if response.status_code == 200:
+                    latencies.append((time.perf_counter() - started) * 1000)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        await one(0)  # clients and connection pools are created outside the measurement (see cold-start.py)
+        latencies.clear()
+        statuses.clear()
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(args.requests)))
+        elapsed = time.perf_counter() - started
+        return summarize(latencies, args.requests - len(latencies), elapsed, statuses=statuses)
+
+    return asyncio.run(main())
+
+
+def run_rag_burst(args) -> Dict:
+    """Outage-style traffic: each burst is --concurrency users asking the same question at the same moment"""
+    os.environ["RAG_COALESCE"] = "true"
+    sys.path.insert(0, FUNCTION_DIR)
+    import azure.functions as func
+    import function_app
+
+    handler = function_app.rag_search.build().get_user_function()
+
+    async def main():
+        latencies, statuses = [], {}
+
+        async def one(question: str):
+            body = json.dumps({"question": question}).encode("utf-8")
+            started = time.perf_counter()
+            response = await handler(func.HttpRequest(method="POST", url="/api/rag-search", body=body))
+            if response.status_code == 200:
+                latencies.append((time.perf_counter() - started) * 1000)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        await one(QUESTIONS[0])  # warm-up, as in rag-search
+        latencies.clear()
+        statuses.clear()
+        coalescer = function_app.coalescer
+        coalescer.flights = coalescer.coalesced = 0
+        bursts = max(1, args.requests // args.concurrency)
+        started = time.perf_counter()
+        for burst in range(bursts):
+            await asyncio.gather(*(one(QUESTIONS[burst % len(QUESTIONS)]) for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+        requests = bursts * args.concurrency
+        return summarize(latencies, requests - len(latencies), elapsed, statuses=statuses,
+                         pipelineRuns=coalescer.flights, coalesced=coalescer.coalesced)
+
+    return asyncio.run(main())
+
+
+def run_rag_stream(args) -> Dict:
+    sys.path.insert(0, FUNCTION_DIR)
+    import function_app
+
+    async def main():
+        semaphore = asyncio.Semaphore(args.concurrency)
+        latencies, first_tokens = [], []
+
+        async def one(i: int):
+            async with semaphore:
+                started = time.perf_counter()
+                first_token, failed = None, False
+                async for event in function_app.rag_search_events(QUESTIONS[i % len(QUESTIONS)]):
+                    if event.startswith("event: token") and first_token is None:
+                        first_token = time.perf_counter()
+                    failed = failed or event.startswith("event: error")
+                if not failed:
+                    latencies.append((time.perf_counter() - started) * 1000)
+                    if first_token is not None:
+                        first_tokens.append((first_token - started) * 1000)
+
+        await one(0)
+        latencies.clear()
+        first_tokens.clear()
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(args.requests)))
+        elapsed = time.perf_counter() - started
+        extra = {f"firstTokenP{p}Ms": round(percentile(first_tokens, p), 1) for p in (50, 95)} if first_tokens else {}
+        return summarize(latencies, args.requests - len(latencies), elapsed, **extra)
+
+    return asyncio.run(main())
+
+
+def run_retrieve(args) -> Dict:
+    sys.path.insert(0, RAG_DIR)
+    try:
+        import retrieve
+    except ImportError as e:
+        return {"skipped": f"retrieve.py could not be imported ({e})"}
+
+    def one(i: int) -> float:
+        started = time.perf_counter()
+        retrieve.retrieve(
+            QUESTIONS[i % len(QUESTIONS)],
+            os.environ["AZURE_AI_SEARCH_ENDPOINT"],
+            os.environ["AZURE_AI_SEARCH_API_KEY"],
+            os.environ["AZURE_AI_SEARCH_INDEX"],
+            top_k=5
+        )
+        return (time.perf_counter() - started) * 1000
+
+    latencies, errors = [], 0
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        started = time.perf_counter()
+        for future in [pool.submit(one, i) for i in range(args.requests)]:
+            try:
+                latencies.append(future.result())
+            except Exception:
+                errors += 1
+        elapsed = time.perf_counter() - started
+    return summarize(latencies, errors, elapsed)
+
+
+def run_retrieve_async(args) -> Dict:
+    sys.path.insert(0, RAG_DIR)
+    try:
+        import retrieve
+    except ImportError as e:
+        return {"skipped": f"retrieve.py could not be imported ({e})"}
+
+    async def main():
+        semaphore = asyncio.Semaphore(args.concurrency)
+        latencies = []
+
+        async def one(i: int):
+            async with semaphore:
+                started = time.perf_counter()
+                await retrieve.aretrieve(
+                    QUESTIONS[i % len(QUESTIONS)],
+                    os.environ["AZURE_AI_SEARCH_ENDPOINT"],
+                    os.environ["AZURE_AI_SEARCH_API_KEY"],
+                    os.environ["AZURE_AI_SEARCH_INDEX"],
+                    top_k=5
+                )
+                latencies.append((time.perf_counter() - started) * 1000)
+
+        started = time.perf_counter()
+        outcomes = await asyncio.gather(*(one(i) for i in range(args.requests)), return_exceptions=True)
+        elapsed = time.perf_counter() - started
+        await retrieve.close_async_session()
+        return summarize(latencies, sum(1 for outcome in outcomes if isinstance(outcome, Exception)), elapsed)
+
+    return asyncio.run(main())
+
+
+def run_ingest(args) -> Dict:
+    """Full (non-incremental) ingestion of --corpus-copies copies of the KB, --runs times"""
+    workdir = tempfile.mkdtemp(prefix="ingest-benchmark-")
+    try:
+        content_dir = os.path.join(workdir, "content")
+        os.makedirs(content_dir)
+        articles = sorted(f for f in os.listdir(os.path.join(RAG_DIR, "content")) if f.endswith(".md"))
+        for copy in range(args.corpus_copies):
+            for filename in articles:
+                shutil.copy(
+                    os.path.join(RAG_DIR, "content", filename),
+                    os.path.join(content_dir, f"{filename[:-3]}-{copy}.md")
+                )
+        env = dict(os.environ, INGEST_MANIFEST_PATH=os.path.join(workdir, "manifest.json"))
+        latencies, errors = [], 0
+        started = time.perf_counter()
+        for _ in range(args.runs):
+            run_started = time.perf_counter()
+            # ingest-kb.py reads ./content, so it runs from the temporary corpus directory
+            completed = subprocess.run(
+                [sys.executable, os.path.join(RAG_DIR, "ingest-kb.py"), "--backend", "azure"],
+                cwd=workdir, env=env, capture_output=True, text=True
+            )
+            if completed.returncode == 0 and "Ingestion Complete" in completed.stdout:
+                latencies.append((time.perf_counter() - run_started) * 1000)
+            else:
+                errors += 1
+                print(completed.stdout[-1000:] + completed.stderr[-2000:], file=sys.stderr)
+        elapsed = time.perf_counter() - started
+        documents = len(articles) * args.corpus_copies
+        result = summarize(latencies, errors, elapsed, documents=documents)
+        result["documentsPerSecond"] = round(documents * len(latencies) / elapsed, 1) if elapsed else 0.0
+        result["peakRssMb"] = peak_rss_mb(resource.RUSAGE_CHILDREN if resource else 0)
+        return result
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+RUNNERS = {
+    "rag-search": run_rag_search,
+    "rag-burst": run_rag_burst,
+    "rag-stream": run_rag_stream,
+    "retrieve": run_retrieve,
+    "retrieve-async": run_retrieve_async,
+    "ingest": run_ingest
+}
+
+
+def child(args):
+    """Runs one scenario inside a fresh process; prints one JSON line"""
+    result = RUNNERS[args.scenario](args)
+    result.setdefault("peakRssMb", peak_rss_mb())
+    print(json.dumps(result))
+
+
+def fake_stats(url: str, reset: bool = False) -> Dict:
+    request = urllib.request.Request(f"{url}/_reset" if reset else f"{url}/_stats", data=b"{}" if reset else None)
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.loads(response.read())
+
+
+def start_fake_services(args) -> subprocess.Popen:
+    command = [sys.executable, os.path.join(BENCHMARK_DIR, "fake_services.py"), "--port", "0"]
+    for option in ("embeddings_latency", "chat_latency", "chat_token_ms", "search_latency",
+                   "throttle_rate", "retry_after_ms", "seed"):
+        command += [f"--{option.replace('_', '-')}", str(getattr(args, option))]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if " on http" not in line:
+        process.kill()
+        sys.exit(f"Fake services did not start: {line}")
+    process.url = line.split(" on ")[1].split()[0]
+    return process
+
+
+def run_scenario(scenario: str, args, url: str, env: Dict[str, str]) -> Dict:
+    fake_stats(url, reset=True)
+    command = [
+        sys.executable, os.path.abspath(__file__), scenario, "--child",
+        "--requests", str(args.requests), "--concurrency", str(args.concurrency),
+        "--runs", str(args.runs), "--corpus-copies", str(args.corpus_copies)
+    ]
+    completed = subprocess.run(command, cwd=REPO_ROOT, env=env, capture_output=True, text=True)
+    lines = [line for line in completed.stdout.splitlines() if line.startswith("{")]
+    if completed.returncode != 0 or not lines:
+        return {"failed": completed.stderr[-2000:] or "no result"}
+    result = json.loads(lines[-1])
+    result["fakes"] = fake_stats(url)
+    return result
+
+
+def print_report(results: Dict[str, Dict]):
+    print("\n| Scenario | Requests | Errors | Throughput (/s) | p50 (ms) | p95 (ms) | p99 (ms) "
+          "| Peak RSS (MB) | 429s |")
+    print("|----------|---------:|-------:|----------------:|---------:|---------:|---------:"
+          "|--------------:|-----:|")
+    for scenario, result in results.items():
+        if "skipped" in result or "failed" in result:
+            print(f"| {scenario} | {result.get('skipped') or 'failed'} | | | | | | | |")
+            continue
+        throttled = sum(stats.get("throttled", 0) for stats in result.get("fakes", {}).values())
+        print(f"| {scenario} | {result['requests']} | {result['errors']} | {result['throughput']:,.1f} | "
+              f"{result.get('p50Ms', 0):,.0f} | {result.get('p95Ms', 0):,.0f} | {result.get('p99Ms', 0):,.0f} | "
+              f"{result.get('peakRssMb') or '-'} | {throttled} |")
+    for scenario, result in results.items():
+        if "firstTokenP50Ms" in result:
+            print(f"\n{scenario}: time to first token p50 {result['firstTokenP50Ms']:,.0f} ms, "
+                  f"p95 {result['firstTokenP95Ms']:,.0f} ms")
+        if "pipelineRuns" in result:
+            chat = result.get("fakes", {}).get("chat", {}).get("requests", 0)
+            print(f"\n{scenario}: {result['requests']} requests ran {result['pipelineRuns']} pipelines "
+                  f"({result['coalesced']} coalesced), {chat} chat completions")
+        if "documentsPerSecond" in result:
+            print(f"\n{scenario}: {result['documents']} documents per run, "
+                  f"{result['documentsPerSecond']:,.1f} documents/s")
+        if "failed" in result:
+            print(f"\n{scenario} failed:\n{result['failed']}", file=sys.stderr)
+
+
+# Calls per request are deterministic up to hedged or coalesced calls, which vary a little with timing
+COUNTER_TOLERANCE = 0.05
+COUNTER_SLACK = 0.01  # calls per request; covers counters well below one call per request (rag-burst)
+# Calls per request only compare between runs with the same load shape (rag-burst coalesces more at higher
+# concurrency, 429s add retries); latencies also need the same fake latency profiles
+COUNTER_SETTINGS = ("requests", "concurrency", "runs", "corpus_copies", "throttle_rate", "retry_after_ms", "seed")
+TIMING_SETTINGS = COUNTER_SETTINGS + ("embeddings_latency", "chat_latency", "chat_token_ms", "search_latency")
+
+
+def calls_per_request(result: Dict) -> Dict[str, float]:
+    """Requests each fake endpoint received per scenario request (ingest: per run)"""
+    requests = result.get("requests") or 0
+    if not requests:
+        return {}
+    return {endpoint: stats["requests"] / requests for endpoint, stats in result.get("fakes", {}).items()}
+
+
+def differing_settings(settings: Dict, baseline: Dict, names: Tuple[str, ...]) -> List[str]:
+    """Settings among `names` whose value differs from the baseline's (baselines without settings match)"""
+    recorded = baseline.get("settings", {})
+    return [
+        f"{name} {settings[name]} vs {recorded[name]}"
+        for name in names if name in recorded and name in settings and settings[name] != recorded[name]
+    ]
+
+
+def regressions(
+    results: Dict[str, Dict], baseline: Dict[str, Dict], tolerance: float, settings: Dict
+) -> Tuple[List[str], List[str]]:
+    """(failures, notes) against the baseline
+
+    Failures are deterministic: more errors, or more calls to a service per request. Latency and throughput
+    depend on the machine (shared CI runners vary by more than 2x between runs), so a p95 that rose or a
+    throughput that fell by more than `tolerance` (a fraction) is only noted. Calls per request (and timings)
+    are only compared when the run used the baseline's load settings (COUNTER_SETTINGS, TIMING_SETTINGS).
+    """
+    failures, notes = [], []
+    counter_changes = differing_settings(settings, baseline, COUNTER_SETTINGS)
+    timing_changes = differing_settings(settings, baseline, TIMING_SETTINGS)
+    if counter_changes:
+        notes.append("calls per request not compared, settings differ from the baseline: " + ", ".join(counter_changes))
+    elif timing_changes:
+        notes.append("latency and throughput not compared, settings differ from the baseline: "
+                     + ", ".join(timing_changes))
+    for scenario, result in results.items():
+        before = baseline.get("scenarios", baseline).get(scenario)
+        if not before or "requests" not in before:
+            notes.append(f"{scenario}: no baseline to compare against")
+            continue
+        if "requests" not in result:
+            notes.append(f"{scenario}: {result.get('skipped') or 'failed'}, not compared")
+            continue
+        if result["errors"] > before["errors"]:
+            failures.append(f"{scenario}: {result['errors']} errors vs {before['errors']} in the baseline")
+        if not counter_changes:
+            calls_before = calls_per_request(before)
+            for endpoint, calls in sorted(calls_per_request(result).items()):
+                allowed = calls_before.get(endpoint, 0.0) * (1 + COUNTER_TOLERANCE) + COUNTER_SLACK
+                if calls > allowed:
+                    failures.append(f"{scenario}: {calls:.2f} {endpoint} calls per request vs "
+                                    f"{calls_before.get(endpoint, 0.0):.2f} in the baseline")
+        if timing_changes:
+            continue
+        if "p95Ms" in before and "p95Ms" in result and result["p95Ms"] > before["p95Ms"] * (1 + tolerance):
+            notes.append(f"{scenario}: p95 {result['p95Ms']:,.0f} ms vs {before['p95Ms']:,.0f} ms in the baseline")
+        if result["throughput"] < before["throughput"] * (1 - tolerance):
+            notes.append(f"{scenario}: throughput {result['throughput']:,.1f}/s vs {before['throughput']:,.1f}/s "
+                         "in the baseline")
+    return failures, notes
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, BENCHMARK_DIR)
+    from fake_services import add_arguments
+
+    parser = argparse.ArgumentParser(description="Load-test the RAG function, retrieve.py and ingest-kb.py offline")
+    parser.add_argument("scenario", choices=SCENARIOS + ["all"])
+    parser.add_argument(
+        "--requests", type=int, default=200, help="Requests per scenario (rag-search, rag-stream, retrieve)"
+    )
+    parser.add_argument("--concurrency", type=int, default=16, help="Requests in flight at once")
+    parser.add_argument("--runs", type=int, default=3, help="Ingestion runs")
+    parser.add_argument("--corpus-copies", type=int, default=10, help="Copies of the KB articles ingested per run")
+    parser.add_argument("--output", help="Write the results as JSON")
+    parser.add_argument("--baseline", help="Fail on regressions against this --output file")
+    parser.add_argument(
+        "--max-regression", type=float, default=0.3, help="p95 / throughput change vs the baseline that is reported"
+    )
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        sys.exit(0)
+
+    services = start_fake_services(args)
+    try:
+        env = dict(os.environ, **BENCHMARK_ENV)
+        env.update({
+            "AZURE_OPENAI_ENDPOINT": services.url,
+            "AZURE_OPENAI_API_KEY": "fake-key",
+            "AZURE_AI_SEARCH_ENDPOINT": services.url,
+            "AZURE_AI_SEARCH_API_KEY": "fake-key",
+            "AZURE_AI_SEARCH_INDEX": "kb-support",
+            "RAG_SEARCH_BACKEND": "azure",
+        })
+        results = {}
+        for scenario in (SCENARIOS if args.scenario == "all" else [args.scenario]):
+            print(f"Running {scenario}...", file=sys.stderr)
+            results[scenario] = run_scenario(scenario, args, services.url, env)
+    finally:
+        services.terminate()
+
+    print(f"\nFakes: embeddings {args.embeddings_latency} ms, chat {args.chat_latency} ms "
+          f"(+{args.chat_token_ms:g} ms/token streamed), search {args.search_latency} ms, "
+          f"429 rate {args.throttle_rate:.0%}; concurrency {args.concurrency}")
+    print_report(results)
+
+    settings = {name: getattr(args, name) for name in (
+        "requests", "concurrency", "runs", "corpus_copies", "embeddings_latency", "chat_latency",
+        "chat_token_ms", "search_latency", "throttle_rate", "retry_after_ms", "seed"
+    )}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"settings": settings, "scenarios": results}, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    failed = [scenario for scenario, result in results.items() if "failed" in result]
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            found, notes = regressions(results, json.load(f), args.max_regression, settings)
+        for message in notes:
+            print(f"NOTE {message}", file=sys.stderr)
+        for message in found:
+            print(f"REGRESSION {message}", file=sys.stderr)
+        if found:
+            sys.exit(1)
+    sys.exit(1 if failed else 0)
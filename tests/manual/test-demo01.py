@@ -1,10 +1,17 @@
 """Test Demo 01 - Triage Flow"""
 import os
+import sys
 from dotenv import load_dotenv
 from openai import AzureOpenAI
 from azure.identity import DefaultAzureCredential, get_bearer_token_provider
 import json
 
+# Shared retry / concurrency / circuit breaker wrapper from the RAG function
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "demos", "02-rag-search", "rag-function")
+)
+from resilience import ResilientOpenAI  # noqa: E402
+
 # Load environment variables
 load_dotenv()
 
@@ -15,8 +22,10 @@ token_provider = get_bearer_token_provider(credential, "https://cognitiveservice
 client = AzureOpenAI(
     azure_ad_token_provider=token_provider,
     api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
-    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
+    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+    max_retries=0
 )
+client = ResilientOpenAI(client)
 
 # Read prompts
 with open("demos/01-triage-promptflow/prompts/system.jinja2", "r") as f:
@@ -1,9 +1,16 @@
 """Test Demo 02 - RAG Search without requiring ingestion"""
 import os
+import sys
 from dotenv import load_dotenv
 from openai import AzureOpenAI
 from azure.identity import DefaultAzureCredential, get_bearer_token_provider
 
+# Shared retry / concurrency / circuit breaker wrapper from the RAG function
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "demos", "02-rag-search", "rag-function")
+)
+from resilience import ResilientOpenAI  # noqa: E402
+
 # Load environment
 load_dotenv()
 
@@ -14,8 +21,10 @@ token_provider = get_bearer_token_provider(credential, "https://cognitiveservice
 client = AzureOpenAI(
     azure_ad_token_provider=token_provider,
     api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
-    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
+    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+    max_retries=0
 )
+client = ResilientOpenAI(client)
 
 # Read KB documents directly
 kb_docs = []